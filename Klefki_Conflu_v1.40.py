@@ -1,18 +1,24 @@
 # confluence_attachments_from_zip_gui_11_dnd.py
 # 08版ベース：DnD(ドラッグ&ドロップ)対応 / 黒地ログ / md・Word切替  (C) Tanukida
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
-import tkinter.font as tkfont
+# ヘッドレス実行: python Klefki_Conflu_v1.40.py convert <zip|dir>... --out DIR --jobs N
+# ベンチマーク:   python Klefki_Conflu_v1.40.py bench --pages 200 800 3200 --workers 1 4（synth で合成バックアップだけ作成）
+from __future__ import annotations
 from pathlib import Path
-import os, re, sys, zipfile, shutil
+import os, re, sys, io, zipfile, shutil, multiprocessing, threading, tempfile, struct, time, argparse, queue
 from datetime import datetime
 from bs4 import BeautifulSoup
-import unicodedata, urllib.parse
+import unicodedata, urllib.parse, hashlib, pickle, json, html, heapq, zlib
+from dataclasses import dataclass, field
 from collections import defaultdict
 from functools import lru_cache
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
 
 APP_TITLE = "Klefki Conflu"
 ATT_DIR_NAME = "添付ファイル"
+ATT_HISTORY_DIR_NAME = "添付ファイル履歴"   # 旧版の添付（history モード時のみ）
+ATTACHMENT_VERSION_MODES = ("latest", "history", "all")   # 最新版のみ / 最新版＋旧版を別フォルダ / 全版を同じフォルダ
+ATTACHMENT_VERSION_MODE = "latest"
 # USE_FILE_URI_FOR_ATTACHMENTS = True # 添付リンクを絶対パス (file:///C:/...) にする
 USE_OFFICE_URI_SCHEME = True  # .xlsx/.docx/.pptx をアプリで直接開く (Windows + Office)
 HTML_DIR_NAME = "html_pages" # HTML出力先ディレクトリ名
@@ -28,15 +34,27 @@ NOT_FOUND_LOG_NAME = "not_found_attachments.log"
 SIDEBAR_HTML_ROOT: Path | None = None
 SIDEBAR_ITEMS = [] 
 SIDEBAR_EMPTY_PAGES: set[Path] = set()   # 空白ページの一覧
+SIDEBAR_MODE = "manifest"   # "manifest": 共有 _sidebar.js をブラウザ側で描画 / "inline": 各ページに全リンクを埋め込む
+SIDEBAR_MANIFEST_NAME = "_sidebar.js"
+SEARCH_INDEX = True            # html_pages/_search/ に全文検索インデックスを出力し，各ページ右上に検索窓を置く
+SEARCH_DIR_NAME = "_search"
+SEARCH_SHARD_POSTINGS = 20000  # 1シャードあたりのポスティング数の目安（検索時は該当シャードだけ読み込む）
+SEARCH_MAX_SHARDS = 256
+SEARCH_TITLE_WEIGHT = 100      # タイトルに含まれる語の重み（本文の出現数はこれ未満に丸める）
+SEARCH_MAX_TOKEN_LEN = 32
+PAGE_HISTORY = False           # html_pages/_history/ にページの版履歴（最新版＋旧版への差分）を出力し，各ページ右上に「履歴」リンクを置く
+HISTORY_DIR_NAME = "_history"
+LOG_DRAIN_INTERVAL_MS = 50     # GUI がワーカーのログキューを取り出す間隔
+LOG_DRAIN_MAX_LINES = 2000     # 1回の取り出しでログ欄へ書き込む最大行数
 
 # --- optional deps ---
-try:
-    from tkinterdnd2 import DND_FILES, TkinterDnD  # pip install tkinterdnd2
-    HAS_DND = True
-except Exception:
-    HAS_DND = False
-    DND_FILES = None
-    TkinterDnD = None
+# GUI（tkinter / tkinterdnd2）は _gui_app() で GUI を起動する時だけ import する．
+# 変換パイプラインと CLI はモジュールを import しても tkinter を読み込まない（ディスプレイの無いサーバ向け）
+if TYPE_CHECKING:
+    import tkinter as tk
+HAS_DND = False
+DND_FILES = None
+TkinterDnD = None
 
 try:
     import magic
@@ -56,6 +74,13 @@ try:
 except Exception:
     HAS_DOCX = False
 
+try:
+    from lxml import etree as lxml_etree   # pip install lxml（本文変換の高速エンジン）
+    HAS_LXML = True
+except Exception:
+    HAS_LXML = False
+    lxml_etree = None
+
 MIME_TO_EXT = {
     "image/jpeg": ".jpg","image/png": ".png","image/gif": ".gif","image/webp": ".webp","image/tiff": ".tif","image/webp": ".webp",
     "application/pdf": ".pdf","application/msword": ".doc",
@@ -76,20 +101,91 @@ def strip_any_ext(name: str) -> str:
 def sanitize(s: str) -> str:
     s = re.sub(r'[\\/:*?"<>|]', " ", s or ""); return re.sub(r"\s+", " ", s).strip()
 
-def ensure_unique(dst: Path) -> Path:
-    if not dst.exists(): return dst
-    stem, ext = os.path.splitext(dst.name); i = 2
-    while True:
-        cand = dst.with_name(f"{stem} ({i}){ext}")
-        if not cand.exists(): return cand
-        i += 1
+class _NameRegistry:
+    """
+    ディレクトリごとの使用済みファイル名の台帳（スレッドセーフ）．
+    各ディレクトリは最初に使う時に1回だけ listdir して既存の名前を取り込み，以降はメモリ上だけで一意な名前を決める．
+    同じ名前に付けた最後の連番を覚えておくので，同名が何百あっても exists() を繰り返さない．
+    名前の比較は os.path.normcase（Windows では大小無視）．
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirs: dict[str, set[str]] = {}
+        self._next: dict[tuple, int] = {}
+
+    def _names(self, directory: Path) -> set[str]:
+        key = str(directory)
+        names = self._dirs.get(key)
+        if names is None:
+            try:
+                names = {os.path.normcase(n) for n in os.listdir(directory)}
+            except OSError:
+                names = set()
+            self._dirs[key] = names
+        return names
+
+    def allocate(self, dst: Path) -> Path:
+        # dst が空いていればそのまま，使用済みなら "name (2).ext" … の連番で空いている名前を確保して返す
+        with self._lock:
+            names = self._names(dst.parent)
+            if os.path.normcase(dst.name) not in names:
+                names.add(os.path.normcase(dst.name))
+                return dst
+            stem, ext = os.path.splitext(dst.name)
+            key = (str(dst.parent), os.path.normcase(dst.name))
+            i = self._next.get(key, 2)
+            while True:
+                cand = f"{stem} ({i}){ext}"
+                i += 1
+                if os.path.normcase(cand) not in names:
+                    break
+            names.add(os.path.normcase(cand))
+            self._next[key] = i
+            return dst.with_name(cand)
+
+class _NameAllocator:
+    """
+    出力ファイル名の一意化（_NameRegistry に seq 順の払い出しを加えたもの）．
+    seq を渡すと seq 順に払い出すため，並列でも直列と同じ "name (2).ext" が付く．
+    """
+    def __init__(self, registry: _NameRegistry | None = None):
+        self._cond = threading.Condition()
+        self._registry = registry or _NameRegistry()
+        self._next = 0
+        self._released: set[int] = set()
+
+    def allocate(self, dst: Path, seq: int | None = None) -> Path:
+        with self._cond:
+            if seq is not None:
+                self._cond.wait_for(lambda: self._next >= seq)
+            cand = self._registry.allocate(dst)
+            if seq is not None:
+                self._advance(seq)
+            return cand
+
+    def release(self, seq: int) -> None:
+        # 名前を確保せずに終わったエントリ（スキップ/例外）の順番を進める
+        with self._cond:
+            if seq == self._next:
+                self._advance(seq)
+            elif seq > self._next:
+                self._released.add(seq)
+
+    def _advance(self, seq: int) -> None:
+        if seq != self._next:
+            return
+        self._next += 1
+        while self._next in self._released:
+            self._released.discard(self._next)
+            self._next += 1
+        self._cond.notify_all()
 
 def mime_from_bytes(b: bytes) -> str | None:
     if not HAS_MAGIC: return None
     try: return magic.from_buffer(b, mime=True)
     except Exception: return None
 
-def log_append(txt: tk.Text, line: str):
+def _log_level(line: str) -> str:
     # 色分け（CMD風）
     lvl = "INFO"
     s = line.lstrip()
@@ -103,19 +199,39 @@ def log_append(txt: tk.Text, line: str):
         lvl = "MOVE"
     elif s.startswith("[INFO]"):
         lvl = "INFO"
+    return lvl
+
+def log_append(txt: tk.Text, line: str):
+    # txt にはログ欄（tk.Text）のほか，1行を受け取る callable（list.append 等）も渡せる
+    if callable(txt):
+        txt(line)
+        return
     txt.config(state="normal")
-    txt.insert("end", line + "\n", (lvl,))
+    txt.insert("end", line + "\n", (_log_level(line),))
     txt.see("end")
     txt.config(state="disabled")
     pump_gui(txt)
 
+def log_append_many(txt: tk.Text, lines: list[str]):
+    # 複数行をまとめて書き込み，再描画は1回だけにする（ワーカースレッドのログ取り出し用）
+    if not lines:
+        return
+    txt.config(state="normal")
+    for line in lines:
+        txt.insert("end", line + "\n", (_log_level(line),))
+    txt.see("end")
+    txt.config(state="disabled")
+
 def pump_gui(widget: tk.Widget) -> None:
-    # 重い処理中に GUI が真っ白で固まらないように更新するヘルパ
+    # 重い処理中に GUI が真っ白で固まらないように更新するヘルパ（GUI を起動していなければ tkinter は未 import）
+    tkinter = sys.modules.get("tkinter")
+    if tkinter is None or not isinstance(widget, tkinter.Misc):
+        return
     try:
         # 描画キューとイベントキューを処理する
         widget.update_idletasks()
         widget.update()
-    except tk.TclError:
+    except tkinter.TclError:
         # ウィンドウを閉じた後などに呼ばれても落ちないように握りつぶす
         pass
 
@@ -132,20 +248,6 @@ def _get_attach_dir(out_root: Path) -> Path:
     """添付の実体が入っているディレクトリ"""
     return (out_root / ATT_DIR_NAME).resolve()
 
-def build_attachment_index(out_root: Path) -> dict:
-    # out_root/添付ファイル 配下を1回だけ走査し，名前→Path / stem→Paths の索引を作る．
-    att_root = (out_root / ATT_DIR_NAME)
-    by_name: dict[str, Path] = {}
-    by_lower: dict[str, Path] = {}
-    by_stem: dict[str, list[Path]] = defaultdict(list)
-    if att_root.exists():
-        for p in att_root.rglob("*"):
-            if p.is_file():
-                by_name[p.name] = p
-                by_lower[p.name.lower()] = p
-                by_stem[p.stem.lower()].append(p)
-    return {"by_name": by_name, "by_lower": by_lower, "by_stem": dict(by_stem)}
-
 def _log_not_found_attachment(out_root: Path, wanted: str, context: str = "") -> None:
     if not LOG_NOT_FOUND_ATTACHMENTS:
         return
@@ -185,10 +287,41 @@ def normalize_all_attachment_filenames(out_root: Path) -> None:
             except Exception:
                 pass
 
+# 本文の先頭から順にタグを読み飛ばし，最初の空白以外のテキストで打ち切る簡易走査用
+_BLANK_TAG_RE = re.compile(r"""<(/?)([A-Za-z][^\s/>]*)(?:[^>"']|"[^"]*"|'[^']*')*>""")
+# 中身がタグとして読まれない，またはテキストとして数えられないタグ
+_BLANK_RAW_TAGS = {"script", "style", "template", "textarea", "title", "xmp", "plaintext",
+                   "iframe", "noembed", "noframes", "noscript"}
+_BLANK_CTRL_RE = re.compile(r"[\x00-\x08\x0b\x0e-\x1f\x7f]")
+
+def _storage_has_text(storage_html: str) -> bool | None:
+    # 空白以外のテキストがあれば True，タグと空白だけなら False．
+    # コメント/CDATA/script 等や閉じていないタグなど，解析器の扱いに依存する箇所に来たら None（判定保留）
+    pos, n = 0, len(storage_html)
+    while pos < n:
+        lt = storage_html.find("<", pos)
+        seg = storage_html[pos:] if lt < 0 else storage_html[pos:lt]
+        if seg and not seg.isspace():
+            if "&" in seg:
+                seg = html.unescape(seg)
+            if seg.strip():
+                return None if _BLANK_CTRL_RE.search(seg) else True
+        if lt < 0:
+            break
+        m = _BLANK_TAG_RE.match(storage_html, lt)
+        if m is None or (not m.group(1) and m.group(2).lower() in _BLANK_RAW_TAGS):
+            return None
+        pos = m.end()
+    return False
+
 def _is_blank_storage_html(storage_html: str) -> bool:
     # Confluence の storage HTML が実質『空』かどうかを判定する
     if not storage_html or not storage_html.strip():
         return True
+    # 大半のページは先頭の走査だけで決まる（決まらなければ従来どおり解析して判定）
+    has_text = _storage_has_text(storage_html)
+    if has_text is not None:
+        return not has_text
 
     try:
         s = BeautifulSoup(storage_html or "", "lxml")
@@ -200,64 +333,144 @@ def _is_blank_storage_html(storage_html: str) -> bool:
 
 
 # ---------- entities.xml 解析 ----------
-def parse_entities(xml_bytes: bytes):
+def _pick_text(parent, paths) -> str:
+    for p in paths:
+        el = parent.find(p)
+        if el is not None and (el.text or "").strip():
+            return el.text.strip()
+    return ""
+
+_ID_PATHS = ["id[@name='id']", "property[@name='id']"]
+
+def _iter_entity_objects(src):
+    # entities.xml を iterparse で前から1回だけ読み，トップレベルの <object> を1件ずつ返す．
+    # 返した要素は呼び出し側の処理後に clear するので，ツリー全体をメモリに保持しない．
     import xml.etree.ElementTree as ET
-    spaces, pages, att_title, att_to_page, att_filename = {}, {}, {}, {}, {}
+    if isinstance(src, (bytes, bytearray)):
+        src = io.BytesIO(src)
+    root = None
+    depth = 0
+    obj_depth = 0
+    for ev, el in ET.iterparse(src, events=("start", "end")):
+        if ev == "start":
+            if root is None:
+                root = el
+            depth += 1
+            if el.tag == "object":
+                obj_depth += 1
+            continue
+        depth -= 1
+        if el.tag == "object":
+            obj_depth -= 1
+            if obj_depth == 0:
+                yield el
+                el.clear()
+        if depth == 1 and obj_depth == 0:
+            # 処理済みの子要素をルートから切り離してメモリを解放
+            root.clear()
+
+def _page_status(original_id: str, content_status: str) -> str:
+    # 旧版は originalVersion（現行ページのID）を持つ．下書きは contentStatus=draft
+    content_status = content_status.lower()
+    if original_id or content_status == "historical":
+        return "historical"
+    if content_status == "draft":
+        return "draft"
+    return "current"
+
+def parse_entities_stream(src) -> dict:
+    """
+    entities.xml を1パスで解析する共通パーサ．
+    src は bytes / ファイルパス / ファイルオブジェクト（zf.open() 等）のいずれでもよい．
+    戻り値: spaces, pages, bodies, att_title, att_to_page, att_filename, att_version の dict
+    （pages の各要素は title, spaceId, parentId, 本文が空かどうかの blank と，
+      版の種別 status（current / historical / draft），旧版の元ページ originalId, version, modified を持つ）
+    """
+    spaces, pages, bodies, blank = {}, {}, {}, {}
+    att_title, att_to_page, att_version = {}, {}, {}
+    fname_by_version, fname_by_data = {}, {}
+
+    for obj in _iter_entity_objects(src):
+        cls = obj.get("class")
+        if cls == "Space":
+            sid  = _pick_text(obj, _ID_PATHS)
+            skey = _pick_text(obj, ["property[@name='key']", "property[@name='spaceKey']"])
+            if sid and skey:
+                spaces[sid] = skey
+
+        elif cls == "Page":
+            pid   = _pick_text(obj, _ID_PATHS)
+            title = _pick_text(obj, ["property[@name='title']"])
+            spaceId = ""
+            space_prop = obj.find("property[@name='space']")
+            if space_prop is not None:
+                spaceId = _pick_text(space_prop, _ID_PATHS)
+            parentId = ""
+            par_prop = obj.find("property[@name='parent']")
+            if par_prop is not None:
+                parentId = _pick_text(par_prop, _ID_PATHS)
+            originalId = ""
+            orig_prop = obj.find("property[@name='originalVersion']")
+            if orig_prop is not None:
+                originalId = _pick_text(orig_prop, _ID_PATHS)
+            status = _page_status(originalId, _pick_text(obj, ["property[@name='contentStatus']"]))
+            ver = _pick_text(obj, ["property[@name='version']"])
+            if pid:
+                pages[pid] = {"title": title or f"page_{pid}", "spaceId": spaceId, "parentId": parentId,
+                              "status": status, "originalId": originalId, "version": int(ver) if ver.isdigit() else 0,
+                              "modified": _pick_text(obj, ["property[@name='lastModificationDate']"])}
+
+        elif cls == "BodyContent":
+            pid  = _pick_text(obj, ["property[@name='content']/id[@name='id']"])
+            html = _pick_text(obj, ["property[@name='body']"])
+            if pid and html:
+                bodies[pid] = html
+                blank[pid] = _is_blank_storage_html(html)
+
+        elif cls == "Attachment":
+            aid    = _pick_text(obj, _ID_PATHS)
+            atitle = _pick_text(obj, ["property[@name='title']"])
+            pageId = ""
+            for cname in ("container", "containerContent", "content"):
+                cont = obj.find(f"property[@name='{cname}']")
+                if cont is not None:
+                    pageId = _pick_text(cont, _ID_PATHS)
+                    if pageId:
+                        break
+            if aid:
+                if atitle: att_title[aid] = atitle
+                if pageId: att_to_page[aid] = pageId
+                # 現行版（originalVersion を持たない Attachment）の版番号 = attachments/<pageId>/<attId>/<版> の最新
+                orig = obj.find("property[@name='originalVersion']")
+                ver = _pick_text(obj, ["property[@name='version']"])
+                if (orig is None or not _pick_text(orig, _ID_PATHS)) and ver.isdigit():
+                    att_version[aid] = int(ver)
+
+        elif cls in ("AttachmentVersion", "AttachmentData"):
+            # AttachmentVersion / AttachmentData -> fileName（AttachmentData を優先）
+            aid = _pick_text(obj, ["property[@name='attachment']/id[@name='id']",
+                                   "property[@name='attachment']/property[@name='id']"])
+            fname = _pick_text(obj, ["property[@name='fileName']"])
+            if aid and fname:
+                (fname_by_version if cls == "AttachmentVersion" else fname_by_data)[aid] = fname
+
+    # 空白ページの判定結果はページモデルに持たせる（本文の無いページも空白）
+    for pid, meta in pages.items():
+        meta["blank"] = blank.get(pid, True)
+
+    att_filename = dict(fname_by_version)
+    att_filename.update(fname_by_data)
+    return {"spaces": spaces, "pages": pages, "bodies": bodies,
+            "att_title": att_title, "att_to_page": att_to_page, "att_filename": att_filename,
+            "att_version": att_version}
+
+def parse_entities(src):
+    # 互換ラッパ：(spaces, pages, att_title, att_to_page, att_filename) を返す
     try:
-        root = ET.fromstring(xml_bytes)
+        ent = parse_entities_stream(src)
     except Exception:
-        return spaces, pages, att_title, att_to_page, att_filename
-
-    def pick(parent, paths):
-        for p in paths:
-            el = parent.find(p)
-            if el is not None and (el.text or "").strip():
-                return el.text.strip()
-        return ""
-
-    # Space
-    for obj in root.findall(".//object[@class='Space']"):
-        sid  = pick(obj, ["id[@name='id']", "property[@name='id']"])
-        skey = pick(obj, ["property[@name='key']", "property[@name='spaceKey']"])
-        if sid and skey:
-            spaces[sid] = skey
-
-    # Page
-    for obj in root.findall(".//object[@class='Page']"):
-        pid   = pick(obj, ["id[@name='id']", "property[@name='id']"])
-        title = pick(obj, ["property[@name='title']"]) or (f"page_{pid}" if pid else "")
-        spaceId = ""
-        space_prop = obj.find("property[@name='space']")
-        if space_prop is not None:
-            spaceId = pick(space_prop, ["id[@name='id']", "property[@name='id']"])
-        parentId = ""
-        par_prop = obj.find("property[@name='parent']")
-        if par_prop is not None:
-            parentId = pick(par_prop, ["id[@name='id']", "property[@name='id']"])
-        if pid:
-            pages[pid] = {"title": title, "spaceId": spaceId, "parentId": parentId}
-
-    # Attachment
-    for obj in root.findall(".//object[@class='Attachment']"):
-        aid    = pick(obj, ["id[@name='id']", "property[@name='id']"])
-        atitle = pick(obj, ["property[@name='title']"]) or ""
-        pageId = ""
-        cont = obj.find("property[@name='container']")
-        if cont is not None:
-            pageId = pick(cont, ["id[@name='id']", "property[@name='id']"])
-        if aid:
-            if atitle: att_title[aid] = atitle
-            if pageId: att_to_page[aid] = pageId
-
-    # AttachmentVersion / AttachmentData -> fileName
-    for cls in ("AttachmentVersion", "AttachmentData"):
-        for obj in root.findall(f".//object[@class='{cls}']"):
-            aid = pick(obj, ["property[@name='attachment']/id[@name='id']",
-                            "property[@name='attachment']/property[@name='id']"])
-            fname = pick(obj, ["property[@name='fileName']"])
-            if aid and fname:
-                att_filename[aid] = fname
-    return spaces, pages, att_title, att_to_page, att_filename
+        return {}, {}, {}, {}, {}
+    return ent["spaces"], ent["pages"], ent["att_title"], ent["att_to_page"], ent["att_filename"]
 
 def _decide_space_key(spaces: dict, pages: dict) -> str:
     if spaces:
@@ -272,46 +485,175 @@ def _decide_space_key(spaces: dict, pages: dict) -> str:
         return list(spaces.values())[0]
     return "UnknownSpace"
 
-def _get_space_key_from_zip(zip_path: Path) -> str:
+def _locate_in_zip_names(names: list[str]) -> tuple[str, str]:
+    # ZIP 内の (attachments ルート, entities.xml) を決める．見つからなければ ""
+    attach_roots = sorted({ n.split("attachments/")[0] + "attachments/"
+                            for n in names if "attachments/" in n })
+    attach_root_in_zip = min(attach_roots, key=len) if attach_roots else ""
+    ent_candidates = [n for n in names if n.lower().endswith("entities.xml")]
+    entities_name = ""
+    if attach_root_in_zip:
+        parent = "/".join(attach_root_in_zip.strip("/").split("/")[:-1])
+        for n in ent_candidates:
+            if n.startswith(parent + "/"):
+                entities_name = n; break
+    if not entities_name and ent_candidates:
+        entities_name = ent_candidates[0]
+    return attach_root_in_zip, entities_name
+
+def _locate_in_folder(root: Path) -> tuple[Path | None, Path | None]:
+    # フォルダ内の (attachments ディレクトリ, entities.xml) を決める
+    candidates = sorted([p for p in root.rglob("attachments") if p.is_dir()],
+                        key=lambda p: len(str(p)))
+    attach_root_on_disk = candidates[0] if candidates else None
+    ent_file = None
+    if attach_root_on_disk is not None:
+        ent = attach_root_on_disk.parent / "entities.xml"
+        if ent.exists(): ent_file = ent
+    if not ent_file:
+        ents = list(root.rglob("entities.xml"))
+        if ents: ent_file = ents[0]
+    return attach_root_on_disk, ent_file
+
+def _folder_entities_files(root: Path) -> list[Path]:
+    # フォルダ配下の entities.xml を全部（複数エクスポートをまとめたフォルダ用）
+    return list(root.rglob("entities.xml"))
+
+# ---------- バックアップモデル（1回の実行で entities.xml を1回だけ解析して共有） ----------
+MODEL_CACHE_VERSION = 4
+MODEL_CACHE_DIR_ENV = "KLEFKI_CACHE_DIR"
+
+@dataclass
+class BackupModel:
+    source: str                  # 入力（Zip またはフォルダ）のパス
+    is_zip: bool
+    entities_name: str = ""      # Zip 内メンバ名 / entities.xml のファイルパス
+    attach_root: str = ""        # Zip 内 ".../attachments/" / attachments ディレクトリのパス
+    spaces: dict = field(default_factory=dict)
+    pages: dict = field(default_factory=dict)
+    bodies: dict = field(default_factory=dict)
+    att_title: dict = field(default_factory=dict)
+    att_to_page: dict = field(default_factory=dict)
+    att_filename: dict = field(default_factory=dict)
+    att_version: dict = field(default_factory=dict)   # 添付ID → 現行版の版番号
+    attach_pages: set | None = None   # スペース別に分けたモデルで展開する attachments/<ページID>（None = 全部）
+
+    @property
+    def space_key(self) -> str:
+        return _decide_space_key(self.spaces, self.pages)
+
+def _model_cache_dir() -> Path:
+    env = os.environ.get(MODEL_CACHE_DIR_ENV)
+    return Path(env) if env else Path.home() / ".klefki_conflu" / "cache"
+
+def _model_cache_path(input_path: Path) -> Path | None:
+    # Zip: サイズ / mtime / entities.xml の CRC（中央ディレクトリから取得，本体は読まない）
+    # フォルダ: 配下の全 entities.xml のサイズ / mtime
     try:
-        with zipfile.ZipFile(str(zip_path), "r") as zf:
+        input_path = input_path.resolve()
+        if input_path.is_file():
+            st = input_path.stat()
+            with zipfile.ZipFile(str(input_path), "r") as zf:
+                _, ent = _locate_in_zip_names([n for n in zf.namelist() if not n.endswith("/")])
+                crc = zf.getinfo(ent).CRC if ent else 0
+            key = f"zip|{input_path}|{st.st_size}|{st.st_mtime_ns}|{crc:08x}"
+        else:
+            ent_files = _folder_entities_files(input_path)
+            if not ent_files:
+                return None
+            parts = []
+            for ent_file in ent_files:
+                st = ent_file.stat()
+                parts.append(f"{ent_file.resolve()}|{st.st_size}|{st.st_mtime_ns}")
+            key = "dir|" + "|".join(parts)
+    except Exception:
+        return None
+    digest = hashlib.sha1(f"v{MODEL_CACHE_VERSION}|{key}".encode("utf-8")).hexdigest()
+    return _model_cache_dir() / f"{digest}.pickle"
+
+def _load_cached_model(cache_path: Path) -> BackupModel | None:
+    try:
+        with cache_path.open("rb") as f:
+            data = pickle.load(f)
+        return BackupModel(**data)
+    except Exception:
+        return None
+
+def _save_cached_model(cache_path: Path, model: BackupModel) -> None:
+    # クラス参照ではなく dict で保存（__main__ / import のどちらから読んでも復元できるように）
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_suffix(".tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(dict(vars(model)), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_path)
+    except Exception:
+        pass
+
+def load_backup_model(input_path: Path, log=None, use_cache: bool = False) -> BackupModel:
+    """入力（Zip/フォルダ）から BackupModel を作る．use_cache=True ならディスクキャッシュを使う．"""
+    input_path = Path(input_path)
+    cache_path = _model_cache_path(input_path) if use_cache else None
+    if cache_path is not None and cache_path.exists():
+        model = _load_cached_model(cache_path)
+        if model is not None:
+            if log is not None:
+                log_append(log, f"[CACHE] 解析結果を再利用: {cache_path.name}")
+            return model
+
+    if input_path.is_file() and input_path.suffix.lower() == ".zip":
+        model = BackupModel(source=str(input_path), is_zip=True)
+        with zipfile.ZipFile(str(input_path), "r") as zf:
             names = [n for n in zf.namelist() if not n.endswith("/")]
-            attach_roots = sorted({ n.split("attachments/")[0] + "attachments/"
-                                    for n in names if "attachments/" in n })
-            ent_candidates = [n for n in names if n.lower().endswith("entities.xml")]
-            entities_name = None
-            if attach_roots:
-                parent = "/".join(attach_roots[0].strip("/").split("/")[:-1])
-                for n in ent_candidates:
-                    if n.startswith(parent + "/"):
-                        entities_name = n; break
-            if not entities_name and ent_candidates:
-                entities_name = ent_candidates[0]
-            if not entities_name: return "UnknownSpace"
-            spaces, pages, *_ = parse_entities(zf.read(entities_name))
-            return _decide_space_key(spaces, pages)
+            model.attach_root, model.entities_name = _locate_in_zip_names(names)
+            if model.entities_name:
+                with zf.open(model.entities_name) as fp:
+                    ent = parse_entities_stream(fp)
+            else:
+                ent = None
+    else:
+        src_root = input_path if input_path.is_dir() else input_path.parent
+        model = BackupModel(source=str(input_path), is_zip=False)
+        attach_dir, ent_file = _locate_in_folder(src_root)
+        model.attach_root = str(attach_dir) if attach_dir is not None else ""
+        model.entities_name = str(ent_file) if ent_file is not None else ""
+        # 複数のエクスポートを置いたフォルダでは全 entities.xml を見つかった順にマージ（後勝ち）
+        ent = None
+        for f in _folder_entities_files(src_root):
+            part = parse_entities_stream(f)
+            if ent is None:
+                ent = part
+                continue
+            for k, v in part.items():
+                ent[k].update(v)
+
+    if ent is not None:
+        model.spaces, model.pages, model.bodies = ent["spaces"], ent["pages"], ent["bodies"]
+        model.att_title, model.att_to_page, model.att_filename = ent["att_title"], ent["att_to_page"], ent["att_filename"]
+        model.att_version = ent["att_version"]
+        if log is not None:
+            log_append(log, f"[INFO] entities.xml: {model.entities_name}  pages={len(model.pages)} "
+                            f"atts={len(model.att_title)} filenames={len(model.att_filename)}")
+        if cache_path is not None:
+            _save_cached_model(cache_path, model)
+    return model
+
+def _get_space_key_from_zip(zip_path: Path) -> str:
+    try:
+        return load_backup_model(zip_path).space_key
     except Exception:
         return "UnknownSpace"
 
 def _get_space_key_from_folder(root: Path) -> str:
     try:
-        candidates = sorted([p for p in root.rglob("attachments") if p.is_dir()],
-                            key=lambda p: len(str(p)))
-        ent_file = None
-        if candidates:
-            ent = candidates[0].parent / "entities.xml"
-            if ent.exists(): ent_file = ent
-        if not ent_file:
-            ents = list(root.rglob("entities.xml"))
-            if ents: ent_file = ents[0]
-        if not ent_file: return "UnknownSpace"
-        spaces, pages, *_ = parse_entities(ent_file.read_bytes())
-        return _decide_space_key(spaces, pages)
+        return load_backup_model(root).space_key
     except Exception:
         return "UnknownSpace"
 
-def _build_auto_out_root(input_path: Path, log: tk.Text) -> Path:
-    if input_path.is_file() and input_path.suffix.lower() == ".zip":
+def _build_auto_out_root(input_path: Path, log: tk.Text, model: BackupModel | None = None) -> Path:
+    if model is not None:
+        space_key = model.space_key; base_dir = input_path.parent
+    elif input_path.is_file() and input_path.suffix.lower() == ".zip":
         space_key = _get_space_key_from_zip(input_path); base_dir = input_path.parent
     else:
         space_key = _get_space_key_from_folder(input_path); base_dir = input_path.parent
@@ -321,6 +663,107 @@ def _build_auto_out_root(input_path: Path, log: tk.Text) -> Path:
     log_append(log, f"[OUT] 出力先（自動）: {out_root}")
     return out_root
 
+# ---------- 差分変換用マニフェスト ----------
+RUN_MANIFEST_NAME = "klefki_manifest.json"
+RUN_MANIFEST_VERSION = 2
+DEDUP_ATTACHMENTS = True               # 同じ内容の添付をハードリンクにまとめる
+DEDUP_REPORT_NAME = "dedup_report.json"
+
+@dataclass
+class RunManifest:
+    """
+    出力フォルダの klefki_manifest.json．前回の記録（previous）と今回の記録を持つ．
+    attachments: 添付エントリ（attachments 以下の相対パス）→ [署名, 出力フォルダからの相対パス or None]
+    pages: html_pages 以下の出力パス → ページ署名．template が変わったら全ページを描画し直す．
+    links: html_pages 以下の出力パス → [解決した ri:page リンク数, 未解決数]（維持したページの分も run_report に数える）．
+    versions: 添付の版の扱い（version_mode）．変わったら添付は全件展開し直す（連番の付き方が変わるため）．
+    """
+    path: Path
+    previous: dict = field(default_factory=dict)
+    template: str = ""
+    versions: str = ""
+    attachments: dict = field(default_factory=dict)
+    pages: dict = field(default_factory=dict)
+    links: dict = field(default_factory=dict)
+    stats: dict = field(default_factory=dict)
+
+    def save(self) -> None:
+        data = {"version": RUN_MANIFEST_VERSION, "template": self.template, "versions": self.versions,
+                "attachments": self.attachments, "pages": self.pages, "links": self.links}
+        tmp = self.path.with_suffix(".tmp")
+        # キーを並べて書く（並列展開の完了順に左右されず，同じ内容なら同じバイト列になる）
+        tmp.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":"), sort_keys=True), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+def load_run_manifest(out_root: Path, incremental: bool) -> RunManifest:
+    # incremental=False なら前回の記録は読まない（今回の記録だけ残して次回の差分変換に備える）
+    manifest = RunManifest(path=out_root / RUN_MANIFEST_NAME)
+    if incremental and manifest.path.exists():
+        try:
+            data = json.loads(manifest.path.read_text(encoding="utf-8"))
+            if data.get("version") == RUN_MANIFEST_VERSION:
+                manifest.previous = data
+        except Exception:
+            pass
+    return manifest
+
+def _attachment_signature(rel: Path, src, model: BackupModel, version_label: str | None = None) -> str:
+    # 中身（CRC/サイズ等）と出力先・出力名を決める情報が同じなら同じ署名
+    page_id, att_id = _entry_ids(rel)
+    meta = (src.signature(), model.att_title.get(att_id), model.att_filename.get(att_id) if att_id else None,
+            model.pages.get(page_id, {}).get("title") if page_id else None, version_label)
+    return hashlib.sha1(repr(meta).encode("utf-8")).hexdigest()
+
+_RI_FILENAME_RE = re.compile(r'ri:filename\s*=\s*"([^"]*)"', re.I)
+_RI_PAGE_RE = re.compile(r"<ri:page\b([^>]*)>", re.I)
+_RI_TITLE_RE = re.compile(r'ri:content-title\s*=\s*"([^"]*)"', re.I)
+_RI_SPACE_RE = re.compile(r'ri:space-key\s*=\s*"([^"]*)"', re.I)
+
+def _page_signature(entries: list[tuple], bodies: dict, attach_index: AttachmentIndex, out_root: Path,
+                    page_index: PageLinkIndex | None = None, history_pages=()) -> str:
+    # 同じ出力パスになるページ群の署名：チェイン・本文・履歴リンクの有無・参照する添付/ページの解決先（出力フォルダからの相対）
+    h = hashlib.sha1()
+    for pid, chain, page_dir, page_title in entries:
+        body = bodies.get(pid, "")
+        h.update(repr((chain, page_title, pid in history_pages)).encode("utf-8"))
+        h.update(body.encode("utf-8"))
+        for name in _RI_FILENAME_RE.findall(body):
+            cands = attach_index.lookup(html.unescape(name).strip(), pid)
+            h.update((os.path.relpath(cands[0], out_root) if cands else "").encode("utf-8"))
+        if page_index is not None:
+            for attrs in _RI_PAGE_RE.findall(body):
+                t, sk = _RI_TITLE_RE.search(attrs), _RI_SPACE_RE.search(attrs)
+                target = page_index.lookup(html.unescape(t.group(1)), html.unescape(sk.group(1)) if sk else "", pid) if t else None
+                h.update((os.path.relpath(target, out_root) if target else "").encode("utf-8"))
+    return h.hexdigest()
+
+def _render_template_key(html_root: Path, sidebar_manifest: Path | None, static_assets: dict | None,
+                         search_index: Path | None = None, history: bool = False) -> str:
+    # 描画結果を左右する全ページ共通の要素（本スクリプト自体・サイドバー方式・共通アセット・検索窓/履歴リンクの有無）
+    h = hashlib.sha1()
+    try:
+        h.update(Path(__file__).read_bytes())
+    except Exception:
+        h.update(APP_TITLE.encode("utf-8"))
+    h.update(repr((HTML_DIR_NAME, sidebar_manifest is not None, search_index is not None, history,
+                   sorted(p.name for p in (static_assets or {}).values()))).encode("utf-8"))
+    if sidebar_manifest is None:
+        # inline 方式は全ページが全リンクを含むので，サイドバーが変われば全ページ描画し直す
+        h.update(repr([(c, os.path.relpath(p, html_root)) for c, p in SIDEBAR_ITEMS]).encode("utf-8"))
+        h.update(repr(sorted(os.path.relpath(p, html_root) for p in SIDEBAR_EMPTY_PAGES)).encode("utf-8"))
+    return h.hexdigest()
+
+def _remove_output(path: Path, stop: Path) -> None:
+    # 不要になった出力を削除し，空になった親フォルダも stop の手前まで片付ける
+    _unlink_quiet(path)
+    d = path.parent
+    try:
+        while d != stop and stop in d.parents and not any(d.iterdir()):
+            d.rmdir()
+            d = d.parent
+    except Exception:
+        pass
+
 # 添付リンクの href を作る共通関数
 def _file_uri_raw(p: Path) -> str:
     # エンコード無しの file:/// 絶対URI（バックスラッシュ→スラッシュ）
@@ -520,284 +963,771 @@ def _ensure_header_logo(out_root: Path) -> Path | None:
 
 
 # ---------- 添付復元（出力は out_root/添付ファイル 内） ----------
-def write_output(rel_under_attachments: Path, data: bytes, attach_root: Path,
-                title_for_name: str | None,
-                preferred_ext_from_entities: str | None,
-                page_id: str | None, att_id: str | None,
-                spaces: dict, pages: dict,
-                dry_run: bool, log: tk.Text):
-
-    # ==== PageId 階層 → ページ名フォルダ ====
-    page_title = ""
-    if page_id and pages:
-        page_title = pages.get(page_id, {}).get("title", "") or ""
-    safe_title = sanitize(page_title) if page_title else "その他"
-
-    # すべて「添付ファイル/<ページ名>/」に集約
-    out_parent = attach_root / safe_title
-    # ===============================================
-
-    if not dry_run:
-        out_parent.mkdir(parents=True, exist_ok=True)
-
-    orig = sanitize(rel_under_attachments.name)
-    leaf_ext = Path(orig).suffix.lower()
-    stem, _ = os.path.splitext(orig)
-
-    # (A) 「.zipという拡張子のファイル」だけは除外
-    if leaf_ext == ".zip" or (preferred_ext_from_entities and preferred_ext_from_entities.lower().endswith(".zip")):
-        log_append(log, f"[SKIP] ZIPファイル除外: {rel_under_attachments}")
-        return
+MIME_SNIFF_BYTES = 64 * 1024      # MIME 判定に使う先頭バイト数（本体全体は読まない）
+COPY_CHUNK_BYTES = 1024 * 1024    # ストリームコピーのチャンクサイズ
 
-    mime0 = mime_from_bytes(data)
+LINK_MODES = ("copy", "hardlink", "reflink")   # フォルダ入力時の配置方法
+_FICLONE = 0x40049409                          # Linux: ioctl(dst, FICLONE, src) でリフリンク
 
-    # (B) OOXML 判定：中身がZIPでも Office なら通す
-    def _detect_ooxml_ext_from_zip_bytes(b: bytes) -> str | None:
+def _kernel_copy(src_fd: int, dst_fd: int, offset: int, count: int) -> bool:
+    # src_fd の offset から count バイトを dst_fd の現在位置へカーネル内でコピーする．
+    # 使えない環境（Windows 等）やエラー時は False を返し，dst は空のまま戻す．
+    copied = 0
+    try:
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < count:
+                    n = os.copy_file_range(src_fd, dst_fd, count - copied, offset + copied)
+                    if n == 0:
+                        break
+                    copied += n
+                if copied == count:
+                    return True
+            except OSError:
+                pass
+        if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+            while copied < count:
+                n = os.sendfile(dst_fd, src_fd, offset + copied, count - copied)
+                if n == 0:
+                    break
+                copied += n
+            if copied == count:
+                return True
+    except OSError:
+        pass
+    if copied:
+        os.ftruncate(dst_fd, 0)
+        os.lseek(dst_fd, 0, os.SEEK_SET)
+    return False
+
+class _ZipEntrySource:
+    # ZIP 内の添付エントリ（open() で展開しながら読むストリームを返す）
+    def __init__(self, zf: zipfile.ZipFile, name: str):
+        self.zf = zf
+        self.name = name
+
+    def open(self):
+        return self.zf.open(self.name, "r")
+
+    def signature(self) -> str:
+        info = self.zf.getinfo(self.name)
+        return f"{info.CRC:08x}:{info.file_size}"
+
+    def content_key(self) -> tuple:
+        # 重複候補の絞り込み用（中央ディレクトリの CRC とサイズ，最後の要素はバイト数）
+        info = self.zf.getinfo(self.name)
+        return ("crc", info.CRC, info.file_size)
+
+    def _data_offset(self, info: zipfile.ZipInfo) -> int:
+        # ローカルヘッダ（30バイト + ファイル名 + extra）の直後が本体
+        raw = os.pread(self.zf.fp.fileno(), 30, info.header_offset)
+        if len(raw) != 30 or raw[:4] != b"PK\x03\x04":
+            raise zipfile.BadZipFile("bad local file header")
+        name_len, extra_len = struct.unpack("<HH", raw[26:30])
+        return info.header_offset + 30 + name_len + extra_len
+
+    def _crc_matches(self, fd: int, offset: int, info: zipfile.ZipInfo) -> bool:
+        # コピーした範囲を pread で読み直して CRC を確かめる（直前にコピーした範囲なのでページキャッシュから読める）
+        crc, pos, end = 0, offset, offset + info.file_size
+        while pos < end:
+            chunk = os.pread(fd, min(COPY_CHUNK_BYTES, end - pos), pos)
+            if not chunk:
+                return False
+            crc = zlib.crc32(chunk, crc)
+            pos += len(chunk)
+        return crc == info.CRC
+
+    def _zero_copy(self, fw) -> bool:
+        # 無圧縮（STORED）かつ非暗号化なら，Zip 本体からカーネル内で直接コピーする．
+        # コピー後に CRC を確かめ，合わなければ出力を空に戻して False（通常のストリームコピーが BadZipFile を出す）
+        info = self.zf.getinfo(self.name)
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1 or not hasattr(os, "pread"):
+            return False
         try:
-            import io, zipfile
-            z = zipfile.ZipFile(io.BytesIO(b))
-            names = z.namelist()
-            # OOXMLの典型構造
-            has_ct = any(n.endswith("[Content_Types].xml") for n in names)
-            if not has_ct:
-                return None
-            # サブフォルダで判定
-            if any(n.startswith("word/") for n in names):
-                return ".docx"
-            if any(n.startswith("xl/") for n in names):
-                return ".xlsx"
-            if any(n.startswith("ppt/") for n in names):
-                return ".pptx"
-            # OOXMLの亜種はここに増やせる（.odt 等）
-            return None
+            fd = self.zf.fp.fileno()
+            offset = self._data_offset(info)
+            if not _kernel_copy(fd, fw.fileno(), offset, info.file_size):
+                return False
+            if self._crc_matches(fd, offset, info):
+                return True
         except Exception:
-            return None
+            pass
+        fw.truncate(0)
+        fw.seek(0)
+        return False
 
-    ooxml_hint = None
-    if mime0 == "application/zip":
-        ooxml_hint = _detect_ooxml_ext_from_zip_bytes(data)
-        # OOXMLと判断できない素のZIPだけ弾く
-        if ooxml_hint is None:
-            log_append(log, f"[SKIP] ZIP(MIME) 除外: {rel_under_attachments}")
-            return
+    def write_to(self, dst: Path, fp, head: bytes) -> None:
+        with open(dst, "wb") as fw:
+            if self._zero_copy(fw):
+                return
+            _copy_stream(fp, head, fw)
 
-    new_stem = strip_any_ext(sanitize(title_for_name or stem)) or "attachment"
+class _FileSource:
+    # フォルダ入力の添付ファイル（link_mode: copy / hardlink / reflink）
+    def __init__(self, path: Path, link_mode: str = "copy"):
+        self.path = Path(path)
+        self.link_mode = link_mode
 
-    # (C) 拡張子決定を強化（entities > 実ファイル拡張子 > MIME推定 > OOXML検知）
-    preferred_ext = os.path.splitext(preferred_ext_from_entities)[1].lower() if preferred_ext_from_entities else None
-    final_ext = ""
+    def open(self):
+        return open(self.path, "rb")
 
-    if preferred_ext:
-        if not new_stem.lower().endswith(preferred_ext):
-            final_ext = preferred_ext
-    elif leaf_ext and not new_stem.lower().endswith(leaf_ext):
-        final_ext = leaf_ext
-    else:
-        if mime0 and (mime0 in MIME_TO_EXT):
-            guessed = MIME_TO_EXT[mime0]
-            if not new_stem.lower().endswith(guessed):
-                final_ext = guessed
+    def signature(self) -> str:
+        st = self.path.stat()
+        return f"{st.st_size}:{st.st_mtime_ns}"
 
-    # OOXMLヒントが得られた場合は最優先で上書き
-    if ooxml_hint and not new_stem.lower().endswith(ooxml_hint):
-        final_ext = ooxml_hint
+    def content_key(self) -> tuple:
+        return ("size", self.path.stat().st_size)
 
-    final_name = new_stem + final_ext
-    dst = ensure_unique(out_parent / final_name)
+    def _reflink(self, dst: Path) -> bool:
+        try:
+            import fcntl
+        except ImportError:
+            return False
+        try:
+            with open(self.path, "rb") as fr, open(dst, "wb") as fw:
+                fcntl.ioctl(fw.fileno(), _FICLONE, fr.fileno())
+            return True
+        except OSError:
+            _unlink_quiet(dst)
+            return False
+
+    def write_to(self, dst: Path, fp, head: bytes) -> None:
+        if self.link_mode == "hardlink":
+            try:
+                os.link(self.path, dst)
+                return
+            except OSError:
+                pass  # 別ドライブ等はコピーにフォールバック
+        elif self.link_mode == "reflink":
+            if self._reflink(dst):
+                return
+        # shutil.copyfile は Linux/macOS ではカーネル側コピー（sendfile/fcopyfile）を使う
+        shutil.copyfile(self.path, dst)
+
+class _DedupEntry:
+    # 内容が同じかもしれない出力1件（digest は必要になった時だけ計算）
+    __slots__ = ("path", "digest", "ready")
+
+    def __init__(self, path: Path, digest: str | None = None):
+        self.path = path
+        self.digest = digest
+        self.ready = threading.Event()
+
+def _sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class _DedupStore:
+    """
+    添付の内容アドレス型ストア．同じ内容の添付は2件目以降を書き込まず，最初の出力へのハードリンクにする．
+    候補は source.content_key()（ZIP なら CRC+サイズ，フォルダならサイズ）で絞り込み，SHA-256 で確定する．
+    一意な内容の添付はハッシュ計算もせず従来どおり（ゼロコピー含む）書き込む．スレッドセーフ．
+    差分変換で維持した出力は seed() で先に登録し，今回の添付のリンク先にする（前回のリンクも報告に含める）．
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups: dict[tuple, list[_DedupEntry]] = {}
+        self._inodes: dict[tuple[int, int], _DedupEntry] = {}   # 維持した出力の (st_dev, st_ino) → 登録済みの出力
+        self.linked: dict[str, list[Path]] = {}   # digest → [リンクした出力]
+        self.originals: dict[str, Path] = {}      # digest → 実体の出力
+        self.sizes: dict[str, int] = {}
+        self.bytes_saved = 0
+
+    def seed(self, src, dst: Path) -> None:
+        # 差分変換で維持した（書き込まない）出力を登録する．前回リンクした出力は同じ inode なのでリンクとして数える
+        key = src.content_key()
+        try:
+            st = os.stat(dst)
+        except OSError:
+            return
+        with self._lock:
+            other = self._inodes.get((st.st_dev, st.st_ino))
+            if other is None:
+                entry = _DedupEntry(dst)
+                entry.ready.set()
+                self._groups.setdefault(key, []).append(entry)
+                self._inodes[(st.st_dev, st.st_ino)] = entry
+                return
+            if other.digest is None:
+                try:
+                    other.digest = _sha256_file(other.path)
+                except OSError:
+                    return
+            self.originals.setdefault(other.digest, other.path)
+            self.linked.setdefault(other.digest, []).append(dst)
+            self.sizes[other.digest] = key[-1]
+            self.bytes_saved += key[-1]
+
+    def write(self, src, dst: Path, fp, head: bytes) -> None:
+        key = src.content_key()
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                entry = _DedupEntry(dst)
+                self._groups[key] = [entry]
+        if group is None:
+            # この内容は初出：そのまま書き込む
+            try:
+                src.write_to(dst, fp, head)
+            finally:
+                entry.ready.set()
+            return
 
-    if dry_run:
-        log_append(log, f"[PLAN] {rel_under_attachments} -> {dst.relative_to(attach_root)}"); return
-
-    with open(dst, "wb") as fw:
-        fw.write(data)
-    log_append(log, f"[OK] {dst.relative_to(attach_root)}")
-
-# ---------- 再配置 ----------
-def _base_from_pathtxt(ptxt: Path) -> Path:
-    name = ptxt.name
-    if name.endswith(".path.txt"):
-        return ptxt.with_name(name[:-9])
-    return ptxt.with_suffix("")
-
-def rehome_by_page_title(base_root: Path, log: tk.Text, progress_cb=None):
-    path_files = list(base_root.rglob("*.path.txt"))
-    target = len(path_files)
-    moved = 0
-    num_count = 0
-    for ptxt in path_files:
-        num_count += 1
-        base = _base_from_pathtxt(ptxt)
-        if not base.exists():
-            expected = _base_from_pathtxt(ptxt).name
-            parent = ptxt.parent
-            found = None
-            for cand in parent.iterdir():
-                if cand.is_file() and cand.name.lower() == expected.lower():
-                    found = cand; break
-            if found is None:
-                log_append(log, f"[WARN] 本体が見つからないためスキップ: {ptxt} -> {expected}")
-                continue
-            base = found
+        # 同じキーの出力がある：中身の SHA-256 を比べる
+        h = hashlib.sha256(head)
+        for chunk in iter(lambda: fp.read(COPY_CHUNK_BYTES), b""):
+            h.update(chunk)
+        digest = h.hexdigest()
+        for other in list(group):
+            other.ready.wait()
+            if other.digest is None:
+                try:
+                    other.digest = _sha256_file(other.path)
+                except OSError:
+                    continue
+            if other.digest == digest:
+                try:
+                    os.link(other.path, dst)
+                except OSError:
+                    break  # リンク不可（別ドライブ等）は通常の書き込みへ
+                with self._lock:
+                    self.originals.setdefault(digest, other.path)
+                    self.linked.setdefault(digest, []).append(dst)
+                    self.sizes[digest] = key[-1]
+                    self.bytes_saved += key[-1]
+                return
 
-        page_title = ""
+        # 内容が違った（またはリンク不可）：読み直して通常どおり書き込む
+        entry = _DedupEntry(dst, digest)
+        with self._lock:
+            group.append(entry)
         try:
-            text = ptxt.read_text(encoding="utf-8", errors="ignore")
-            for line in text.splitlines():
-                if line.startswith("PageTitle:"):
-                    page_title = line.split(":", 1)[1].strip(); break
-        except Exception:
+            with src.open() as fp2:
+                src.write_to(dst, fp2, fp2.read(MIME_SNIFF_BYTES))
+        finally:
+            entry.ready.set()
+
+    def report(self, out_root: Path) -> dict:
+        groups = []
+        for digest, paths in self.linked.items():
+            groups.append({
+                "sha256": digest, "size": self.sizes[digest],
+                "original": self.originals[digest].relative_to(out_root).as_posix(),
+                "links": sorted(p.relative_to(out_root).as_posix() for p in paths),
+            })
+        groups.sort(key=lambda g: -g["size"] * len(g["links"]))
+        return {"files_linked": sum(len(g["links"]) for g in groups), "bytes_saved": self.bytes_saved,
+                "groups": groups}
+
+def _detect_ooxml_ext(zip_file) -> str | None:
+    # OOXML 判定：中身がZIPでも Office なら拡張子を返す（zip_file はパス/シーク可能なファイル）
+    try:
+        with zipfile.ZipFile(zip_file) as z:
+            names = z.namelist()
+        # OOXMLの典型構造
+        has_ct = any(n.endswith("[Content_Types].xml") for n in names)
+        if not has_ct:
+            return None
+        # サブフォルダで判定
+        if any(n.startswith("word/") for n in names):
+            return ".docx"
+        if any(n.startswith("xl/") for n in names):
+            return ".xlsx"
+        if any(n.startswith("ppt/") for n in names):
+            return ".pptx"
+        # OOXMLの亜種はここに増やせる（.odt 等）
+        return None
+    except Exception:
+        return None
+
+def _copy_stream(fp, head: bytes, fw) -> None:
+    # 先頭バイト（判定用に読んだ分）＋残りを固定サイズのチャンクで書き出す
+    fw.write(head)
+    shutil.copyfileobj(fp, fw, COPY_CHUNK_BYTES)
+
+@dataclass
+class _AttachmentPlan:
+    """添付1件の出力計画．entities.xml の情報だけで展開前に決まる最終フォルダと出力名．"""
+    rel: Path                   # attachments 以下の相対パス
+    key: object                 # 読み出しキー（make_source に渡す）
+    out_parent: Path            # 最終フォルダ（添付ファイル/<ページ名>/ など）
+    stem: str = ""              # 出力名（拡張子なし）
+    ext: str | None = None      # 確定した拡張子（"" は拡張子なし，None は中身の MIME から推定）
+    label: str | None = None    # 版ラベル（"v3" 等）
+    skip: bool = False          # 名前で除外が確定（.zip 添付）
+
+    @property
+    def path(self) -> Path | None:
+        # 拡張子まで確定していれば最終パス（同名の連番は展開時に付く）
+        return None if self.ext is None else self.out_parent / (self.stem + self.ext)
+
+def plan_attachments(items: list[tuple[Path, object]], model: BackupModel, attach_root: Path,
+                     history_root: Path | None = None, labels: dict | None = None) -> list[_AttachmentPlan]:
+    """
+    展開前に全添付の置き場所を決める（ページID → 添付ファイル/<ページ名>/，版ラベル付きは history_root 側）．
+    出力名・拡張子は entities > 元ファイル名で決め，どちらにも無いものだけ展開時に中身から推定する．
+    """
+    labels = labels or {}
+    folders: dict[str | None, str] = {}
+    plans = []
+    for rel, key in items:
+        page_id, att_id = _entry_ids(rel)
+        folder = folders.get(page_id)
+        if folder is None:
+            page_title = (model.pages.get(page_id, {}).get("title", "") or "") if page_id else ""
+            folder = folders[page_id] = sanitize(page_title) if page_title else "その他"
+        label = labels.get(rel.as_posix())
+        plan = _AttachmentPlan(rel, key, ((history_root if label else None) or attach_root) / folder, label=label)
+        plans.append(plan)
+
+        orig = sanitize(rel.name)
+        leaf_ext = Path(orig).suffix.lower()
+        preferred = model.att_filename.get(att_id) if att_id else None
+        # (A) 「.zipという拡張子のファイル」だけは除外
+        if leaf_ext == ".zip" or (preferred and preferred.lower().endswith(".zip")):
+            plan.skip = True
             continue
-        if not page_title: page_title = "Untitled Page"
 
-        dst_dir = base_root / sanitize(page_title)
-        dst_dir.mkdir(parents=True, exist_ok=True)
+        new_stem = strip_any_ext(sanitize(model.att_title.get(att_id) or os.path.splitext(orig)[0])) or "attachment"
+        if label:
+            new_stem = f"{new_stem} ({label})"
+        plan.stem = new_stem
+
+        # (C) 拡張子決定（entities > 実ファイル拡張子 > 展開時の MIME推定）
+        preferred_ext = os.path.splitext(preferred)[1].lower() if preferred else None
+        if preferred_ext:
+            plan.ext = "" if new_stem.lower().endswith(preferred_ext) else preferred_ext
+        elif leaf_ext and not new_stem.lower().endswith(leaf_ext):
+            plan.ext = leaf_ext
+    return plans
+
+def write_output(plan: _AttachmentPlan, src, dry_run: bool, log: tk.Text,
+                 allocator: _NameAllocator | None = None, seq: int | None = None,
+                 dedup: _DedupStore | None = None):
+    # src は _ZipEntrySource / _FileSource．本体はメモリに載せずストリームでコピーする
+    # 置き場所と名前は plan_attachments で決定済み（出力フォルダは呼び出し側で作成済み）
+    out_parent = plan.out_parent
+    base = out_parent.parent
+
+    if plan.skip:
+        log_append(log, f"[SKIP] ZIPファイル除外: {plan.rel}")
+        return
 
-        dst_file = ensure_unique(dst_dir / base.name)
-        dst_path = dst_file.with_suffix(dst_file.suffix + ".path.txt")
+    with src.open() as fp:
+        head = fp.read(MIME_SNIFF_BYTES)
+        mime0 = mime_from_bytes(head)
 
-        shutil.move(str(base), str(dst_file))
-        shutil.move(str(ptxt), str(dst_path))
-        moved += 1
-        log_append(log, f"[MOVE] {base}  ->  {dst_file.relative_to(base_root)}")
-        _step_progress(20, 40, num_count, target, progress_cb)
-        pump_gui(log)
+        # (B) OOXML 判定：中身がZIPでも Office なら通す
+        #     中央ディレクトリは末尾にあるため，一時ファイルへ流し込んでから判定する
+        ooxml_hint = None
+        spool = None
+        if mime0 == "application/zip":
+            if dry_run:
+                spool = tempfile.TemporaryFile()
+            else:
+                spool = tempfile.NamedTemporaryFile(dir=out_parent, prefix=".", suffix=".part", delete=False)
+            try:
+                _copy_stream(fp, head, spool)
+                spool.flush(); spool.seek(0)
+                ooxml_hint = _detect_ooxml_ext(spool)
+            finally:
+                spool.close()
+            # OOXMLと判断できない素のZIPだけ弾く
+            if ooxml_hint is None:
+                if not dry_run:
+                    _unlink_quiet(Path(spool.name))
+                log_append(log, f"[SKIP] ZIP(MIME) 除外: {plan.rel}")
+                return
 
-    removed = 0
-    dirs = sorted((p for p in base_root.rglob("*") if p.is_dir()), key=lambda p: -len(p.parts))
-    for d in dirs:
-        try:
-            if not any(d.iterdir()):
-                d.rmdir(); removed += 1
-                log_append(log, f"[RM] 空フォルダ削除: {d.relative_to(base_root)}")
-        except Exception:
-            pass
-        pump_gui(log)
+        new_stem = plan.stem
+        final_ext = plan.ext
+        if final_ext is None:
+            final_ext = ""
+            if mime0 and (mime0 in MIME_TO_EXT):
+                guessed = MIME_TO_EXT[mime0]
+                if not new_stem.lower().endswith(guessed):
+                    final_ext = guessed
+
+        # OOXMLヒントが得られた場合は最優先で上書き
+        if ooxml_hint and not new_stem.lower().endswith(ooxml_hint):
+            final_ext = ooxml_hint
+
+        final_name = new_stem + final_ext
+        dst = (allocator or _NameAllocator()).allocate(out_parent / final_name, seq)
+
+        if dry_run:
+            log_append(log, f"[PLAN] {plan.rel} -> {dst.relative_to(base)}"); return
+
+        if spool is not None:
+            os.replace(spool.name, dst)
+        elif dedup is not None:
+            dedup.write(src, dst, fp, head)
+        else:
+            src.write_to(dst, fp, head)
+    log_append(log, f"[OK] {dst.relative_to(base)}")
+    return dst
 
-    log_append(log, f"[REHOME] PageTitle再配置: {moved} files / 空フォルダ削除: {removed}\n")
+def _unlink_quiet(p: Path) -> None:
+    try:
+        p.unlink()
+    except Exception:
+        pass
 
 # ---------- 添付復元（ZIP/Folder） ----------
-def process_zip(zip_path: Path, attach_root: Path, dry_run: bool, log: tk.Text, progress_cb=None):
-    with zipfile.ZipFile(str(zip_path), "r") as zf:
-        names = [n for n in zf.namelist() if not n.endswith("/")]
-        attach_roots = sorted({ n.split("attachments/")[0] + "attachments/"
-                                for n in names if "attachments/" in n })
-        if not attach_roots:
-            log_append(log, "[WARN] 'attachments/' が見つかりません．"); return
-        attach_root_in_zip = min(attach_roots, key=len)
-
-        ent_candidates = [n for n in names if n.lower().endswith("entities.xml")]
-        entities_name = None
-        parent = "/".join(attach_root_in_zip.strip("/").split("/")[:-1])
-        for n in ent_candidates:
-            if n.startswith(parent + "/"):
-                entities_name = n; break
-        if not entities_name and ent_candidates:
-            entities_name = ent_candidates[0]
+DEFAULT_WORKERS = os.cpu_count() or 1
+PARALLEL_MIN_ATTACHMENTS = 32   # これ未満の添付数なら直列で展開
+
+def _resolve_workers(workers: int | None) -> int:
+    # None / 0 以下は CPU 数
+    if not workers or workers <= 0:
+        return DEFAULT_WORKERS
+    return int(workers)
+
+def _entry_ids(rel: Path) -> tuple[str | None, str | None]:
+    # attachments/<pageId>/<attId>/<version> → (pageId, attId)
+    parts = rel.parts
+    if len(parts) >= 2:
+        return parts[0], parts[1]
+    return None, None
+
+class AttachmentIndex:
+    """
+    添付の解決用インデックス（メモリ上だけで引き，ファイルシステムには触れない）．
+    展開時に実際に書き出した添付を (ページID, 正規化名) で登録し，参照元ページの添付を優先して返す．
+    名前は Confluence 上の添付名（ri:filename が指す名前）と出力ファイル名の両方で登録する．
+    """
+    _ALT_EXTS = {".jpg": [".jpeg"], ".jpeg": [".jpg"], ".png": [".jpg", ".jpeg"]}
+
+    def __init__(self):
+        self.by_page: dict[tuple[str | None, str], Path] = {}
+        self.by_name: dict[str, Path] = {}
+        self.by_page_stem: dict[tuple[str | None, str], list[Path]] = defaultdict(list)
+        self.by_stem: dict[str, list[Path]] = defaultdict(list)
+
+    def add(self, page_id: str | None, path: Path, *names: str | None) -> None:
+        # 同じ名前は先に登録した方（展開順で先の添付）を優先する
+        for name in dict.fromkeys(_normalize_filename(n) for n in (path.name, *names) if n):
+            self.by_page.setdefault((page_id, name), path)
+            self.by_name.setdefault(name, path)
+            stem = os.path.splitext(name)[0]
+            for bucket in (self.by_page_stem[(page_id, stem)], self.by_stem[stem]):
+                if path not in bucket:
+                    bucket.append(path)
+
+    def lookup(self, filename: str, page_id: str | None = None) -> list[Path]:
+        # ページ内 → 全体 の順に，完全一致 → 拡張子ゆらぎ → stem 一致 で候補を引く
+        name = _normalize_filename(filename)
+        base, ext = os.path.splitext(name)
+        keys = [name] + [base + alt for alt in self._ALT_EXTS.get(ext, [])]
+        scopes = ((lambda k: self.by_page.get((page_id, k)), lambda k: self.by_page_stem.get((page_id, k), [])),
+                  (self.by_name.get, lambda k: self.by_stem.get(k, [])))
+        for exact, stems in (scopes if page_id is not None else scopes[1:]):
+            for key in keys:
+                hit = exact(key)
+                if hit is not None:
+                    return [hit]
+            if stems(base):
+                return list(stems(base))
+        return []
+
+def build_attachment_index(out_root: Path, model: BackupModel | None = None) -> AttachmentIndex:
+    # 展開を伴わずに描画する時の索引：前回のマニフェストがあればそこから，無ければ 添付ファイル 配下を1回だけ走査する
+    index = AttachmentIndex()
+    try:
+        data = json.loads((out_root / RUN_MANIFEST_NAME).read_text(encoding="utf-8"))
+        records = data["attachments"] if data.get("version") == RUN_MANIFEST_VERSION else None
+    except Exception:
+        records = None
+    if records is not None:
+        for rk, (_sig, rel_out) in records.items():
+            if rel_out and Path(rel_out).parts[0] == ATT_DIR_NAME:
+                page_id, att_id = _entry_ids(Path(rk))
+                index.add(page_id, out_root / rel_out, model.att_title.get(att_id) if model else None)
+        return index
+    att_root = out_root / ATT_DIR_NAME
+    if att_root.exists():
+        for p in sorted(att_root.rglob("*")):
+            if p.is_file():
+                index.add(None, p)
+    return index
 
-        spaces = pages = att_title = att_to_page = att_filename = {}
-        if entities_name:
-            spaces, pages, att_title, att_to_page, att_filename = parse_entities(zf.read(entities_name))
-            log_append(log, f"[INFO] entities.xml: {entities_name}  pages={len(pages)} atts={len(att_title)} filenames={len(att_filename)}")
+def _split_attachment_versions(items: list[tuple[Path, object]], model: BackupModel) -> tuple[list, list]:
+    """
+    attachments/<pageId>/<attId>/<版> を現行版と旧版に分ける（元の順序を保つ）．
+    現行版は entities.xml の Attachment.version，無ければ最大の版番号．版構造でないエントリは現行扱い．
+    """
+    versions: dict[tuple, set[int]] = defaultdict(set)
+    for rel, _key in items:
+        parts = rel.parts
+        if len(parts) >= 3 and parts[-1].isdigit():
+            versions[parts[:-1]].add(int(parts[-1]))
+    latest = {}
+    for parent, vers in versions.items():
+        want = model.att_version.get(parent[-1])
+        latest[parent] = want if want in vers else max(vers)
+
+    current, history = [], []
+    for rel, key in items:
+        parts = rel.parts
+        if len(parts) >= 3 and parts[-1].isdigit() and int(parts[-1]) != latest[parts[:-1]]:
+            history.append((rel, key))
+        else:
+            current.append((rel, key))
+    return current, history
+
+def _extract_attachments(items: list[tuple[Path, object]], make_source, attach_root: Path,
+                         model: BackupModel, dry_run: bool, log, progress_cb, workers: int,
+                         manifest: RunManifest | None = None, dedup: _DedupStore | None = None,
+                         version_mode: str = ATTACHMENT_VERSION_MODE, index: AttachmentIndex | None = None,
+                         timer: StageTimer | None = None):
+    """
+    items: [(attachments 以下の相対パス, 読み出しキー)]．make_source(key) は添付ソースを返し，スレッドセーフであること．
+    workers > 1 ならスレッドプールで読み出し（zlib 展開）と書き込みを並行させる．
+    ログ出力と進捗更新は呼び出し元スレッドだけで行う．
+    manifest があれば前回から署名が変わらない添付は展開せずに残し，消えた添付の出力は削除する．
+    dedup があれば同じ内容の添付をハードリンクにまとめる（差分変換で維持した出力もリンク先として登録する）．
+    置き場所は plan_attachments で先に決め，最終フォルダへ直接書き込む（後からの移動はしない）．
+    index があれば 添付ファイル 配下に置いた添付（差分変換で維持したものを含む）を展開順に登録する．
+    version_mode: latest=現行版のみ / history=旧版は 添付ファイル履歴 へ「名前 (v版).拡張子」で / all=従来どおり全版
+    timer には attachments.select / plan / extract / index の所要時間と，書き出した添付のバイト数を記録する．
+    """
+    if version_mode not in ATTACHMENT_VERSION_MODES:
+        raise ValueError(f"version_mode は {ATTACHMENT_VERSION_MODES} のいずれか: {version_mode}")
+    timer = timer or StageTimer()
+    timer.mark()
+    allocator = _NameAllocator()
+    out_root = attach_root.parent
+    history_root = out_root / ATT_HISTORY_DIR_NAME
+
+    # 版の選別：旧版は展開しない（history なら別フォルダへ版番号付きで展開）
+    labels: dict[str, str] = {}
+    if version_mode != "all":
+        items, history = _split_attachment_versions(items, model)
+        if version_mode == "history":
+            labels = {rel.as_posix(): f"v{rel.parts[-1]}" for rel, _key in history}
+            items = items + history
+            log_append(log, f"[INFO] 添付の旧版 {len(history)} 件を {ATT_HISTORY_DIR_NAME} に展開します")
         else:
-            log_append(log, "[WARN] entities.xml が見つからないため，タイトル置換/元名出力は限定的になります．")
-
-        targets = len([n for n in names if n.startswith(attach_root_in_zip)])
-        num_count = 0
-        for n in [n for n in names if n.startswith(attach_root_in_zip)]:
-            num_count += 1
-            rel = Path(n[len(attach_root_in_zip):])
-            parts = rel.parts
-            page_id = parts[0] if len(parts) >= 2 else None
-            att_id  = parts[1] if len(parts) >= 2 else None
-
-            title_for_name = att_title.get(att_id, None)
-            preferred_ext_from_entities = att_filename.get(att_id, None) if att_id else None
-
-            data = zf.read(n)
-            write_output(rel, data, attach_root,
-                        title_for_name, preferred_ext_from_entities,
-                        page_id, att_id, spaces, pages, dry_run, log)
+            log_append(log, f"[INFO] 添付の旧版 {len(history)} 件をスキップ（現行版のみ展開）")
+    total = len(items)
+
+    def remove_old(rel_out: str) -> None:
+        path = out_root / rel_out
+        _remove_output(path, out_root / Path(rel_out).parts[0])
+
+    # 差分変換：変わった添付だけを展開対象にする（古い出力は先に消して名前を空ける）
+    sigs: list[str | None] = [None] * total
+    positions = list(range(total))           # 展開対象 → items 内の位置（索引の登録順を直列時と揃える）
+    placed: dict[int, tuple[Path, Path]] = {}
+    if manifest is not None:
+        prev = manifest.previous.get("attachments", {})
+        if manifest.previous.get("versions") != version_mode:
+            # 版の扱いが変わると同名添付の連番がずれるので，前回の添付は全部消して展開し直す
+            if prev and not dry_run:
+                for old in prev.values():
+                    if old[1]:
+                        remove_old(old[1])
+            prev = {}
+        manifest.versions = version_mode
+        todo, todo_sigs, todo_pos, seen = [], [], [], set()
+        kept = 0
+        for pos, (rel, key) in enumerate(items):
+            rk = rel.as_posix()
+            seen.add(rk)
+            sig = _attachment_signature(rel, make_source(key), model, labels.get(rk))
+            old = prev.get(rk)
+            if old and old[0] == sig and (old[1] is None or (out_root / old[1]).exists()):
+                manifest.attachments[rk] = old
+                if old[1]:
+                    placed[pos] = (rel, out_root / old[1])
+                    if dedup is not None and not dry_run:
+                        dedup.seed(make_source(key), out_root / old[1])
+                kept += 1
+                continue
+            if old and old[1] and not dry_run:
+                remove_old(old[1])
+            todo.append((rel, key)); todo_sigs.append(sig); todo_pos.append(pos)
+        removed = 0
+        for rk, old in prev.items():
+            if rk not in seen and old[1]:
+                removed += 1
+                if not dry_run:
+                    remove_old(old[1])
+        log_append(log, f"[INCR] 添付: 展開 {len(todo)} / 維持 {kept} / 削除 {removed}")
+        manifest.stats.update(attachments_extracted=len(todo), attachments_kept=kept, attachments_removed=removed)
+        items, sigs, positions = todo, todo_sigs, todo_pos
+    timer.lap("attachments.select")
+
+    # 出力計画：最終フォルダと名前を先に決め，フォルダはここで1回ずつ作る
+    plans = plan_attachments(items, model, attach_root, history_root, labels)
+    folders = {plan.out_parent for plan in plans if not plan.skip}
+    if not dry_run:
+        for folder in folders:
+            folder.mkdir(parents=True, exist_ok=True)
+    timer.lap("attachments.plan")
+
+    def record(seq: int, rel: Path, dst: Path | None) -> None:
+        if dst is not None:
+            placed[positions[seq]] = (rel, dst)
+            if not dry_run:
+                timer.count("attachment_bytes", make_source(plans[seq].key).content_key()[-1])
+        if manifest is not None and not dry_run:
+            manifest.attachments[rel.as_posix()] = [sigs[seq], dst.relative_to(out_root).as_posix() if dst else None]
+
+    def extract_one(seq: int, plan: _AttachmentPlan, sink) -> Path | None:
+        try:
+            return write_output(plan, make_source(plan.key), dry_run, sink,
+                                allocator=allocator, seq=seq, dedup=dedup)
+        finally:
+            allocator.release(seq)
+
+    def finish() -> int:
+        # 中身で除外（素のZIP）された添付だけのフォルダは空のまま残るので消す
+        if not dry_run:
+            for folder in folders:
+                try:
+                    folder.rmdir()
+                except OSError:
+                    pass
+        timer.lap("attachments.extract")
+        if index is not None:
+            for pos in sorted(placed):
+                rel, dst = placed[pos]
+                if dst.is_relative_to(attach_root):
+                    page_id, att_id = _entry_ids(rel)
+                    index.add(page_id, dst, model.att_title.get(att_id))
+        timer.lap("attachments.index")
+        return total
+
+    count = len(plans)
+    if workers <= 1 or count < PARALLEL_MIN_ATTACHMENTS:
+        for i, plan in enumerate(plans, start=1):
+            record(i - 1, plan.rel, extract_one(i - 1, plan, log))
             pump_gui(log)
-            _step_progress(0, 20, num_count, targets, progress_cb)
+            _step_progress(0, 40, i, count, progress_cb)
+        return finish()
 
-        log_append(log, "[SUMMARY] 添付復元完了（ZIP）\n")
+    from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def process_folder(src_root: Path, attach_root: Path, dry_run: bool, log: tk.Text, progress_cb=None):
-    candidates = sorted([p for p in src_root.rglob("attachments") if p.is_dir()],
-                        key=lambda p: len(str(p)))
-    if not candidates:
-        log_append(log, "[WARN] 'attachments' が見つかりません．"); return
-    attach_root_on_disk = candidates[0]
+    def job(seq, plan) -> tuple[list[str], Path | None]:
+        lines: list[str] = []
+        dst = extract_one(seq, plan, lines.append)
+        return lines, dst
 
-    ent_file = next((p for p in [attach_root_on_disk.parent / "entities.xml"] if p.exists()), None)
-    if not ent_file:
-        ents = list(src_root.rglob("entities.xml"))
-        ent_file = ents[0] if ents else None
+    log_append(log, f"[INFO] 添付展開を {workers} スレッドで並列実行します")
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = {ex.submit(job, i, plan): (i, plan.rel) for i, plan in enumerate(plans)}
+        try:
+            for fut in as_completed(futures):
+                lines, dst = fut.result()
+                for line in lines:
+                    log_append(log, line)
+                record(*futures[fut], dst)
+                done += 1
+                pump_gui(log)
+                _step_progress(0, 40, done, count, progress_cb)
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+    return finish()
+
+def process_zip(zip_path: Path, attach_root: Path, dry_run: bool, log: tk.Text, progress_cb=None,
+                model: BackupModel | None = None, extract_workers: int = 1, manifest: RunManifest | None = None,
+                dedup: _DedupStore | None = None, version_mode: str = ATTACHMENT_VERSION_MODE,
+                index: AttachmentIndex | None = None, timer: StageTimer | None = None):
+    if model is None:
+        model = load_backup_model(zip_path, log)
+    attach_root_in_zip = model.attach_root
+    if not attach_root_in_zip:
+        log_append(log, "[WARN] 'attachments/' が見つかりません．"); return 0
+    if not model.entities_name:
+        log_append(log, "[WARN] entities.xml が見つからないため，タイトル置換/元名出力は限定的になります．")
+
+    # ZipFile はスレッド間で共有せず，ワーカースレッドごとにハンドルを持たせる
+    local = threading.local()
+    handles: list[zipfile.ZipFile] = []
+    handles_lock = threading.Lock()
+
+    def member_source(name: str) -> _ZipEntrySource:
+        zf = getattr(local, "zf", None)
+        if zf is None:
+            zf = local.zf = zipfile.ZipFile(str(zip_path), "r")
+            with handles_lock:
+                handles.append(zf)
+        return _ZipEntrySource(zf, name)
 
-    spaces = pages = att_title = att_to_page = att_filename = {}
-    if ent_file:
-        spaces, pages, att_title, att_to_page, att_filename = parse_entities(ent_file.read_bytes())
-        log_append(log, f"[INFO] entities.xml: {ent_file}  pages={len(pages)} atts={len(att_title)} filenames={len(att_filename)}")
-    else:
+    try:
+        with zipfile.ZipFile(str(zip_path), "r") as zf:
+            names = [n for n in zf.namelist() if not n.endswith("/")]
+        items = [(Path(n[len(attach_root_in_zip):]), n) for n in names if n.startswith(attach_root_in_zip)]
+        if model.attach_pages is not None:
+            # スペース別のモデルは自分のページの添付だけを読む
+            items = [(rel, n) for rel, n in items if _entry_ids(rel)[0] in model.attach_pages]
+        count = _extract_attachments(items, member_source, attach_root, model, dry_run, log, progress_cb,
+                                     _resolve_workers(extract_workers), manifest=manifest, dedup=dedup,
+                                     version_mode=version_mode, index=index, timer=timer)
+    finally:
+        for zf in handles:
+            zf.close()
+
+    log_append(log, "[SUMMARY] 添付復元完了（ZIP）\n")
+    return count
+
+def process_folder(src_root: Path, attach_root: Path, dry_run: bool, log: tk.Text, progress_cb=None,
+                   model: BackupModel | None = None, extract_workers: int = 1, link_mode: str = "copy",
+                   manifest: RunManifest | None = None, dedup: _DedupStore | None = None,
+                   version_mode: str = ATTACHMENT_VERSION_MODE, index: AttachmentIndex | None = None,
+                   timer: StageTimer | None = None):
+    if model is None:
+        model = load_backup_model(src_root, log)
+    if not model.attach_root:
+        log_append(log, "[WARN] 'attachments' が見つかりません．"); return 0
+    attach_root_on_disk = Path(model.attach_root)
+    if not model.entities_name:
         log_append(log, "[WARN] entities.xml が見つからないため，タイトル置換/元名出力ではなくIDで出力します．")
 
-    total_entries = len([p for p in attach_root_on_disk.rglob("*") if p.is_file()])
-    num_count = 0
-    for f in [p for p in attach_root_on_disk.rglob("*") if p.is_file()]:
-        num_count += 1
-        rel = f.relative_to(attach_root_on_disk)
-        parts = rel.parts
-        page_id = parts[0] if len(parts) >= 2 else None
-        att_id  = parts[1] if len(parts) >= 2 else None
-
-        title_for_name = att_title.get(att_id, None)
-        preferred_ext_from_entities = att_filename.get(att_id, None) if att_id else None
-
-        data = f.read_bytes()
-        write_output(rel, data, attach_root,
-                    title_for_name, preferred_ext_from_entities,
-                    page_id, att_id, spaces, pages, dry_run, log)
-        pump_gui(log)
-        _step_progress(0, 20, num_count, total_entries, progress_cb)
+    if model.attach_pages is None:
+        items = [(f.relative_to(attach_root_on_disk), f) for f in attach_root_on_disk.rglob("*") if f.is_file()]
+    else:
+        # スペース別のモデルは自分のページのフォルダだけを走査する（直下のファイルは ID 不明の分）
+        items = [(f.relative_to(attach_root_on_disk), f)
+                 for pid in sorted(p for p in model.attach_pages if p)
+                 for f in (attach_root_on_disk / pid).rglob("*") if f.is_file()]
+        if None in model.attach_pages:
+            items += [(f.relative_to(attach_root_on_disk), f) for f in attach_root_on_disk.iterdir() if f.is_file()]
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"link_mode は {LINK_MODES} のいずれか: {link_mode}")
+    count = _extract_attachments(items, lambda p: _FileSource(p, link_mode), attach_root, model, dry_run, log,
+                                 progress_cb, _resolve_workers(extract_workers), manifest=manifest, dedup=dedup,
+                                 version_mode=version_mode, index=index, timer=timer)
 
     log_append(log, "[SUMMARY] 添付復元完了（Folder）\n")
+    return count
+
+def _quote_href_path(rel_posix: str) -> str:
+    parts = rel_posix.split("/")
+    return "/".join(urllib.parse.quote(p, safe="!$&'()*+,;=:@[]-%._") for p in parts if p)
 
 @lru_cache(maxsize=8192)
 def _rel_href_from_cached(from_dir_str: str, target_str: str) -> str:
     rel = os.path.relpath(target_str, start=from_dir_str)
     rel_posix = rel.replace("\\", "/")
-    parts = rel_posix.split("/")
-    return "/".join(urllib.parse.quote(p, safe="!$&'()*+,;=:@[]-%._") for p in parts if p)
+    return _quote_href_path(rel_posix)
 
 def _rel_href_from(from_dir: Path, target: Path) -> str:
     return _rel_href_from_cached(str(from_dir), str(target))
 
-# ----------------------------------------------------------------------------------
-# チェックボックス／添付リンク／ページ内リンク
-# ----------------------------------------------------------------------------------
-def confluence_storage_to_html(storage_html: str, page_titles_chain: list[str],
-                                html_root: Path, out_root: Path,
-                                *, attach_index: dict | None = None,
-                                resolved_icons: dict | None = None) -> str:
-    parser = "lxml"
-    try:
-        soup = BeautifulSoup(storage_html or "", parser)
-        
-        # --- BackToTop の CSS/JS を <head> に一度だけ注入 ---
-        head = soup.find("head")
-        if not head:
-            # まれに <head> が無い HTML もあるので生成しておく
-            html_tag = soup.find("html") or soup
-            head = soup.new_tag("head")
-            if html_tag.contents:
-                html_tag.insert(0, head)
-            else:
-                html_tag.append(head)
+# ページ共通の CSS/JS
+# inline 方式では各ページへ埋め込み，static 方式では html_pages/_static/app.<hash>.css/js に1回だけ書き出して参照する
+ASSET_MODE = "static"
+STATIC_DIR_NAME = "_static"
 
-        # CSS
-        if not head.find(id="backToTop-style"):
-            style_tag = soup.new_tag("style", id="backToTop-style")
-            style_tag.string = """
+_BACK_TO_TOP_CSS = """
                 #backToTop{
                 position:fixed; right:24px; bottom:-140px; width:80px; height:80px;
                 padding:6px; border-radius:12px; background:#ffffffcc; box-shadow:0 6px 18px rgba(0,0,0,.22);
@@ -808,12 +1738,8 @@ def confluence_storage_to_html(storage_html: str, page_titles_chain: list[str],
                 #backToTop img{ width:100%; height:100%; object-fit:contain; display:block; }
                 #scrollSentinel{ position:relative; width:100%; height:1px; }
                 """
-            head.append(style_tag)
 
-        # JS
-        if not head.find(id="backToTop-script"):
-            script_tag = soup.new_tag("script", id="backToTop-script")
-            script_tag.string = r"""
+_BACK_TO_TOP_JS = r"""
                 (function(){
                 // DOMReady ラッパ
                 function ready(fn){
@@ -891,103 +1817,894 @@ def confluence_storage_to_html(storage_html: str, page_titles_chain: list[str],
                 });
                 })();
                 """
-            head.append(script_tag)
-        # --- /BackToTop ヘッダ注入 ここまで ---
 
-        
-    except Exception:
-        soup = BeautifulSoup(storage_html or "", "html.parser")
-    title = page_titles_chain[-1] if page_titles_chain else "その他"
-    
-    # --- ユーティリティ ---
-    def _page_title() -> str:
-        return page_titles_chain[-1] if page_titles_chain else "その他"
+_PAGE_SCRIPT_JS = """\
+    (function () {
+        const lb  = document.getElementById("lightbox");
+        const img = lb ? lb.querySelector("img") : null;
 
-    def _attach_folder_for_page() -> Path:
-        return out_root / "添付ファイル" / _page_title()
+        function openLightbox(src, alt) {
+            if (!lb || !img) return;
+            img.src = src;
+            img.alt = alt || "";
+            lb.classList.add("open");
+        }
 
-    def _html_dir_for_page() -> Path:
-        # このページ（page_titles_chain）の HTML が出力されるディレクトリを返す
-        chain = page_titles_chain or ["その他"]
-        if len(chain) == 1:
-            return html_root / "その他"
-        d = html_root
-        for t in chain[:-1]:
-            d = d / sanitize(t)
-        return d
+        function closeLightbox() {
+            if (!lb) return;
+            lb.classList.remove("open");
+        }
 
-    def _candidate_attach_paths(filename: str, attach_dir: Path) -> list[Path]:
-        name_lower = (filename or "").strip().lower()
-        base, ext = os.path.splitext(name_lower)
-        if attach_index:
-            cands: list[Path] = []
-            # 1) 完全一致（大小無視）
-            hit = attach_index["by_lower"].get(name_lower)
-            if hit:
-                cands.append(hit)
-            # 2) 拡張子ゆらぎ
-            if not cands:
-                alt_map = {".jpg": [".jpeg"], ".jpeg": [".jpg"], ".png": [".jpg", ".jpeg"]}
-                for alt in alt_map.get(ext, []):
-                    altname = base + alt
-                    hit2 = attach_index["by_lower"].get(altname)
-                    if hit2:
-                        cands.append(hit2)
-                        break
-            # 3) stem 一致
-            if not cands:
-                cands.extend(attach_index["by_stem"].get(base, []))
-            return cands
-
-        # フォールバック（従来の全探索．なるべく通らないようにする）
-        candidates = []
-        for a in attach_dir.glob("**/*"):
-            if a.name.lower() == name_lower:
-                candidates.append(a)
-        if not candidates:
-            alt_exts = {".jpg": [".jpeg"], ".jpeg": [".jpg"], ".png": [".jpg", ".jpeg"]}.get(ext, [])
-            for alt in alt_exts:
-                alt_name = base + alt
-                for a in attach_dir.glob("**/*"):
-                    if a.name.lower() == alt_name:
-                        candidates.append(a)
-        if not candidates:
-            for a in attach_dir.glob("**/*"):
-                if a.name.lower().startswith(base):
-                    candidates.append(a)
-        return candidates
+        // 画像クリックでライトボックス表示
+        if (lb && img) {
+            document.addEventListener("click", function (ev) {
+                // a.zoom を起点にライトボックスを開く
+                const a = ev.target.closest("a.zoom");
+                if (a) {
+                    ev.preventDefault();
+                    openLightbox(
+                        a.getAttribute("href"),
+                        a.getAttribute("aria-label") || ""
+                    );
+                    return;
+                }
 
-    def _href_to_attachment(filename: str) -> tuple[str, str]:
-        # 添付の href と label を返す（相対パス版）．
-        # 見つからない時はログして，最後の希望として “とりあえず期待パス” を返す
-        attach_dir = _get_attach_dir(out_root)
-        page_dir = _html_dir_for_page()  # ← このページのHTMLが出力されるフォルダ
+                // オーバーレイやクローズボタンをクリックした場合は閉じる
+                const t = ev.target;
+                if (t.id === "lightbox" || t.classList.contains("lightbox__close")) {
+                    closeLightbox();
+                }
+            });
 
-        # 候補検索
-        cands = _candidate_attach_paths(filename, attach_dir)
-        if cands:
-            target = cands[0]
+            document.addEventListener("keyup", function (ev) {
+                if (ev.key === "Escape") {
+                    closeLightbox();
+                }
+            });
+        }
+
+        // --- サイドバーの幅変更 -------------------------------
+        (function initSidebarResize() {
+            const sidebar = document.querySelector(".sidebar");
+            const resizer = document.getElementById("sidebar-resizer");
+            if (!sidebar || !resizer) return;
+
+            let dragging = false;
+            let startX   = 0;
+            let startW   = 0;
+
+            resizer.addEventListener("mousedown", function (ev) {
+                dragging = true;
+                startX   = ev.clientX;
+                startW   = sidebar.getBoundingClientRect().width;
+                document.body.classList.add("resizing-sidebar");
+                ev.preventDefault();
+            });
+
+            document.addEventListener("mousemove", function (ev) {
+                if (!dragging) return;
+                const dx = ev.clientX - startX;
+                let newW = startW + dx;
+
+                // 最小 / 最大幅の制限
+                if (newW < 180) newW = 180;
+                if (newW > 520) newW = 520;
+
+                sidebar.style.width = newW + "px";
+            });
+
+            document.addEventListener("mouseup", function () {
+                if (!dragging) return;
+                dragging = false;
+                document.body.classList.remove("resizing-sidebar");
+            });
+        })();
+
+        // --- 言語案内モーダル -------------------------------
+        (function initLangHelp() {
+            const select  = document.getElementById("lang-select");
+            const overlay = document.getElementById("lang-help-overlay");
+            if (!select || !overlay) return;
+
+            const modals = overlay.querySelectorAll(".lang-help-modal");
+
+            function showModal(lang) {
+                overlay.classList.add("is-open");
+                overlay.setAttribute("aria-hidden", "false");
+
+                modals.forEach(function (m) {
+                    if (m.getAttribute("data-lang") === lang) {
+                        m.style.display = "block";
+                    } else {
+                        m.style.display = "none";
+                    }
+                });
+
+                // ブラウザ翻訳の検知用に lang 属性も合わせておく
+                document.documentElement.lang = lang;
+            }
+
+            function hideModal() {
+                overlay.classList.remove("is-open");
+                overlay.setAttribute("aria-hidden", "true");
+            }
+
+            // プルダウン変更時にモーダル表示
+            select.addEventListener("change", function () {
+                const v = select.value || "ja";
+                showModal(v);
+            });
+
+            // 背景クリック or × ボタンで閉じる
+            overlay.addEventListener("click", function (ev) {
+                if (ev.target === overlay || ev.target.hasAttribute("data-lang-help-close")) {
+                    hideModal();
+                }
+            });
+
+            // Esc キーでも閉じる
+            document.addEventListener("keyup", function (ev) {
+                if (ev.key === "Escape") {
+                    hideModal();
+                }
+            });            
+        })();
+
+        // --- 現在ページの位置までサイドバーを自動スクロール ----------------
+        (function scrollSidebarToCurrent() {
+            const sidebar = document.querySelector(".sidebar");
+            if (!sidebar) return;
+            const current = sidebar.querySelector(".sidebar-link-current");
+            if (!current) return;
+
+            const sidebarRect = sidebar.getBoundingClientRect();
+            const currentRect = current.getBoundingClientRect();
+            const offsetTop   = currentRect.top - sidebarRect.top;
+            const targetScroll =
+                offsetTop - (sidebar.clientHeight / 2) + (current.offsetHeight / 2);
+
+            sidebar.scrollTop = targetScroll;
+        })();
+
+    })();
+"""
+
+_PAGE_CSS = """\
+        /* 右上の言語選択バー */
+        .topbar {
+        position: fixed;
+        top: 0;
+        right: 0;
+        padding: 8px 16px;
+        font-size: 12px;
+        z-index: 2100;
+        background: rgba(255, 255, 255, 0.9);
+        border-bottom-left-radius: 8px;
+        box-shadow: 0 2px 6px rgba(0,0,0,0.15);
+        }
+        .topbar label {
+        margin-right: 4px;
+        }
+        .lang-select {
+        padding: 2px 4px;
+        font-size: 12px;
+        }
+
+        /* 言語案内モーダル */
+        .lang-help-overlay {
+        position: fixed;
+        inset: 0;
+        background: rgba(0,0,0,0.45);
+        display: none;
+        align-items: center;
+        justify-content: center;
+        z-index: 2200;
+        }
+        .lang-help-overlay.is-open {
+        display: flex;
+        }
+        .lang-help-modal {
+        position: relative;
+        background: #ffffff;
+        max-width: 520px;
+        width: 90%;
+        padding: 1.25rem 1.5rem;
+        border-radius: 0.75rem;
+        box-shadow: 0 18px 45px rgba(0,0,0,0.35);
+        font-size: 14px;
+        line-height: 1.5;
+        }
+        .lang-help-modal h2 {
+        margin-top: 0;
+        margin-bottom: 0.5rem;
+        font-size: 16px;
+        }
+        .lang-help-modal p {
+        margin: 0.4rem 0;
+        }
+        .lang-help-modal ol {
+        margin: 0.4rem 0 0.2rem;
+        padding-left: 1.4rem;
+        }
+        .lang-help-close {
+        position: absolute;
+        top: 0.35rem;
+        right: 0.5rem;
+        border: none;
+        background: transparent;
+        font-size: 18px;
+        cursor: pointer;
+        }
+
+        .layout {
+        display: flex;
+        min-height: 100vh;
+        }
+
+        /* サイドバー */
+        .sidebar {
+        width: 260px;
+        box-sizing: border-box;
+        padding: 16px 12px;
+        background: rgba(255, 255, 255, 0.92);
+        border-right: 1px solid #e5e7eb;
+        overflow-y: auto;
+        position: sticky;
+        top: 0;
+        max-height: 100vh;
+        }
+        .sidebar-resizer {
+        width: 5px;
+        cursor: col-resize;
+        background: transparent;
+        }
+        .sidebar-resizer:hover {
+        background: rgba(148, 163, 184, 0.4);
+        }
+        body.resizing-sidebar {
+        cursor: col-resize;
+        user-select: none;
+        }
+        .sidebar-title {
+        display: flex;
+        align-items: center;
+        gap: 6px;
+        font-size: 18px;
+        font-weight: 600;
+        margin-bottom: 8px;
+        }
+        .sidebar-title-icon {
+        width: 20px;
+        height: 20px;
+        flex-shrink: 0;
+        }
+        .sidebar-empty-icon {
+        width: 24px;
+        height: 24px;
+        margin-right: 4px;
+        vertical-align: text-bottom;
+        }
+        .sidebar-links a {
+        display: block;
+        font-size: 14px;
+        padding: 4px 2px;
+        color: #2563eb;
+        text-decoration: none;
+        border-radius: 4px;
+        }
+        .sidebar-links a:hover {
+        background: #e5f0ff;
+        }
+        .sidebar-links a.sidebar-link-current {
+        background: rgba(248, 113, 113, 0.25);  /* 薄い赤背景 */
+        color: #b91c1c;                          /* 文字も少し濃い赤に */
+        font-weight: 600;
+        }
+
+        /*Topリンクとセクション区切り */
+        .sidebar-toplink {
+        margin-bottom: 12px;
+        padding-bottom: 8px;
+        border-bottom: 1px solid #e5e7eb;
+        }
+        .sidebar-toplink a {
+        font-weight: 600;
+        color: #111827;
+        text-decoration: none;
+        }
+        .sidebar-toplink a:hover {
+        text-decoration: underline;
+        }
+        .sidebar-section {
+        margin-bottom: 16px;
+        padding-bottom: 8px;
+        border-bottom: 1px solid #e5e7eb;
+        }
+        .sidebar-section-title {
+        display: flex;
+        align-items: center;
+        gap: 6px;
+        font-size: 13px;
+        font-weight: 700;
+        color: #6b7280;
+        margin-bottom: 4px;
+        }
+        .sidebar-section-icon {
+        width: 16px;
+        height: 16px;
+        flex-shrink: 0;
+        }
+        .sidebar-section a {
+        display: block;
+        font-size: 13px;
+        padding: 2px 2px;
+        color: #2563eb;
+        text-decoration: none;
+        border-radius: 3px;
+        }
+        .sidebar-section a:hover {
+        background: #e5f0ff;
+        }
+
+        /*ページタイトル用 */
+        .page-header {
+        margin-bottom: 1.5rem;
+        border-bottom: 1px solid #e5e7eb;
+        padding-bottom: .75rem;
+        }
+        .page-title {
+        margin: 0;
+        font-size: 1.6rem;
+        font-weight: 700;
+        }
+
+        /* 本文側 */
+        .page-container {
+        flex: 1;
+        display: flex;
+        justify-content: center;
+        box-sizing: border-box;
+        padding: 24px;
+        }
+        .content-box {
+        background: #ffffff;
+        max-width: 960px;
+        width: 100%;
+        box-shadow: 0 10px 30px rgba(15,23,42,0.15);
+        border-radius: 8px;
+        padding: 32px 40px 40px;
+        box-sizing: border-box;
+        }
+        .content-box h1,
+        .content-box h2,
+        .content-box h3 {
+        margin-top: 1.6em;
+        }
+        .content-box p {
+        line-height: 1.8;
+        margin: 0.5em 0;
+        }
+        .content-box ul,
+        .content-box ol {
+        padding-left: 1.6em;
+        }
+
+        /* テーブル（Confluence の表） */
+        .content-box table,
+        .content-box table.confluenceTable {
+        border-collapse: collapse;
+        border-spacing: 0;
+        width: 100%;
+        margin: 0.75rem 0;
+        font-size: 14px;
+        }
+
+        .content-box th,
+        .content-box td,
+        .content-box table.confluenceTable th,
+        .content-box table.confluenceTable td {
+        border: 1px solid #e5e7eb;
+        padding: 4px 8px;
+        vertical-align: top;
+        }
+
+        .content-box thead th,
+        .content-box table.confluenceTable thead th {
+        background: #f9fafb;
+        font-weight: 600;
+        }
+
+        .footer {
+        margin-top: 2rem;
+        font-size: 13px;
+        color: #4b5563;
+        border-top: 1px solid #e5e7eb;
+        padding-top: 0.75rem;
+        }
+
+        .confluence-image img {
+        max-width: 100%;
+        height: auto;
+        }
+
+        /* 画像クリック時のライトボックス */
+        #lightbox {
+            position: fixed;
+            inset: 0;
+            background: rgba(0,0,0,0.75);
+            display: none;
+            align-items: center;
+            justify-content: center;
+            z-index: 3000;
+        }
+
+        /* open クラスが付与されたときだけ表示 */
+        #lightbox.open {
+            display: flex;
+        }
+
+        /* 画像の最大サイズを画面内に収める（重要） */
+        #lightbox img {
+            max-width: 90vw;
+            max-height: 90vh;
+            object-fit: contain;
+            border-radius: 8px;
+            box-shadow: 0 0 20px rgba(0,0,0,0.4);
+        }
+        
+        /* 動画/音声のサイズ調整 */
+        .content-box video,
+        .content-box audio {
+            max-width: 100%;
+            height: auto;
+            display: block;
+            margin: .5rem 0;
+        }
+        
+        /* === ページ最下部 トップに戻る === */
+        #backToTop{
+            position: fixed;
+            right: max(16px, env(safe-area-inset-right));
+            bottom: max(16px, env(safe-area-inset-bottom));
+            width: 88px;        /* 画像サイズに合わせて調整 */
+            height: 88px;
+            z-index: 10030;     /* ヘッダやモーダルより手前/奥は環境に合わせ微調整 */
+            transform: translateY(140%);
+            opacity: 0;
+            transition: transform .35s ease, opacity .35s ease;
+            cursor: pointer;
+            user-select: none;
+            -webkit-tap-highlight-color: transparent;
+            }
+        #backToTop.show{
+            transform: translateY(0);
+            opacity: 1;
+            }
+        #backToTop img{
+            display:block;
+            width:100%;
+            height:auto;
+            filter: drop-shadow(0 2px 4px rgba(0,0,0,.35));
+            }
+        #backToTop:focus-visible{
+            outline: 3px solid #3b82f6; /* アクセシビリティ */
+            border-radius: 10px;
+            }
+        /* ページ末尾監視用のダミー要素（高さ0でOK） */
+            #scrollSentinel{ width:1px; height:1px; }
+
+
+"""
+
+def _write_static_assets(html_root: Path) -> dict:
+    """
+    ページ共通の CSS/JS を html_root/_static/app.<hash>.css / app.<hash>.js に書き出す．
+    ファイル名に内容のハッシュを含めるので，ブラウザは安心してキャッシュできる．
+    """
+    static_dir = html_root / STATIC_DIR_NAME
+    static_dir.mkdir(parents=True, exist_ok=True)
+    # 後から読み込まれていた BackToTop 用 CSS がページ共通 CSS を上書きする順序を維持
+    contents = {"css": _PAGE_CSS + _SEARCH_CSS + _BACK_TO_TOP_CSS, "js": _BACK_TO_TOP_JS + _PAGE_SCRIPT_JS + _SEARCH_JS}
+    assets = {}
+    for kind, text in contents.items():
+        data = text.encode("utf-8")
+        name = f"app.{hashlib.sha1(data).hexdigest()[:10]}.{kind}"
+        path = static_dir / name
+        if not path.exists():
+            path.write_bytes(data)
+        # 古いハッシュのアセットは削除
+        for old in static_dir.glob(f"app.*.{kind}"):
+            if old.name != name:
+                _unlink_quiet(old)
+        assets[kind] = path
+    return assets
+
+# ----------------------------------------------------------------------------------
+# チェックボックス／添付リンク／ページ内リンク
+# ----------------------------------------------------------------------------------
+# ---------- 本文（storage format）の変換エンジン ----------
+# lxml: 1回の走査で要素を振り分け，要素名/マクロ名ごとのハンドラで置換ノードを直接組み立てる（既定）
+# bs4 : 従来の BeautifulSoup 版（lxml が無い環境・出力の比較用）．どちらも同じ本文 HTML を返す
+STORAGE_ENGINE = "lxml"
+STORAGE_ENGINES = ("lxml", "bs4")
+
+# bs4 の str(soup) と同じ文字列にするための規則（HTMLTreeBuilder / minimal フォーマッタの既定値）
+_BS4_VOID_TAGS = frozenset(("area", "base", "basefont", "bgsound", "br", "col", "command", "embed", "frame", "hr",
+                            "image", "img", "input", "isindex", "keygen", "link", "menuitem", "meta", "nextid",
+                            "param", "source", "spacer", "track", "wbr"))
+_BS4_LIST_ATTRS = {"*": frozenset(("class", "accesskey", "dropzone")), "a": frozenset(("rel", "rev")),
+                   "link": frozenset(("rel", "rev")), "td": frozenset(("headers",)), "th": frozenset(("headers",)),
+                   "form": frozenset(("accept-charset",)), "object": frozenset(("archive",)),
+                   "area": frozenset(("rel",)), "icon": frozenset(("sizes",)), "iframe": frozenset(("sandbox",)),
+                   "output": frozenset(("for",))}
+_BS4_RAW_TEXT_TAGS = frozenset(("script", "style"))               # 中身をエスケープしない
+_BS4_STRING_CONTAINERS = frozenset(("rt", "rp", "style", "script", "template"))   # get_text の対象外
+_BS4_PRESERVE_WS_TAGS = ("pre", "textarea")                       # 空白だけの文字列を畳まない
+_ASCII_SPACES = frozenset(" \n\t\x0c\r")
+# 値を省いた真偽属性（disabled 等）は lxml の木では値が名前になり，bs4 では空文字になる（見分けられないので bs4 版へ）
+_LX_BOOLEAN_ATTRS = frozenset(("checked", "compact", "declare", "defer", "disabled", "ismap", "multiple", "nohref",
+                               "noresize", "noshade", "nowrap", "readonly", "selected"))
+_NON_WS_RE = re.compile(r"\S+")
+_LX_LEADING_MARKUP_RE = re.compile(r"\s*<[!/]")   # 先頭がコメント/CDATA/終了タグ
+
+_MEDIA_VIDEO_EXTS = {".mp4", ".webm", ".ogv", ".ogg", ".m4v"}
+_MEDIA_AUDIO_EXTS = {".mp3", ".wav", ".m4a", ".ogg"}
+_MEDIA_IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".svg"}
+
+def _lx_el(tag: str, attrib: dict | None = None, text: str | None = None, tail: str | None = None, children=()):
+    # 置換用の要素を直接組み立てる（断片 HTML を文字列から解析し直さない）
+    el = lxml_etree.Element(tag)
+    for k, v in (attrib or {}).items():
+        el.set(k, v)
+    el.text = text
+    el.tail = tail
+    for child in children:
+        el.append(child)
+    return el
+
+def _lx_first(el, suffix: str, attr: str | None = None, value: str | None = None):
+    # el の子孫（自身は除く）で，名前が suffix で終わる最初の要素（bs4 の find(lambda ...) 相当）
+    it = el.iter()
+    next(it)
+    for d in it:
+        tag = d.tag
+        if isinstance(tag, str) and tag.endswith(suffix) and (attr is None or d.get(attr) == value):
+            return d
+    return None
+
+def _lx_attached(el, tops: list) -> bool:
+    # 先に置換された要素の中にあるもの（木から外れたもの）は処理しない．tops は文書の最上位の要素
+    top = el
+    parent = el.getparent()
+    while parent is not None:
+        top, parent = parent, parent.getparent()
+    return any(top is t for t in tops)
+
+def _lx_stripped_text(el, containers: bool) -> str:
+    # bs4 の get_text(strip=True) 相当：文字列片ごとに strip して空でないものを連結（コメントは除く）
+    # containers=True なら script/style などの中の文字列も除く
+    def skip(owner) -> bool:
+        if not containers:
+            return False
+        while owner is not None:
+            if owner.tag in _BS4_STRING_CONTAINERS:
+                return True
+            owner = owner.getparent()
+        return False
+
+    parts = []
+    for d in el.iter():
+        if isinstance(d.tag, str) and d.text and not skip(d):
+            s = d.text.strip()
+            if s:
+                parts.append(s)
+        if d is not el and d.tail and not skip(d.getparent()):
+            s = d.tail.strip()
+            if s:
+                parts.append(s)
+    return "".join(parts)
+
+def _lx_replace(old, new) -> None:
+    new.tail = old.tail
+    old.tail = None
+    old.getparent().replace(old, new)
+
+def _lx_unwrap(el) -> None:
+    # 要素を外して中身（文字列と子要素）を同じ位置に残す
+    parent = el.getparent()
+    idx = parent.index(el)
+
+    def append_text(at, text):
+        # at の直前（idx 番目の前）にある文字列の末尾へ text を足す
+        if not text:
+            return
+        if at > 0:
+            prev = parent[at - 1]
+            prev.tail = (prev.tail or "") + text
         else:
-            _log_not_found_attachment(out_root, filename, "href_to_attachment")
-            target = attach_dir / filename  # 存在しない可能性あり
+            parent.text = (parent.text or "") + text
+
+    append_text(idx, el.text)
+    tail = el.tail
+    el.tail = None
+    children = list(el)
+    parent.remove(el)
+    for i, child in enumerate(children):
+        parent.insert(idx + i, child)
+    append_text(idx + len(children), tail)
+
+def _lx_serialize(el, out: list) -> None:
+    # bs4 の minimal フォーマッタと同じ規則で書き出す（属性は名前順，空要素は <br/>，script/style の中身は素のまま）
+    tag = el.tag
+    if not isinstance(tag, str):
+        if tag is lxml_etree.Comment:
+            out.append(f"<!--{el.text or ''}-->")
+        return
+    out.append("<" + tag)
+    if len(el.attrib):
+        lists = _BS4_LIST_ATTRS.get(tag)
+        for k, v in sorted(el.attrib.items()):
+            if k in _BS4_LIST_ATTRS["*"] or (lists is not None and k in lists):
+                v = " ".join(_NON_WS_RE.findall(v))
+            v = v.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            q = '"'
+            if '"' in v:
+                if "'" in v:
+                    v = v.replace('"', "&quot;")
+                else:
+                    q = "'"
+            out.append(f" {k}={q}{v}{q}")
+    if el.text is None and not len(el) and tag in _BS4_VOID_TAGS:
+        out.append("/>")
+        return
+    out.append(">")
+    raw = tag in _BS4_RAW_TEXT_TAGS
+    if el.text:
+        out.append(el.text if raw else el.text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;"))
+    for child in el:
+        _lx_serialize(child, out)
+        if child.tail:
+            out.append(child.tail if raw else child.tail.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;"))
+    out.append(f"</{tag}>")
+
+def _storage_body_lxml(storage_html: str, href_for, folder_for, inject_head: bool,
+                       page_href_for) -> tuple[str, str | None] | None:
+    """
+    storage format の本文を lxml で1回だけ走査して HTML にする（_storage_body_bs4 と同じ出力）．
+    走査で要素を種類ごとに振り分け，bs4 版の各周（view-file → multimedia → 画像 → リンク → 名前空間タグ）と同じ順で
+    ハンドラを適用する．外すだけの要素は最後にまとめて外す（外す順は結果に影響せず，途中の get_text の区切りも変わらない）．
+    href_for(filename) -> (href, label)，folder_for(filename) -> フォルダの href，page_href_for(タイトル, スペースキー) -> href．
+    戻り値は (本文HTML, 最後に処理した ri:page リンクのタイトル)．lxml で扱わない入力（空文書など）は None．
+    """
+    text = storage_html or ""
+    if text[:1] == "\ufeff":
+        text = text[1:]
+    low = text.lower()
+    if "<!doctype" in low or "<?" in text or "<meta" in low or "</html" in low or _LX_LEADING_MARKUP_RE.match(text):
+        # DOCTYPE / 処理命令 / meta の charset 置換，文書の外に出る空白（先頭のコメントや終了タグ，</html> の後ろ）は bs4 版に任せる
+        return None
+    parser = lxml_etree.HTMLParser(recover=True)
+    try:
+        parser.feed(text)
+        root = parser.close()
+    except Exception:
+        return None
+    if root is None:
+        return None
+    try:
+        return _lx_transform(root, href_for, folder_for, inject_head, page_href_for)
+    except ValueError:
+        return None     # XML に置けない制御文字を含む名前や真偽属性など（bs4 版で処理する）
+
+def _lx_transform(root, href_for, folder_for, inject_head: bool, page_href_for) -> tuple[str, str | None]:
+    # _storage_body_lxml の本体（root は解析済みの文書．</html> の後ろの内容は root と並ぶ最上位の要素になる）
+    nodes = [*reversed(list(root.itersiblings(preceding=True))), root, *root.itersiblings()]
+    tops = [n for n in nodes if isinstance(n.tag, str)]
+    # 走査は1回：空白だけの文字列を bs4 と同じく " " / "\n" に畳みながら，処理対象を種類ごとに集める
+    preserve = any(next(t.iter(*_BS4_PRESERVE_WS_TAGS), None) is not None for t in tops)
+    containers = any(next(t.iter(*_BS4_STRING_CONTAINERS), None) is not None for t in tops)
+
+    def squash(s: str | None, owner) -> str | None:
+        if not s or not _ASCII_SPACES.issuperset(s):
+            return s
+        if preserve:
+            while owner is not None:
+                if owner.tag in _BS4_PRESERVE_WS_TAGS:
+                    return s
+                owner = owner.getparent()
+        return "\n" if "\n" in s else " "
+
+    macros, multimedia, images, links, unwrap = [], [], [], [], []
+    for el in (el for t in tops for el in t.iter()):
+        tag = el.tag
+        if isinstance(tag, str):
+            if el.text and el.text.isspace():
+                el.text = squash(el.text, el)
+            if tag.endswith("structured-macro"):
+                name = el.get("ac:name")
+                if name == "view-file":
+                    macros.append(el)
+                elif name == "multimedia":
+                    multimedia.append(el)
+            elif tag.endswith("multimedia"):
+                multimedia.append(el)
+            elif tag.endswith("image"):
+                images.append(el)
+            elif tag.endswith("link"):
+                links.append(el)
+            if ":" in tag:
+                unwrap.append(el)
+            if len(el.attrib) and any(el.get(a) == a for a in _LX_BOOLEAN_ATTRS.intersection(el.attrib)):
+                raise ValueError("boolean attribute")
+        if el.tail and el.tail.isspace():
+            el.tail = squash(el.tail, el.getparent())
+
+    def media(kind: str, cls: str, wrapper: str, href: str, label: str, ext: str, pad: bool, size: dict | None = None):
+        # <figure|p class=...><video|audio controls preload=metadata><source><a>label</a></...></...>
+        player = _lx_el(kind, {"controls": "", "preload": "metadata", **(size or {})}, " ", None, [
+            _lx_el("source", {"src": href, "type": f"{kind}/{ext.lstrip('.')}"}, tail=" "),
+            _lx_el("a", {"href": href, "target": "_blank", "rel": "noopener"}, label or None, " " if pad else None),
+        ])
+        return _lx_el(wrapper, {"class": cls}, " " if pad else None, None, [player])
+
+    def zoom_image(src: str, alt: str):
+        return _lx_el("figure", {"class": "confluence-image"}, " ", None, [
+            _lx_el("a", {"href": src, "class": "zoom", "aria-label": "画像を拡大"}, " ", None, [
+                _lx_el("img", {"src": src, "class": "thumb", "alt": alt}, tail=" ")])])
+
+    def file_link(href: str, label: str, folder: str):
+        return _lx_el("p", None, None, None, [
+            _lx_el("a", {"href": href, "target": "_blank", "rel": "noopener"}, label or None, " "),
+            _lx_el("a", {"class": "open-folder", "href": folder, "target": "_blank", "title": "フォルダを開く",
+                         "aria-label": "フォルダを開く"}, "📁")])
+
+    # --- view-file マクロ（画像/動画/音声/ファイル） ---
+    for macro in macros:
+        if not _lx_attached(macro, tops):
+            continue
+        param = _lx_first(macro, "parameter", "ac:name", "name")
+        attach = _lx_first(param, "attachment") if param is not None else None
+        filename = (attach.get("ri:filename") or "").strip() if attach is not None else ""
+        if not filename:
+            if ":" not in macro.tag:
+                unwrap.append(macro)   # 名前空間の無いマクロもファイル名が無ければ外す（名前空間付きは最後に外れる）
+            continue
+        href, label = href_for(filename)
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in _MEDIA_VIDEO_EXTS or ext in _MEDIA_AUDIO_EXTS:
+            size = {}
+            if ext in _MEDIA_VIDEO_EXTS:
+                for key in ("width", "height"):
+                    p = _lx_first(macro, "parameter", "ac:name", key)
+                    v = _lx_stripped_text(p, containers) if p is not None else ""
+                    if v.isdigit():
+                        size[key] = v
+                new = media("video", "confluence-video", "figure", href, label, ext, True, size)
+            else:
+                new = media("audio", "confluence-audio", "p", href, label, ext, True)
+        elif ext in _MEDIA_IMAGE_EXTS:
+            new = zoom_image(href, label)
+        else:
+            new = file_link(href, label, folder_for(filename))
+        _lx_replace(macro, new)
 
-        # 相対パスでリンクを作る
-        href = _rel_href_from(page_dir, target)
+    # --- ac:multimedia を動画/音声として扱う ---
+    for mm in multimedia:
+        if not _lx_attached(mm, tops):
+            continue
+        ri = _lx_first(mm, "attachment")
+        url = filename = None
+        if ri is not None and ri.get("ri:filename") is not None:
+            filename = (ri.get("ri:filename") or "").strip()
+        else:
+            uri = _lx_first(mm, "url")
+            if uri is not None and uri.get("ri:value") is not None:
+                url = (uri.get("ri:value") or "").strip()
+        if filename:
+            href, label = href_for(filename)
+            ext = os.path.splitext(filename)[1].lower()
+            if ext in _MEDIA_VIDEO_EXTS:
+                _lx_replace(mm, media("video", "confluence-video", "figure", href, label, ext, False))
+            elif ext in _MEDIA_AUDIO_EXTS:
+                _lx_replace(mm, media("audio", "confluence-audio", "p", href, label, ext, False))
+        elif url and (url.lower().endswith(".mp4") or url.lower().endswith(".webm")):
+            _lx_replace(mm, _lx_el("figure", {"class": "confluence-video"}, None, None, [
+                _lx_el("video", {"controls": "", "preload": "metadata", "src": url})]))
 
-        label = Path(filename).name
-        return href, label
+    # --- 画像マクロ <ac:image> を <img>（サムネ）＋リンク（フル）に変換 ---
+    for aimg in images:
+        if not _lx_attached(aimg, tops):
+            continue
+        ri_att = _lx_first(aimg, "attachment")
+        filename = (ri_att.get("ri:filename") or "").strip() if ri_att is not None else ""
+        if filename:
+            _lx_replace(aimg, zoom_image(href_for(filename)[0], filename))
+            continue
+        ri_url = _lx_first(aimg, "url")
+        url = (ri_url.get("ri:value") or "").strip() if ri_url is not None else ""
+        if url:
+            _lx_replace(aimg, zoom_image(url, ""))
+            continue
+        _lx_replace(aimg, _lx_el("p", None, "[画像]"))
 
-    def _folder_href_for_attachment(filename: str) -> str:
-        # 添付ファイルが置かれているフォルダへの “相対パス” を返す
-        attach_dir = _get_attach_dir(out_root)
-        candidates = _candidate_attach_paths(filename, attach_dir)
-        target = next((c for c in candidates if c.exists()), attach_dir / filename)
-        parent = target.parent if target.exists() else attach_dir
+    # --- ac:link + ri:attachment / ri:page ---
+    link_title = None
+    for alink in links:
+        if not _lx_attached(alink, tops):
+            continue
+        ri_attach = _lx_first(alink, "attachment")
+        filename = (ri_attach.get("ri:filename") or "").strip() if ri_attach is not None else ""
+        if filename:
+            href, _label = href_for(filename)
+            label = _lx_stripped_text(alink, containers) or _label
+            _lx_replace(alink, file_link(href, label, folder_for(filename)))
+            continue
+        ri_page = _lx_first(alink, "page")
+        if ri_page is not None and ri_page.get("ri:content-title") is not None:
+            link_title = (ri_page.get("ri:content-title") or "").strip()
+            if link_title:
+                label = _lx_stripped_text(alink, containers) or link_title
+                href = page_href_for(link_title, (ri_page.get("ri:space-key") or "").strip())
+                _lx_replace(alink, _lx_el("p", None, None, None, [_lx_el("a", {"href": href}, label)]))
+
+    # Confluence名前空間タグ（と view-file 以外のマクロ）は中身だけ残す
+    for el in unwrap:
+        if el.getparent() is not None and _lx_attached(el, tops):
+            _lx_unwrap(el)
+
+    # BackToTop の CSS/JS を <head> に一度だけ注入（static 方式では共通アセット側に含まれる）
+    if inject_head:
+        head = next((h for t in tops for h in t.iter("head")), None)
+        if head is None:
+            html_tag = next(h for t in tops for h in t.iter("html"))
+            head = _lx_el("head", tail=html_tag.text)
+            html_tag.text = None
+            html_tag.insert(0, head)
+        for tag, ident, body in (("style", "backToTop-style", _BACK_TO_TOP_CSS),
+                                 ("script", "backToTop-script", _BACK_TO_TOP_JS)):
+            if not any(e.get("id") == ident for e in head.iter() if e is not head):
+                head.append(_lx_el(tag, {"id": ident}, body))
+
+    out: list[str] = []
+    for node in nodes:
+        _lx_serialize(node, out)
+    return "".join(out), link_title
+
+def _storage_body_bs4(storage_html: str, href_for, folder_for, inject_head: bool,
+                      page_href_for) -> tuple[str, str | None]:
+    # BeautifulSoup 版の本文変換（lxml 版と同じ出力）．戻り値は (本文HTML, 最後に処理した ri:page リンクのタイトル)
+    link_title = None
+    parser = "lxml"
+    try:
+        soup = BeautifulSoup(storage_html or "", parser)
+        
+        # --- BackToTop の CSS/JS を <head> に一度だけ注入（static 方式では共通アセット側に含まれる） ---
+        head = soup.find("head") if inject_head else None
+        if inject_head and not head:
+            # まれに <head> が無い HTML もあるので生成しておく
+            html_tag = soup.find("html") or soup
+            head = soup.new_tag("head")
+            if html_tag.contents:
+                html_tag.insert(0, head)
+            else:
+                html_tag.append(head)
 
-        # このページのHTMLが出力されるフォルダを基準に相対パス化
-        page_dir = _html_dir_for_page()
-        return _rel_href_from(page_dir, parent)
+        # CSS
+        if head is not None and not head.find(id="backToTop-style"):
+            style_tag = soup.new_tag("style", id="backToTop-style")
+            style_tag.string = _BACK_TO_TOP_CSS
+            head.append(style_tag)
 
+        # JS
+        if head is not None and not head.find(id="backToTop-script"):
+            script_tag = soup.new_tag("script", id="backToTop-script")
+            script_tag.string = _BACK_TO_TOP_JS
+            head.append(script_tag)
+        # --- /BackToTop ヘッダ注入 ここまで ---
+
+        
+    except Exception:
+        soup = BeautifulSoup(storage_html or "", "html.parser")
     # --- view-file マクロ（画像/ファイル） ---
     for macro in soup.find_all(lambda t: t.name and t.name.endswith("structured-macro")):
         if macro.get("ac:name") == "view-file":
@@ -997,7 +2714,7 @@ def confluence_storage_to_html(storage_html: str, page_titles_chain: list[str],
                 if attach and attach.has_attr("ri:filename"):
                     filename = (attach.get("ri:filename") or "").strip()
                     if filename:
-                        href, label = _href_to_attachment(filename)
+                        href, label = href_for(filename)
                         ext = os.path.splitext(filename)[1].lower()
                         
                         # 動画ファイルが含まれていた際の処理 -------------------------------------------------
@@ -1035,821 +2752,489 @@ def confluence_storage_to_html(storage_html: str, page_titles_chain: list[str],
                             ))
                             continue
                         # ---------------------------------------------------
-                        # 画像拡張子なら本文インライン（サムネ）＋クリックで拡大
-                        if ext.lower() in {".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".svg"}:
-                            macro.replace_with(BeautifulSoup(
-                                f'<figure class="confluence-image">'
-                                f'  <a href="{href}" class="zoom" aria-label="画像を拡大">'
-                                f'    <img src="{href}" class="thumb" alt="{label}">'
-                                f'  </a>'
-                                f'</figure>',
-                                "html.parser"
-                            ))
-                        else:
-                            folder = _folder_href_for_attachment(filename)
-                            macro.replace_with(BeautifulSoup(
-                                f'<p><a href="{href}" target="_blank" rel="noopener">{label}</a>'
-                                f' <a class="open-folder" href="{folder}" target="_blank" title="フォルダを開く" aria-label="フォルダを開く">📁</a></p>',
-                                "html.parser"))
-                        continue
-            macro.unwrap()
-    
-    # --- ac:multimedia / ac:structured-macro name="multimedia" を動画として扱う ---
-    for mm in soup.find_all(lambda t: (
-        (t.name and t.name.endswith("structured-macro") and t.get("ac:name") == "multimedia")
-        or (t.name and t.name.endswith("multimedia"))
-    )):
-        # 添付のファイル名を拾う
-        ri = mm.find(lambda t: t.name and t.name.endswith("attachment"))
-        url = None
-        filename = None
-        if ri and ri.has_attr("ri:filename"):
-            filename = (ri.get("ri:filename") or "").strip()
-        else:
-            uri = mm.find(lambda t: t.name and t.name.endswith("url"))
-            if uri and uri.has_attr("ri:value"):
-                url = (uri.get("ri:value") or "").strip()
-
-        if filename:
-            href, label = _href_to_attachment(filename)
-            ext = os.path.splitext(filename)[1].lower()
-            if ext in {".mp4", ".webm", ".ogv", ".ogg", ".m4v"}:
-                mm.replace_with(BeautifulSoup(
-                    f'<figure class="confluence-video"><video controls preload="metadata">'
-                    f'  <source src="{href}" type="video/{ext.lstrip(".")}">'
-                    f'  <a href="{href}" target="_blank" rel="noopener">{label}</a>'
-                    f'</video></figure>', "html.parser"))
-                continue
-            if ext in {".mp3", ".wav", ".m4a", ".ogg"}:
-                mm.replace_with(BeautifulSoup(
-                    f'<p class="confluence-audio"><audio controls preload="metadata">'
-                    f'  <source src="{href}" type="audio/{ext.lstrip(".")}">'
-                    f'  <a href="{href}" target="_blank" rel="noopener">{label}</a>'
-                    f'</audio></p>', "html.parser"))
-                continue
-        elif url and (url.lower().endswith(".mp4") or url.lower().endswith(".webm")):
-            mm.replace_with(BeautifulSoup(
-                f'<figure class="confluence-video"><video controls preload="metadata" src="{url}"></video></figure>',
-                "html.parser"))
-            continue
-
-    # --- 画像マクロ <ac:image> を <img>（サムネ）＋リンク（フル）に変換 ---
-    for aimg in soup.find_all(lambda t: t.name and t.name.endswith("image")):
-        ri_att = aimg.find(lambda t: t.name and t.name.endswith("attachment"))
-        if ri_att and ri_att.has_attr("ri:filename"):
-            filename = (ri_att.get("ri:filename") or "").strip()
-            if filename:
-                src, _ = _href_to_attachment(filename)   # フル画像のURL/パス
-                html = (
-                    f'<figure class="confluence-image">'
-                    f'  <a href="{src}" class="zoom" aria-label="画像を拡大">'
-                    f'    <img src="{src}" class="thumb" alt="{filename}">'
-                    f'  </a>'
-                    f'</figure>'
-                )
-                aimg.replace_with(BeautifulSoup(html, "html.parser"))
-                continue
-        ri_url = aimg.find(lambda t: t.name and t.name.endswith("url"))
-        if ri_url and ri_url.has_attr("ri:value"):
-            url = (ri_url.get("ri:value") or "").strip()
-            if url:
-                html = (
-                    f'<figure class="confluence-image">'
-                    f'  <a href="{url}" class="zoom" aria-label="画像を拡大">'
-                    f'    <img src="{url}" class="thumb" alt="">'
-                    f'  </a>'
-                    f'</figure>'
-                )
-                aimg.replace_with(BeautifulSoup(html, "html.parser"))
-                continue
-        aimg.replace_with(BeautifulSoup('<p>[画像]</p>', "html.parser"))
-
-    # --- ac:link + ri:attachment / ri:page ---
-    for alink in soup.find_all(lambda t: t.name and t.name.endswith("link")):
-        # 添付
-        ri_attach = alink.find(lambda t: t.name and t.name.endswith("attachment"))
-        if ri_attach and ri_attach.has_attr("ri:filename"):
-            filename = (ri_attach.get("ri:filename") or "").strip()
-            if filename:
-                href, _label = _href_to_attachment(filename)
-                label = alink.get_text(strip=True) or _label
-                folder = _folder_href_for_attachment(filename)
-                alink.replace_with(BeautifulSoup(
-                    f'<p><a href="{href}" target="_blank" rel="noopener">{label}</a>'
-                    f' <a class="open-folder" href="{folder}" target="_blank" title="フォルダを開く" aria-label="フォルダを開く">📁</a></p>',
-                    "html.parser"))
-                continue
-        # ページ
-        ri_page = alink.find(lambda t: t.name and t.name.endswith("page"))
-        if ri_page and ri_page.has_attr("ri:content-title"):
-            title = (ri_page.get("ri:content-title") or "").strip()
-            if title:
-                safe = sanitize(title)
-                label = alink.get_text(strip=True) or title
-                # 同じディレクトリ内の HTML にリンク（存在チェックはしない/後で作る）
-                alink.replace_with(BeautifulSoup(f'<p><a href="{safe}.html">{label}</a></p>', "html.parser"))
-                continue
-
-    # Confluence名前空間タグは中身だけ残す
-    for tag in list(soup.find_all()):
-        if ":" in tag.name:
-            tag.unwrap()
-
-    # --- 本文HTML（段落間隔の体裁をちょっと整える） ---
-    body_html = str(soup)
-
-    # --- 背景画像 BG_01.png への相対パスを計算 ---
-    page_dir = _html_dir_for_page()
-    
-    # --- 末尾フッター：添付格納先（相対リンク化） ---
-    attach_dir = _attach_folder_for_page().resolve()
-    footer_rel = _rel_href_from(page_dir, attach_dir)
-    if not footer_rel.endswith("/"):
-        footer_rel += "/"
-
-    # 事前解決（resolved_icons）があればそれを使う
-    bg_url = (resolved_icons.get("bg") if resolved_icons else "") or ""
-    logo_url = (resolved_icons.get("logo") if resolved_icons else "") or ""
-    exe_icon_rel = (resolved_icons.get("exe_icon") if resolved_icons else "") or ""
-    pokeball_rel = (resolved_icons.get("pokeball") if resolved_icons else "") or ""
-    empty_icon_rel = (resolved_icons.get("empty_icon") if resolved_icons else "") or ""
-    back_top_img = (resolved_icons.get("back_top_img") if resolved_icons else "") or ""
-
-    # 事前解決が無いときだけ従来の確保・相対化を行う
-    if not bg_url:
-        try:
-            bg_candidate = _get_attach_dir(out_root) / "BG_01.png"
-            if bg_candidate.exists():
-                bg_url = _rel_href_from(page_dir, bg_candidate)
-        except Exception:
-            bg_url = ""
-
-    if not logo_url:
-        try:
-            logo_candidate = _ensure_header_logo(out_root)
-            if logo_candidate.exists():
-                logo_url = _rel_href_from(out_root, logo_candidate)
-        except Exception:
-            logo_url = ""
-
-    if not exe_icon_rel:
-        try:
-            exe_icon_path = _ensure_exe_icon(out_root)
-            if exe_icon_path is not None:
-                exe_icon_rel = _rel_href_from(page_dir, exe_icon_path)
-        except Exception:
-            exe_icon_rel = ""
-
-    if not pokeball_rel:
-        try:
-            pokeball_path = _ensure_pokeball(out_root)
-            if pokeball_path is not None:
-                pokeball_rel = _rel_href_from(page_dir, pokeball_path)
-        except Exception:
-            pokeball_rel = ""
-
-    if not empty_icon_rel:
-        try:
-            empty_icon_path = _ensure_empty_icon(out_root)
-            if empty_icon_path is not None:
-                empty_icon_rel = _rel_href_from(page_dir, empty_icon_path)
-        except Exception:
-            empty_icon_rel = ""
-            
-    if not back_top_img:
-        try:
-            gori_path = _ensure_footer_gori(out_root)   # 添付/ footer_gori1.png を保証
-            if gori_path is not None:
-                back_top_img = _rel_href_from(page_dir, gori_path)  # ページ基準の相対パスへ
-        except Exception:
-            back_top_img = ""
-
-    # フッター用画像
-    back_to_top_html = ""
-    if back_top_img:
-        back_to_top_html = f"""
-        <div id="backToTop"
-            role="button"
-            tabindex="0"
-            aria-label="ページの先頭へ戻る"
-            title="ページの先頭へ戻る">
-        <img src="{back_top_img}" alt="トップに戻る">
-        </div>
-        <div id="scrollSentinel" aria-hidden="true"></div>
-        """
-    # フッター本体
-    footer_html = f"""
-    <hr>
-    <div class="footer" style="margin-top:20px;">
-        <a href="{footer_rel}"
-        class="open-folder"
-        title="添付ファイル格納先を開く"
-        aria-label="添付ファイル格納先を開く"
-        style="font-size:14px; text-decoration:none;">
-        📁 添付ファイル格納先を開く
-        </a>
-    </div>
-    """
-
-    # このページ位置から見たサイドバー用リンクを作る
-    def _generate_sidebar_links_for_current_page() -> str:
-        parts: list[str] = []
-
-        # --- Top に戻るリンク ---
-        index_path = out_root / "index.html"
-        top_href = _rel_href_from(page_dir, index_path)
-        parts.append(
-            f'<div class="sidebar-toplink"><a href="{top_href}">Topに戻る</a></div>'
-        )
-
-        if not SIDEBAR_ITEMS:
-            return "\n".join(parts)
-
-        # ================================
-        # ①：同名タイトルの重複除去
-        #     → (大項目, タイトル) 単位で「最新だけ」残す
-        # ================================
-        latest: dict[tuple[str, str], tuple[list[str], Path]] = {}
-        for chain, pth in SIDEBAR_ITEMS:
-            if len(chain) == 1:
-                group_key = "その他"
-            else:
-                group_key = chain[0]        # 例：ポケモンディレクションレッジ
-
-            title = chain[-1]
-            latest[(group_key, title)] = (chain, pth)
-
-        # ================================
-        # ②：大項目ごとに分類
-        # ================================
-        groups: dict[str, list[tuple[str, str]]] = {}
-
-        for (group_key, title), (_chain, pth) in latest.items():
-            href = _rel_href_from(page_dir, pth)
-            is_empty = pth in SIDEBAR_EMPTY_PAGES
-            groups.setdefault(group_key, []).append((title, href, is_empty))
-
-        # ================================
-        # ②.5：このページ自身の href を計算
-        # ================================
-        current_title = _page_title()
-        current_page_dir = _html_dir_for_page()
-        current_page_path = current_page_dir / f"{sanitize(current_title)}.html"
-        current_href = _rel_href_from(page_dir, current_page_path)
+                        # 画像拡張子なら本文インライン（サムネ）＋クリックで拡大
+                        if ext.lower() in {".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".svg"}:
+                            macro.replace_with(BeautifulSoup(
+                                f'<figure class="confluence-image">'
+                                f'  <a href="{href}" class="zoom" aria-label="画像を拡大">'
+                                f'    <img src="{href}" class="thumb" alt="{label}">'
+                                f'  </a>'
+                                f'</figure>',
+                                "html.parser"
+                            ))
+                        else:
+                            folder = folder_for(filename)
+                            macro.replace_with(BeautifulSoup(
+                                f'<p><a href="{href}" target="_blank" rel="noopener">{label}</a>'
+                                f' <a class="open-folder" href="{folder}" target="_blank" title="フォルダを開く" aria-label="フォルダを開く">📁</a></p>',
+                                "html.parser"))
+                        continue
+            macro.unwrap()
+    
+    # --- ac:multimedia / ac:structured-macro name="multimedia" を動画として扱う ---
+    for mm in soup.find_all(lambda t: (
+        (t.name and t.name.endswith("structured-macro") and t.get("ac:name") == "multimedia")
+        or (t.name and t.name.endswith("multimedia"))
+    )):
+        # 添付のファイル名を拾う
+        ri = mm.find(lambda t: t.name and t.name.endswith("attachment"))
+        url = None
+        filename = None
+        if ri and ri.has_attr("ri:filename"):
+            filename = (ri.get("ri:filename") or "").strip()
+        else:
+            uri = mm.find(lambda t: t.name and t.name.endswith("url"))
+            if uri and uri.has_attr("ri:value"):
+                url = (uri.get("ri:value") or "").strip()
 
-        # ================================
-        # ③：サイドバー HTML 出力
-        # ================================
-        # 「その他」が一番下に来るように並び替え
-        ordered_groups = sorted(
-            groups.keys(),
-            key=lambda g: (g == "その他", g) 
-        )
+        if filename:
+            href, label = href_for(filename)
+            ext = os.path.splitext(filename)[1].lower()
+            if ext in {".mp4", ".webm", ".ogv", ".ogg", ".m4v"}:
+                mm.replace_with(BeautifulSoup(
+                    f'<figure class="confluence-video"><video controls preload="metadata">'
+                    f'  <source src="{href}" type="video/{ext.lstrip(".")}">'
+                    f'  <a href="{href}" target="_blank" rel="noopener">{label}</a>'
+                    f'</video></figure>', "html.parser"))
+                continue
+            if ext in {".mp3", ".wav", ".m4a", ".ogg"}:
+                mm.replace_with(BeautifulSoup(
+                    f'<p class="confluence-audio"><audio controls preload="metadata">'
+                    f'  <source src="{href}" type="audio/{ext.lstrip(".")}">'
+                    f'  <a href="{href}" target="_blank" rel="noopener">{label}</a>'
+                    f'</audio></p>', "html.parser"))
+                continue
+        elif url and (url.lower().endswith(".mp4") or url.lower().endswith(".webm")):
+            mm.replace_with(BeautifulSoup(
+                f'<figure class="confluence-video"><video controls preload="metadata" src="{url}"></video></figure>',
+                "html.parser"))
+            continue
 
-        for group in ordered_groups:
-            parts.append('<div class="sidebar-section">')
-            if pokeball_rel:
-                title_html = (
-                    f'<div class="sidebar-section-title">'
-                    f'<img src="{pokeball_rel}" alt="•" class="sidebar-section-icon">'
-                    f'<span>{group}</span></div>'
+    # --- 画像マクロ <ac:image> を <img>（サムネ）＋リンク（フル）に変換 ---
+    for aimg in soup.find_all(lambda t: t.name and t.name.endswith("image")):
+        ri_att = aimg.find(lambda t: t.name and t.name.endswith("attachment"))
+        if ri_att and ri_att.has_attr("ri:filename"):
+            filename = (ri_att.get("ri:filename") or "").strip()
+            if filename:
+                src, _ = href_for(filename)   # フル画像のURL/パス
+                html = (
+                    f'<figure class="confluence-image">'
+                    f'  <a href="{src}" class="zoom" aria-label="画像を拡大">'
+                    f'    <img src="{src}" class="thumb" alt="{filename}">'
+                    f'  </a>'
+                    f'</figure>'
                 )
-            else:
-                title_html = (
-                    f'<div class="sidebar-section-title"><span>{group}</span></div>'
+                aimg.replace_with(BeautifulSoup(html, "html.parser"))
+                continue
+        ri_url = aimg.find(lambda t: t.name and t.name.endswith("url"))
+        if ri_url and ri_url.has_attr("ri:value"):
+            url = (ri_url.get("ri:value") or "").strip()
+            if url:
+                html = (
+                    f'<figure class="confluence-image">'
+                    f'  <a href="{url}" class="zoom" aria-label="画像を拡大">'
+                    f'    <img src="{url}" class="thumb" alt="">'
+                    f'  </a>'
+                    f'</figure>'
                 )
+                aimg.replace_with(BeautifulSoup(html, "html.parser"))
+                continue
+        aimg.replace_with(BeautifulSoup('<p>[画像]</p>', "html.parser"))
 
-            parts.append(title_html)
-
-            for label, href, is_empty in sorted(groups[group], key=lambda x: x[0]):
-                cls = "sidebar-link-current" if href == current_href else "sidebar-link"
-
-                icon_html = ""
-                if is_empty and empty_icon_rel:
-                    icon_html = (
-                        f'<img src="{empty_icon_rel}" class="sidebar-empty-icon" '
-                        f'alt="Empty page">'
-                    )
-                parts.append(f'<a href="{href}" class="{cls}">{icon_html}{label}</a>')
-
-            parts.append("</div>")
-
-        return "\n".join(parts)
+    # --- ac:link + ri:attachment / ri:page ---
+    for alink in soup.find_all(lambda t: t.name and t.name.endswith("link")):
+        # 添付
+        ri_attach = alink.find(lambda t: t.name and t.name.endswith("attachment"))
+        if ri_attach and ri_attach.has_attr("ri:filename"):
+            filename = (ri_attach.get("ri:filename") or "").strip()
+            if filename:
+                href, _label = href_for(filename)
+                label = alink.get_text(strip=True) or _label
+                folder = folder_for(filename)
+                alink.replace_with(BeautifulSoup(
+                    f'<p><a href="{href}" target="_blank" rel="noopener">{label}</a>'
+                    f' <a class="open-folder" href="{folder}" target="_blank" title="フォルダを開く" aria-label="フォルダを開く">📁</a></p>',
+                    "html.parser"))
+                continue
+        # ページ
+        ri_page = alink.find(lambda t: t.name and t.name.endswith("page"))
+        if ri_page and ri_page.has_attr("ri:content-title"):
+            link_title = (ri_page.get("ri:content-title") or "").strip()
+            if link_title:
+                href = page_href_for(link_title, (ri_page.get("ri:space-key") or "").strip())
+                label = alink.get_text(strip=True) or link_title
+                alink.replace_with(BeautifulSoup(f'<p><a href="{href}">{label}</a></p>', "html.parser"))
+                continue
 
-    sidebar_links_html = _generate_sidebar_links_for_current_page()
+    # Confluence名前空間タグは中身だけ残す
+    for tag in list(soup.find_all()):
+        if ":" in tag.name:
+            tag.unwrap()
 
-    # ライトボックス本体
-    lightbox_html = """
-    <div id="lightbox">
-        <div class="lb-inner">
-        <img src="" alt="">
-        </div>
-    </div>
-    """
+    return str(soup), link_title
 
-    # ライトボックス用スクリプト＋言語案内モーダル
-    script_html = """
-    <script>
-    (function () {
-        const lb  = document.getElementById("lightbox");
-        const img = lb ? lb.querySelector("img") : null;
+def confluence_storage_to_html(storage_html: str, page_titles_chain: list[str],
+                                html_root: Path, out_root: Path,
+                                *, attach_index: AttachmentIndex | None = None,
+                                page_id: str | None = None,
+                                resolved_icons: dict | None = None,
+                                sidebar_manifest: Path | None = None,
+                                static_assets: dict | None = None,
+                                search_index: Path | None = None,
+                                engine: str = STORAGE_ENGINE,
+                                history_href: str | None = None,
+                                page_index: PageLinkIndex | None = None,
+                                link_stats: dict | None = None) -> str:
+    title = page_titles_chain[-1] if page_titles_chain else "その他"
+    
+    # --- ユーティリティ ---
+    def _page_title() -> str:
+        return page_titles_chain[-1] if page_titles_chain else "その他"
 
-        function openLightbox(src, alt) {
-            if (!lb || !img) return;
-            img.src = src;
-            img.alt = alt || "";
-            lb.classList.add("open");
-        }
+    def _attach_folder_for_page() -> Path:
+        return out_root / "添付ファイル" / _page_title()
 
-        function closeLightbox() {
-            if (!lb) return;
-            lb.classList.remove("open");
-        }
+    def _html_dir_for_page() -> Path:
+        # このページ（page_titles_chain）の HTML が出力されるディレクトリを返す
+        chain = page_titles_chain or ["その他"]
+        if len(chain) == 1:
+            return html_root / "その他"
+        d = html_root
+        for t in chain[:-1]:
+            d = d / sanitize(t)
+        return d
 
-        // 画像クリックでライトボックス表示
-        if (lb && img) {
-            document.addEventListener("click", function (ev) {
-                // a.zoom を起点にライトボックスを開く
-                const a = ev.target.closest("a.zoom");
-                if (a) {
-                    ev.preventDefault();
-                    openLightbox(
-                        a.getAttribute("href"),
-                        a.getAttribute("aria-label") || ""
-                    );
-                    return;
-                }
+    if attach_index is None:
+        attach_index = build_attachment_index(out_root)
 
-                // オーバーレイやクローズボタンをクリックした場合は閉じる
-                const t = ev.target;
-                if (t.id === "lightbox" || t.classList.contains("lightbox__close")) {
-                    closeLightbox();
-                }
-            });
+    def _candidate_attach_paths(filename: str) -> list[Path]:
+        # このページ（page_id）の添付を優先して索引から引く（ファイルシステムは走査しない）
+        return attach_index.lookup(filename, page_id)
 
-            document.addEventListener("keyup", function (ev) {
-                if (ev.key === "Escape") {
-                    closeLightbox();
-                }
-            });
-        }
+    def _href_to_attachment(filename: str) -> tuple[str, str]:
+        # 添付の href と label を返す（相対パス版）．
+        # 見つからない時はログして，最後の希望として “とりあえず期待パス” を返す
+        page_dir = _html_dir_for_page()  # ← このページのHTMLが出力されるフォルダ
 
-        // --- サイドバーの幅変更 -------------------------------
-        (function initSidebarResize() {
-            const sidebar = document.querySelector(".sidebar");
-            const resizer = document.getElementById("sidebar-resizer");
-            if (!sidebar || !resizer) return;
+        # 候補検索
+        cands = _candidate_attach_paths(filename)
+        if cands:
+            target = cands[0]
+        else:
+            _log_not_found_attachment(out_root, filename, "href_to_attachment")
+            target = _get_attach_dir(out_root) / filename  # 存在しない可能性あり
 
-            let dragging = false;
-            let startX   = 0;
-            let startW   = 0;
+        # 相対パスでリンクを作る
+        href = _rel_href_from(page_dir, target)
 
-            resizer.addEventListener("mousedown", function (ev) {
-                dragging = true;
-                startX   = ev.clientX;
-                startW   = sidebar.getBoundingClientRect().width;
-                document.body.classList.add("resizing-sidebar");
-                ev.preventDefault();
-            });
+        label = Path(filename).name
+        return href, label
 
-            document.addEventListener("mousemove", function (ev) {
-                if (!dragging) return;
-                const dx = ev.clientX - startX;
-                let newW = startW + dx;
+    def _folder_href_for_attachment(filename: str) -> str:
+        # 添付ファイルが置かれているフォルダへの “相対パス” を返す
+        candidates = _candidate_attach_paths(filename)
+        parent = candidates[0].parent if candidates else _get_attach_dir(out_root)
 
-                // 最小 / 最大幅の制限
-                if (newW < 180) newW = 180;
-                if (newW > 520) newW = 520;
+        # このページのHTMLが出力されるフォルダを基準に相対パス化
+        page_dir = _html_dir_for_page()
+        return _rel_href_from(page_dir, parent)
 
-                sidebar.style.width = newW + "px";
-            });
+    page_links: list[bool] = []   # ri:page リンクごとの解決結果（lxml 版から bs4 版に切り替えた時は数え直す）
+
+    def _href_to_page(link_title: str, space_key: str) -> str:
+        # ri:page のリンク先：page_index で出力パスを引いて相対パスにする．
+        # 見つからない（索引が無い/バックアップに無いページ）時は従来どおり同じフォルダの <タイトル>.html
+        target = page_index.lookup(link_title, space_key, page_id) if page_index is not None else None
+        page_links.append(target is not None)
+        if target is None:
+            return f"{sanitize(link_title)}.html"
+        return _rel_href_from(_html_dir_for_page(), target)
+
+    # --- 本文：マクロ/添付/リンクを HTML に置き換える（lxml が使えなければ bs4 版） ---
+    converted = None
+    if engine == "lxml" and HAS_LXML:
+        converted = _storage_body_lxml(storage_html, _href_to_attachment, _folder_href_for_attachment,
+                                       static_assets is None, _href_to_page)
+    if converted is None:
+        page_links.clear()
+        converted = _storage_body_bs4(storage_html, _href_to_attachment, _folder_href_for_attachment,
+                                      static_assets is None, _href_to_page)
+    if link_stats is not None:
+        resolved = sum(page_links)
+        link_stats["links_resolved"] = link_stats.get("links_resolved", 0) + resolved
+        link_stats["links_unresolved"] = link_stats.get("links_unresolved", 0) + len(page_links) - resolved
+    body_html, link_title = converted
+    if link_title is not None:
+        title = link_title  # 見出し/タイトルは従来どおり最後に処理した ri:page リンクのタイトルで上書きされる
 
-            document.addEventListener("mouseup", function () {
-                if (!dragging) return;
-                dragging = false;
-                document.body.classList.remove("resizing-sidebar");
-            });
-        })();
 
-        // --- 言語案内モーダル -------------------------------
-        (function initLangHelp() {
-            const select  = document.getElementById("lang-select");
-            const overlay = document.getElementById("lang-help-overlay");
-            if (!select || !overlay) return;
+    # --- 背景画像 BG_01.png への相対パスを計算 ---
+    page_dir = _html_dir_for_page()
+    
+    # --- 末尾フッター：添付格納先（相対リンク化） ---
+    attach_dir = _attach_folder_for_page().resolve()
+    footer_rel = _rel_href_from(page_dir, attach_dir)
+    if not footer_rel.endswith("/"):
+        footer_rel += "/"
 
-            const modals = overlay.querySelectorAll(".lang-help-modal");
+    # 事前解決（resolved_icons）があればそれを使う
+    bg_url = (resolved_icons.get("bg") if resolved_icons else "") or ""
+    logo_url = (resolved_icons.get("logo") if resolved_icons else "") or ""
+    exe_icon_rel = (resolved_icons.get("exe_icon") if resolved_icons else "") or ""
+    pokeball_rel = (resolved_icons.get("pokeball") if resolved_icons else "") or ""
+    empty_icon_rel = (resolved_icons.get("empty_icon") if resolved_icons else "") or ""
+    back_top_img = (resolved_icons.get("back_top_img") if resolved_icons else "") or ""
 
-            function showModal(lang) {
-                overlay.classList.add("is-open");
-                overlay.setAttribute("aria-hidden", "false");
+    # 事前解決が無いときだけ従来の確保・相対化を行う
+    if not bg_url:
+        try:
+            bg_candidate = _get_attach_dir(out_root) / "BG_01.png"
+            if bg_candidate.exists():
+                bg_url = _rel_href_from(page_dir, bg_candidate)
+        except Exception:
+            bg_url = ""
 
-                modals.forEach(function (m) {
-                    if (m.getAttribute("data-lang") === lang) {
-                        m.style.display = "block";
-                    } else {
-                        m.style.display = "none";
-                    }
-                });
+    if not logo_url:
+        try:
+            logo_candidate = _ensure_header_logo(out_root)
+            if logo_candidate.exists():
+                logo_url = _rel_href_from(out_root, logo_candidate)
+        except Exception:
+            logo_url = ""
 
-                // ブラウザ翻訳の検知用に lang 属性も合わせておく
-                document.documentElement.lang = lang;
-            }
+    if not exe_icon_rel:
+        try:
+            exe_icon_path = _ensure_exe_icon(out_root)
+            if exe_icon_path is not None:
+                exe_icon_rel = _rel_href_from(page_dir, exe_icon_path)
+        except Exception:
+            exe_icon_rel = ""
 
-            function hideModal() {
-                overlay.classList.remove("is-open");
-                overlay.setAttribute("aria-hidden", "true");
-            }
+    if not pokeball_rel:
+        try:
+            pokeball_path = _ensure_pokeball(out_root)
+            if pokeball_path is not None:
+                pokeball_rel = _rel_href_from(page_dir, pokeball_path)
+        except Exception:
+            pokeball_rel = ""
 
-            // プルダウン変更時にモーダル表示
-            select.addEventListener("change", function () {
-                const v = select.value || "ja";
-                showModal(v);
-            });
+    if not empty_icon_rel:
+        try:
+            empty_icon_path = _ensure_empty_icon(out_root)
+            if empty_icon_path is not None:
+                empty_icon_rel = _rel_href_from(page_dir, empty_icon_path)
+        except Exception:
+            empty_icon_rel = ""
+            
+    if not back_top_img:
+        try:
+            gori_path = _ensure_footer_gori(out_root)   # 添付/ footer_gori1.png を保証
+            if gori_path is not None:
+                back_top_img = _rel_href_from(page_dir, gori_path)  # ページ基準の相対パスへ
+        except Exception:
+            back_top_img = ""
 
-            // 背景クリック or × ボタンで閉じる
-            overlay.addEventListener("click", function (ev) {
-                if (ev.target === overlay || ev.target.hasAttribute("data-lang-help-close")) {
-                    hideModal();
-                }
-            });
+    # フッター用画像
+    back_to_top_html = ""
+    if back_top_img:
+        back_to_top_html = f"""
+        <div id="backToTop"
+            role="button"
+            tabindex="0"
+            aria-label="ページの先頭へ戻る"
+            title="ページの先頭へ戻る">
+        <img src="{back_top_img}" alt="トップに戻る">
+        </div>
+        <div id="scrollSentinel" aria-hidden="true"></div>
+        """
+    # フッター本体
+    footer_html = f"""
+    <hr>
+    <div class="footer" style="margin-top:20px;">
+        <a href="{footer_rel}"
+        class="open-folder"
+        title="添付ファイル格納先を開く"
+        aria-label="添付ファイル格納先を開く"
+        style="font-size:14px; text-decoration:none;">
+        📁 添付ファイル格納先を開く
+        </a>
+    </div>
+    """
 
-            // Esc キーでも閉じる
-            document.addEventListener("keyup", function (ev) {
-                if (ev.key === "Escape") {
-                    hideModal();
-                }
-            });            
-        })();
+    # このページ位置から見たサイドバー用リンクを作る
+    def _generate_sidebar_links_for_current_page() -> str:
+        parts: list[str] = []
 
-        // --- 現在ページの位置までサイドバーを自動スクロール ----------------
-        (function scrollSidebarToCurrent() {
-            const sidebar = document.querySelector(".sidebar");
-            if (!sidebar) return;
-            const current = sidebar.querySelector(".sidebar-link-current");
-            if (!current) return;
+        # --- Top に戻るリンク ---
+        index_path = out_root / "index.html"
+        top_href = _rel_href_from(page_dir, index_path)
+        parts.append(
+            f'<div class="sidebar-toplink"><a href="{top_href}">Topに戻る</a></div>'
+        )
 
-            const sidebarRect = sidebar.getBoundingClientRect();
-            const currentRect = current.getBoundingClientRect();
-            const offsetTop   = currentRect.top - sidebarRect.top;
-            const targetScroll =
-                offsetTop - (sidebar.clientHeight / 2) + (current.offsetHeight / 2);
+        if not SIDEBAR_ITEMS:
+            return "\n".join(parts)
 
-            sidebar.scrollTop = targetScroll;
-        })();
+        # ================================
+        # ①：同名タイトルの重複除去
+        #     → (大項目, タイトル) 単位で「最新だけ」残す
+        # ================================
+        latest: dict[tuple[str, str], tuple[list[str], Path]] = {}
+        for chain, pth in SIDEBAR_ITEMS:
+            if len(chain) == 1:
+                group_key = "その他"
+            else:
+                group_key = chain[0]        # 例：ポケモンディレクションレッジ
 
-    })();
-    </script>
-    """
+            title = chain[-1]
+            latest[(group_key, title)] = (chain, pth)
 
+        # ================================
+        # ②：大項目ごとに分類
+        # ================================
+        groups: dict[str, list[tuple[str, str]]] = {}
 
-    # 背景画像（BG_01.png）が見つからなかったときは単色背景にする
-    bg_style = f"background: #f5f5f5 url('{bg_url}') repeat;" if bg_url else "background: #f5f5f5;"
+        for (group_key, title), (_chain, pth) in latest.items():
+            href = _rel_href_from(page_dir, pth)
+            is_empty = pth in SIDEBAR_EMPTY_PAGES
+            groups.setdefault(group_key, []).append((title, href, is_empty))
 
-    full = f"""<!DOCTYPE html>
-    <html lang="ja">
-    <head>
-    <meta charset="utf-8">
-    <title>{title}</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        body {{
-        margin: 0;
-        padding: 0;
-        font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", system-ui, sans-serif;
-        {bg_style}
-        }}
+        # ================================
+        # ②.5：このページ自身の href を計算
+        # ================================
+        current_title = _page_title()
+        current_page_dir = _html_dir_for_page()
+        current_page_path = current_page_dir / f"{sanitize(current_title)}.html"
+        current_href = _rel_href_from(page_dir, current_page_path)
 
-        /* 右上の言語選択バー */
-        .topbar {{
-        position: fixed;
-        top: 0;
-        right: 0;
-        padding: 8px 16px;
-        font-size: 12px;
-        z-index: 2100;
-        background: rgba(255, 255, 255, 0.9);
-        border-bottom-left-radius: 8px;
-        box-shadow: 0 2px 6px rgba(0,0,0,0.15);
-        }}
-        .topbar label {{
-        margin-right: 4px;
-        }}
-        .lang-select {{
-        padding: 2px 4px;
-        font-size: 12px;
-        }}
+        # ================================
+        # ③：サイドバー HTML 出力
+        # ================================
+        # 「その他」が一番下に来るように並び替え
+        ordered_groups = sorted(
+            groups.keys(),
+            key=lambda g: (g == "その他", g) 
+        )
 
-        /* 言語案内モーダル */
-        .lang-help-overlay {{
-        position: fixed;
-        inset: 0;
-        background: rgba(0,0,0,0.45);
-        display: none;
-        align-items: center;
-        justify-content: center;
-        z-index: 2200;
-        }}
-        .lang-help-overlay.is-open {{
-        display: flex;
-        }}
-        .lang-help-modal {{
-        position: relative;
-        background: #ffffff;
-        max-width: 520px;
-        width: 90%;
-        padding: 1.25rem 1.5rem;
-        border-radius: 0.75rem;
-        box-shadow: 0 18px 45px rgba(0,0,0,0.35);
-        font-size: 14px;
-        line-height: 1.5;
-        }}
-        .lang-help-modal h2 {{
-        margin-top: 0;
-        margin-bottom: 0.5rem;
-        font-size: 16px;
-        }}
-        .lang-help-modal p {{
-        margin: 0.4rem 0;
-        }}
-        .lang-help-modal ol {{
-        margin: 0.4rem 0 0.2rem;
-        padding-left: 1.4rem;
-        }}
-        .lang-help-close {{
-        position: absolute;
-        top: 0.35rem;
-        right: 0.5rem;
-        border: none;
-        background: transparent;
-        font-size: 18px;
-        cursor: pointer;
-        }}
+        for group in ordered_groups:
+            parts.append('<div class="sidebar-section">')
+            if pokeball_rel:
+                title_html = (
+                    f'<div class="sidebar-section-title">'
+                    f'<img src="{pokeball_rel}" alt="•" class="sidebar-section-icon">'
+                    f'<span>{group}</span></div>'
+                )
+            else:
+                title_html = (
+                    f'<div class="sidebar-section-title"><span>{group}</span></div>'
+                )
 
-        .layout {{
-        display: flex;
-        min-height: 100vh;
-        }}
+            parts.append(title_html)
 
-        /* サイドバー */
-        .sidebar {{
-        width: 260px;
-        box-sizing: border-box;
-        padding: 16px 12px;
-        background: rgba(255, 255, 255, 0.92);
-        border-right: 1px solid #e5e7eb;
-        overflow-y: auto;
-        position: sticky;
-        top: 0;
-        max-height: 100vh;
-        }}
-        .sidebar-resizer {{
-        width: 5px;
-        cursor: col-resize;
-        background: transparent;
-        }}
-        .sidebar-resizer:hover {{
-        background: rgba(148, 163, 184, 0.4);
-        }}
-        body.resizing-sidebar {{
-        cursor: col-resize;
-        user-select: none;
-        }}
-        .sidebar-title {{
-        display: flex;
-        align-items: center;
-        gap: 6px;
-        font-size: 18px;
-        font-weight: 600;
-        margin-bottom: 8px;
-        }}
-        .sidebar-title-icon {{
-        width: 20px;
-        height: 20px;
-        flex-shrink: 0;
-        }}
-        .sidebar-empty-icon {{
-        width: 24px;
-        height: 24px;
-        margin-right: 4px;
-        vertical-align: text-bottom;
-        }}
-        .sidebar-links a {{
-        display: block;
-        font-size: 14px;
-        padding: 4px 2px;
-        color: #2563eb;
-        text-decoration: none;
-        border-radius: 4px;
-        }}
-        .sidebar-links a:hover {{
-        background: #e5f0ff;
-        }}
-        .sidebar-links a.sidebar-link-current {{
-        background: rgba(248, 113, 113, 0.25);  /* 薄い赤背景 */
-        color: #b91c1c;                          /* 文字も少し濃い赤に */
-        font-weight: 600;
-        }}
+            for label, href, is_empty in sorted(groups[group], key=lambda x: x[0]):
+                cls = "sidebar-link-current" if href == current_href else "sidebar-link"
 
-        /*Topリンクとセクション区切り */
-        .sidebar-toplink {{
-        margin-bottom: 12px;
-        padding-bottom: 8px;
-        border-bottom: 1px solid #e5e7eb;
-        }}
-        .sidebar-toplink a {{
-        font-weight: 600;
-        color: #111827;
-        text-decoration: none;
-        }}
-        .sidebar-toplink a:hover {{
-        text-decoration: underline;
-        }}
-        .sidebar-section {{
-        margin-bottom: 16px;
-        padding-bottom: 8px;
-        border-bottom: 1px solid #e5e7eb;
-        }}
-        .sidebar-section-title {{
-        display: flex;
-        align-items: center;
-        gap: 6px;
-        font-size: 13px;
-        font-weight: 700;
-        color: #6b7280;
-        margin-bottom: 4px;
-        }}
-        .sidebar-section-icon {{
-        width: 16px;
-        height: 16px;
-        flex-shrink: 0;
-        }}
-        .sidebar-section a {{
-        display: block;
-        font-size: 13px;
-        padding: 2px 2px;
-        color: #2563eb;
-        text-decoration: none;
-        border-radius: 3px;
-        }}
-        .sidebar-section a:hover {{
-        background: #e5f0ff;
-        }}
+                icon_html = ""
+                if is_empty and empty_icon_rel:
+                    icon_html = (
+                        f'<img src="{empty_icon_rel}" class="sidebar-empty-icon" '
+                        f'alt="Empty page">'
+                    )
+                parts.append(f'<a href="{href}" class="{cls}">{icon_html}{label}</a>')
 
-        /*ページタイトル用 */
-        .page-header {{
-        margin-bottom: 1.5rem;
-        border-bottom: 1px solid #e5e7eb;
-        padding-bottom: .75rem;
-        }}
-        .page-title {{
-        margin: 0;
-        font-size: 1.6rem;
-        font-weight: 700;
-        }}
+            parts.append("</div>")
 
-        /* 本文側 */
-        .page-container {{
-        flex: 1;
-        display: flex;
-        justify-content: center;
-        box-sizing: border-box;
-        padding: 24px;
-        }}
-        .content-box {{
-        background: #ffffff;
-        max-width: 960px;
-        width: 100%;
-        box-shadow: 0 10px 30px rgba(15,23,42,0.15);
-        border-radius: 8px;
-        padding: 32px 40px 40px;
-        box-sizing: border-box;
-        }}
-        .content-box h1,
-        .content-box h2,
-        .content-box h3 {{
-        margin-top: 1.6em;
-        }}
-        .content-box p {{
-        line-height: 1.8;
-        margin: 0.5em 0;
-        }}
-        .content-box ul,
-        .content-box ol {{
-        padding-left: 1.6em;
-        }}
+        return "\n".join(parts)
 
-        /* テーブル（Confluence の表） */
-        .content-box table,
-        .content-box table.confluenceTable {{
-        border-collapse: collapse;
-        border-spacing: 0;
-        width: 100%;
-        margin: 0.75rem 0;
-        font-size: 14px;
-        }}
+    # マニフェスト方式：共有 _sidebar.js がこのページ位置を基準にリンクを描画する
+    def _sidebar_manifest_loader_html() -> str:
+        index_path = out_root / "index.html"
+        top_href = _rel_href_from(page_dir, index_path)
+        root_rel = _rel_href_from(page_dir, html_root)
+        current_path = _html_dir_for_page() / f"{sanitize(_page_title())}.html"
+        current_rel = _quote_href_path(os.path.relpath(current_path, html_root).replace("\\", "/"))
+        return (
+            f'<div class="sidebar-toplink"><a href="{top_href}">Topに戻る</a></div>\n'
+            f'<script src="{_rel_href_from(page_dir, sidebar_manifest)}"'
+            f' data-root="{root_rel + "/" if root_rel else ""}" data-current="{current_rel}"'
+            f' data-pokeball="{pokeball_rel}" data-empty-icon="{empty_icon_rel}"></script>'
+        )
 
-        .content-box th,
-        .content-box td,
-        .content-box table.confluenceTable th,
-        .content-box table.confluenceTable td {{
-        border: 1px solid #e5e7eb;
-        padding: 4px 8px;
-        vertical-align: top;
-        }}
+    if sidebar_manifest is not None:
+        sidebar_links_html = _sidebar_manifest_loader_html()
+    else:
+        sidebar_links_html = _generate_sidebar_links_for_current_page()
 
-        .content-box thead th,
-        .content-box table.confluenceTable thead th {{
-        background: #f9fafb;
-        font-weight: 600;
-        }}
+    # ライトボックス本体
+    lightbox_html = """
+    <div id="lightbox">
+        <div class="lb-inner">
+        <img src="" alt="">
+        </div>
+    </div>
+    """
 
-        .footer {{
-        margin-top: 2rem;
-        font-size: 13px;
-        color: #4b5563;
-        border-top: 1px solid #e5e7eb;
-        padding-top: 0.75rem;
-        }}
+    # ライトボックス用スクリプト＋言語案内モーダル
+    if static_assets is not None:
+        script_html = f"""
+    <script src="{_rel_href_from(page_dir, static_assets['js'])}"></script>
+    """
+    else:
+        script_html = f"""
+    <script>
+{_PAGE_SCRIPT_JS}{_SEARCH_JS if search_index is not None else ""}    </script>
+    """
 
-        .confluence-image img {{
-        max-width: 100%;
-        height: auto;
-        }}
 
-        /* 画像クリック時のライトボックス */
-        #lightbox {{
-            position: fixed;
-            inset: 0;
-            background: rgba(0,0,0,0.75);
-            display: none;
-            align-items: center;
-            justify-content: center;
-            z-index: 3000;
-        }}
+    # ページ共通 CSS：static 方式では <link> で参照（背景画像はページ毎に相対パスが変わるので埋め込みのまま）
+    if static_assets is not None:
+        page_css = ""
+        css_link = f'    <link rel="stylesheet" href="{_rel_href_from(page_dir, static_assets["css"])}">\n'
+    else:
+        page_css = _PAGE_CSS + (_SEARCH_CSS if search_index is not None else "")
+        css_link = ""
+
+    # 全文検索窓：_search/ のインデックスをこのページの位置から相対で読み込む
+    search_html = ""
+    if search_index is not None:
+        root_rel = _rel_href_from(page_dir, html_root)
+        search_html = (
+            f'<div id="klefki-search" class="klefki-search" role="search"'
+            f' data-base="{_rel_href_from(page_dir, search_index.parent)}/"'
+            f' data-root="{root_rel + "/" if root_rel else ""}">'
+            f'<input type="search" placeholder="ページを検索" aria-label="ページを検索" autocomplete="off">'
+            f'<div class="klefki-search-results"></div></div>\n        '
+        )
 
-        /* open クラスが付与されたときだけ表示 */
-        #lightbox.open {{
-            display: flex;
-        }}
+    # 版履歴：_history/index.html#<ページID> へのリンク（旧版のあるページだけ）
+    history_html = ""
+    if history_href:
+        history_html = f'<a class="klefki-history" href="{history_href}" style="margin-right: 12px;">履歴</a>\n        '
 
-        /* 画像の最大サイズを画面内に収める（重要） */
-        #lightbox img {{
-            max-width: 90vw;
-            max-height: 90vh;
-            object-fit: contain;
-            border-radius: 8px;
-            box-shadow: 0 0 20px rgba(0,0,0,0.4);
-        }}
-        
-        /* 動画/音声のサイズ調整 */
-        .content-box video,
-        .content-box audio {{
-            max-width: 100%;
-            height: auto;
-            display: block;
-            margin: .5rem 0;
-        }}
-        
-        /* === ページ最下部 トップに戻る === */
-        #backToTop{{
-            position: fixed;
-            right: max(16px, env(safe-area-inset-right));
-            bottom: max(16px, env(safe-area-inset-bottom));
-            width: 88px;        /* 画像サイズに合わせて調整 */
-            height: 88px;
-            z-index: 10030;     /* ヘッダやモーダルより手前/奥は環境に合わせ微調整 */
-            transform: translateY(140%);
-            opacity: 0;
-            transition: transform .35s ease, opacity .35s ease;
-            cursor: pointer;
-            user-select: none;
-            -webkit-tap-highlight-color: transparent;
-            }}
-        #backToTop.show{{
-            transform: translateY(0);
-            opacity: 1;
-            }}
-        #backToTop img{{
-            display:block;
-            width:100%;
-            height:auto;
-            filter: drop-shadow(0 2px 4px rgba(0,0,0,.35));
-            }}
-        #backToTop:focus-visible{{
-            outline: 3px solid #3b82f6; /* アクセシビリティ */
-            border-radius: 10px;
-            }}
-        /* ページ末尾監視用のダミー要素（高さ0でOK） */
-            #scrollSentinel{{ width:1px; height:1px; }}
+    # 背景画像（BG_01.png）が見つからなかったときは単色背景にする
+    bg_style = f"background: #f5f5f5 url('{bg_url}') repeat;" if bg_url else "background: #f5f5f5;"
 
+    full = f"""<!DOCTYPE html>
+    <html lang="ja">
+    <head>
+    <meta charset="utf-8">
+    <title>{title}</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <style>
+        body {{
+        margin: 0;
+        padding: 0;
+        font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", system-ui, sans-serif;
+        {bg_style}
+        }}
 
-    </style>
-    </head>
+{page_css}    </style>
+{css_link}    </head>
 
 <body>
     <!-- 右上の言語選択プルダウン -->
     <div class="topbar">
-        <label for="lang-select">Language:</label>
+        {history_html}{search_html}<label for="lang-select">Language:</label>
         <select id="lang-select" class="lang-select">
             <option value="ja">日本語</option>
             <option value="en">English</option>
@@ -1925,35 +3310,10 @@ def _html_to_plaintext(html: str) -> str:
     text = re.sub(r"<[^>]+>", "", text)
     return re.sub(r"\n{3,}", "\n\n", text).strip()
 
-def _parse_pages_parent_from_entities_xml_bytes(ent_bytes: bytes):
-    import xml.etree.ElementTree as ET
-    pages = {}; body_html = {}
-    root = ET.fromstring(ent_bytes)
-
-    def pick(parent, paths):
-        for p in paths:
-            el = parent.find(p)
-            if el is not None and (el.text or "").strip():
-                return el.text.strip()
-        return ""
-
-    for obj in root.findall(".//object[@class='Page']"):
-        pid   = pick(obj, ["id[@name='id']", "property[@name='id']"])
-        title = pick(obj, ["property[@name='title']"])
-        par   = ""
-        par_prop = obj.find("property[@name='parent']")
-        if par_prop is not None:
-            par = pick(par_prop, ["id[@name='id']", "property[@name='id']"])
-        if pid:
-            pages[pid] = {"title": title or f"page_{pid}", "parentId": par}
-
-    for obj in root.findall(".//object[@class='BodyContent']"):
-        page_id = pick(obj, ["property[@name='content']/id[@name='id']"])
-        html = pick(obj, ["property[@name='body']"])
-        if page_id and html:
-            body_html[page_id] = html
-
-    return pages, body_html
+def _parse_pages_parent_from_entities_xml_bytes(ent_bytes):
+    # ent_bytes は bytes / パス / ファイルオブジェクト（parse_entities_stream と同じ）
+    ent = parse_entities_stream(ent_bytes)
+    return ent["pages"], ent["bodies"]
 
 def _collect_pages_parent_from_pages_dir(pages_dir: Path):
     import xml.etree.ElementTree as ET
@@ -1997,35 +3357,10 @@ def _dir_for_titles(dst_root: Path, titles: list[str]) -> tuple[Path, str]:
     page_dir.mkdir(parents=True, exist_ok=True)
     return page_dir, page_title
 
-def _parse_pages_and_bodies_from_entities_bytes(ent_bytes: bytes):
+def _parse_pages_and_bodies_from_entities_bytes(ent_bytes):
     """entities.xml から {pid: {title,parentId}}, {pid: body_html} を返す"""
-    import xml.etree.ElementTree as ET
-    pages, bodies = {}, {}
-    root = ET.fromstring(ent_bytes)
-
-    def pick(parent, paths):
-        for p in paths:
-            el = parent.find(p)
-            if el is not None and (el.text or "").strip():
-                return el.text.strip()
-        return ""
-
-    for obj in root.findall(".//object[@class='Page']"):
-        pid   = pick(obj, ["id[@name='id']", "property[@name='id']"])
-        title = pick(obj, ["property[@name='title']"])
-        parentId = ""
-        par = obj.find("property[@name='parent']")
-        if par is not None:
-            parentId = pick(par, ["id[@name='id']", "property[@name='id']"])
-        if pid:
-            pages[pid] = {"title": title or f"page_{pid}", "parentId": parentId}
-
-    for obj in root.findall(".//object[@class='BodyContent']"):
-        pid  = pick(obj, ["property[@name='content']/id[@name='id']"])
-        html = pick(obj, ["property[@name='body']"])
-        if pid and html:
-            bodies[pid] = html
-    return pages, bodies
+    ent = parse_entities_stream(ent_bytes)
+    return ent["pages"], ent["bodies"]
 
 def _build_chain(pid: str, pages_map: dict) -> list[str]:
     chain, seen, cur = [], set(), pid
@@ -2047,6 +3382,43 @@ def _dir_for_chain(dst_root: Path, chain: list[str]) -> tuple[Path, str]:
     page_dir.mkdir(parents=True, exist_ok=True)
     return page_dir, title
 
+class PageLinkIndex:
+    """
+    ri:page リンクの解決用インデックス（(スペースキー, タイトル) → 出力する HTML のパス）．
+    描画するページ（同じ出力パスの勝者）から1回だけ作り，全ページの描画で共有する（ワーカーへは ctx で渡す）．
+    スペースキーの無いリンクは参照元ページのスペースで引き，無ければ他のスペースの同名ページを使う．
+    """
+    def __init__(self):
+        self.by_key: dict[tuple[str, str], Path] = {}
+        self.by_title: dict[str, Path] = {}
+        self.space_of: dict[str, str] = {}   # ページID → スペースキー
+
+    def add(self, page_id: str, space_key: str, title: str, path: Path) -> None:
+        # 同じキーは先に登録した方を優先する
+        title = title.strip()
+        self.space_of[page_id] = space_key
+        self.by_key.setdefault((space_key, title), path)
+        self.by_title.setdefault(title, path)
+
+    def lookup(self, title: str, space_key: str = "", page_id: str | None = None) -> Path | None:
+        title = title.strip()
+        if space_key:
+            return self.by_key.get((space_key, title))
+        own = self.space_of.get(page_id) if page_id is not None else None
+        hit = self.by_key.get((own, title)) if own is not None else None
+        return hit if hit is not None else self.by_title.get(title)
+
+def build_page_link_index(page_entries: list[tuple], pages_map: dict, spaces: dict,
+                          index: PageLinkIndex | None = None) -> PageLinkIndex:
+    # page_entries: [(page_id, チェイン, 出力フォルダ, ファイル名)]．スペースキーは spaces（スペースID → キー）で引く
+    # index を渡すとそこへ追加する（サイト変換で全スペース分を1つの索引にまとめる時）
+    index = index if index is not None else PageLinkIndex()
+    for pid, chain, page_dir, page_title in page_entries:
+        meta = pages_map.get(pid, {})
+        sid = meta.get("spaceId") or ""
+        index.add(pid, spaces.get(sid, sid), meta.get("title") or page_title, page_dir / f"{page_title}.html")
+    return index
+
 def _write_index_html(index_root: Path, html_root: Path, pages_map: dict, link_prefix: str = ""):
     # インデックス用ページの処理
     # --- 親→子 ---
@@ -2252,16 +3624,790 @@ def _step_progress(start: float, end: float, index: int, total: int, progress_cb
     value = start + (end - start) * ratio
     progress_cb(value)   
 
-def generate_html_from_xml_root(input_path: Path, out_html_root: Path, out_root: Path, log_box, progress_cb=None):
+_SIDEBAR_MANIFEST_JS = r"""
+(function () {
+    var s = document.currentScript;
+    if (!s) return;
+    var root = s.getAttribute("data-root") || "";
+    var current = s.getAttribute("data-current") || "";
+    var pokeball = s.getAttribute("data-pokeball") || "";
+    var emptyIcon = s.getAttribute("data-empty-icon") || "";
+
+    function esc(t) {
+        return String(t).replace(/&/g, "&amp;").replace(/</g, "&lt;")
+                        .replace(/>/g, "&gt;").replace(/"/g, "&quot;");
+    }
+
+    var parts = [];
+    GROUPS.forEach(function (g) {
+        parts.push('<div class="sidebar-section">');
+        if (pokeball) {
+            parts.push('<div class="sidebar-section-title"><img src="' + esc(pokeball) +
+                       '" alt="•" class="sidebar-section-icon"><span>' + esc(g.title) + '</span></div>');
+        } else {
+            parts.push('<div class="sidebar-section-title"><span>' + esc(g.title) + '</span></div>');
+        }
+        g.items.forEach(function (it) {
+            var cls = (it[1] === current) ? "sidebar-link-current" : "sidebar-link";
+            var icon = (it[2] && emptyIcon)
+                ? '<img src="' + esc(emptyIcon) + '" class="sidebar-empty-icon" alt="Empty page">' : "";
+            parts.push('<a href="' + esc(root + it[1]) + '" class="' + cls + '">' + icon + esc(it[0]) + '</a>');
+        });
+        parts.push("</div>");
+    });
+    s.insertAdjacentHTML("afterend", parts.join("\n"));
+})();
+"""
+
+def _write_sidebar_manifest(html_root: Path) -> Path:
+    """
+    サイドバーの全リンクを html_root/_sidebar.js に1回だけ書き出す．
+    各ページは <script src> でこれを読み込み，自分の位置からの相対リンクをブラウザ側で組み立てる．
+    （file:// では JSON を fetch できないため JS として出力）
+    """
+    # 同名タイトルの重複除去 → (大項目, タイトル) 単位で「最新だけ」残す（inline 方式と同じ規則）
+    latest: dict[tuple[str, str], Path] = {}
+    for chain, pth in SIDEBAR_ITEMS:
+        group_key = "その他" if len(chain) == 1 else chain[0]
+        latest[(group_key, chain[-1])] = pth
+
+    groups: dict[str, list] = {}
+    for (group_key, title), pth in latest.items():
+        rel = _quote_href_path(os.path.relpath(pth, html_root).replace("\\", "/"))
+        groups.setdefault(group_key, []).append([title, rel, pth in SIDEBAR_EMPTY_PAGES])
+
+    ordered = sorted(groups.keys(), key=lambda g: (g == "その他", g))
+    data = [{"title": g, "items": sorted(groups[g], key=lambda x: x[0])} for g in ordered]
+
+    manifest = html_root / SIDEBAR_MANIFEST_NAME
+    groups_js = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    manifest.write_text(
+        "(function () {\nvar GROUPS = " + groups_js + ";\n" + _SIDEBAR_MANIFEST_JS.strip() + "\n})();\n",
+        encoding="utf-8")
+    return manifest
+
+# ---------- 全文検索インデックス ----------
+# 語（英数字の単語／日本語などの CJK は1文字＝unigram と2文字ずつ＝bigram）→ ページ番号 の転置インデックスを
+# 語のハッシュでシャードに分けて html_pages/_search/ に書き出し，各ページ右上の検索窓から file:// のまま引く．
+# 検索語の分割はブラウザ側で，CJK が1文字だけの時は unigram，2文字以上なら bigram だけで引く．
+# 分割規則（_search_tokens / _search_shard）はブラウザ側の _SEARCH_JS と一致させること．
+_SEARCH_CJK = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_SEARCH_WORD = r"0-9a-z\u00c0-\u024f\u0370-\u03ff\u0400-\u04ff"
+_SEARCH_TOKEN_RE = re.compile(f"([{_SEARCH_CJK}]+)|([{_SEARCH_WORD}]+)")
+_SEARCH_TAG_RE = re.compile(r"<[^>]*>")
+
+def _search_tokens(text: str) -> list[str]:
+    # NFKC → 小文字化して，CJK の連続は1文字ずつ（1文字の検索用）と bigram，英数字は2文字以上の単語
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = []
+    for cjk, word in _SEARCH_TOKEN_RE.findall(text):
+        if cjk:
+            tokens.extend(cjk)
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        elif len(word) >= 2:
+            tokens.append(word[:SEARCH_MAX_TOKEN_LEN])
+    return tokens
+
+def _search_terms(title: str, storage_html: str) -> dict[str, int]:
+    # 1ページ分の 検索語 → 重み（本文中の出現数，タイトルに含まれる語は SEARCH_TITLE_WEIGHT を加算）
+    body = (storage_html or "").replace("<![CDATA[", " ").replace("]]>", " ")
+    body = html.unescape(_SEARCH_TAG_RE.sub(" ", body))
+    weights: dict[str, int] = {}
+    for token in _search_tokens(body):
+        weights[token] = weights.get(token, 0) + 1
+    for token in weights:
+        weights[token] = min(weights[token], SEARCH_TITLE_WEIGHT - 1)
+    for token in set(_search_tokens(title)):
+        weights[token] = weights.get(token, 0) + SEARCH_TITLE_WEIGHT
+    return weights
+
+def _search_shard(token: str, shards: int) -> int:
+    h = 0
+    for ch in token:
+        h = (h * 31 + ord(ch)) & 0xFFFFFFFF
+    return h % shards
+
+def _search_js_assign(name: str, obj) -> str:
+    data = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    data = data.replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+    return f'(window.KLEFKI_SEARCH=window.KLEFKI_SEARCH||{{}})["{name}"]={data};\n'
+
+def _write_search_index(html_root: Path, docs: list[tuple]) -> Path:
+    """
+    全文検索インデックスを html_root/_search/ に書き出す（meta.js と語のハッシュで分けた sNNN.js）．
+    docs: [(タイトル, HTML のパス, チェイン, 検索語→重み)]．ポスティングは [ページ番号の差分, 重み, ...]．
+    ページは検索語のシャードだけを <script> で読み込む（file:// では JSON を fetch できないため JS として出力）．
+    """
+    search_dir = html_root / SEARCH_DIR_NAME
+    search_dir.mkdir(parents=True, exist_ok=True)
+
+    pages = []
+    postings: dict[str, list[int]] = defaultdict(list)
+    last_doc: dict[str, int] = {}
+    for doc, (title, path, chain, terms) in enumerate(docs):
+        rel = _quote_href_path(os.path.relpath(path, html_root).replace("\\", "/"))
+        pages.append([title, rel, " / ".join(chain[:-1])])
+        for token, weight in terms.items():
+            postings[token].extend((doc - last_doc.get(token, 0), weight))
+            last_doc[token] = doc
+
+    total = sum(len(p) for p in postings.values()) // 2
+    shards = max(1, min(SEARCH_MAX_SHARDS, -(-total // SEARCH_SHARD_POSTINGS)))
+    buckets: list[dict] = [{} for _ in range(shards)]
+    for token in sorted(postings):
+        buckets[_search_shard(token, shards)][token] = postings[token]
+
+    written = set()
+    for name, obj in [("meta", {"shards": shards, "pages": pages})] + \
+                     [(f"s{i:03d}", bucket) for i, bucket in enumerate(buckets)]:
+        (search_dir / f"{name}.js").write_text(_search_js_assign(name, obj), encoding="utf-8")
+        written.add(f"{name}.js")
+    # シャード数が減った時の古いシャードを削除
+    for old in search_dir.glob("*.js"):
+        if old.name not in written:
+            _unlink_quiet(old)
+    return search_dir / "meta.js"
+
+_SEARCH_JS = r"""
+    // --- 全文検索（html_pages/_search/ のインデックスを必要なシャードだけ読み込む） ---
+    (function () {
+        const box = document.getElementById("klefki-search");
+        if (!box) return;
+        const input = box.querySelector("input");
+        const panel = box.querySelector(".klefki-search-results");
+        const base  = box.getAttribute("data-base") || "";
+        const root  = box.getAttribute("data-root") || "";
+        const MAX_RESULTS = 50;
+        const TOKEN_RE = /([__CJK__]+)|([__WORD__]+)/g;
+        const S = window.KLEFKI_SEARCH = window.KLEFKI_SEARCH || {};
+        const loading = {};
+        let serial = 0;
+        let timer = null;
+
+        // 索引は CJK の1文字と bigram の両方を持つ．1文字の検索はそのまま，2文字以上は bigram で引く
+        function tokenize(text) {
+            const s = String(text).normalize("NFKC").toLowerCase();
+            const out = [];
+            let m;
+            TOKEN_RE.lastIndex = 0;
+            while ((m = TOKEN_RE.exec(s)) !== null) {
+                if (m[1]) {
+                    const r = m[1];
+                    if (r.length === 1) out.push(r);
+                    else for (let i = 0; i < r.length - 1; i++) out.push(r.substr(i, 2));
+                } else if (m[2].length >= 2) {
+                    out.push(m[2].slice(0, __MAXLEN__));
+                }
+            }
+            return Array.from(new Set(out));
+        }
+
+        function shardOf(token, shards) {
+            let h = 0;
+            for (const ch of token) h = (Math.imul(h, 31) + ch.codePointAt(0)) >>> 0;
+            return h % shards;
+        }
+
+        function load(name) {
+            if (S[name]) return Promise.resolve(S[name]);
+            if (!loading[name]) {
+                loading[name] = new Promise(function (resolve) {
+                    const el = document.createElement("script");
+                    el.src = base + name + ".js";
+                    el.onload  = function () { resolve(S[name] || null); };
+                    el.onerror = function () { resolve(null); };
+                    document.head.appendChild(el);
+                });
+            }
+            return loading[name];
+        }
+
+        function esc(t) {
+            return String(t).replace(/&/g, "&amp;").replace(/</g, "&lt;")
+                            .replace(/>/g, "&gt;").replace(/"/g, "&quot;");
+        }
+
+        function show(html) {
+            panel.innerHTML = html;
+            panel.classList.toggle("open", html !== "");
+        }
+
+        function search(q) {
+            const tokens = tokenize(q);
+            const seq = ++serial;
+            if (!tokens.length) { show(""); return; }
+            load("meta").then(function (meta) {
+                if (seq !== serial) return;
+                if (!meta) { show('<div class="klefki-search-note">検索インデックスがありません</div>'); return; }
+                const names = tokens.map(function (t) {
+                    return "s" + ("00" + shardOf(t, meta.shards)).slice(-3);
+                });
+                return Promise.all(names.map(load)).then(function (shards) {
+                    if (seq !== serial) return;
+                    // 全語を含むページだけ残し，重みの合計で並べる
+                    let scores = null;
+                    tokens.forEach(function (t, i) {
+                        const shard = shards[i] || {};
+                        const post = Object.prototype.hasOwnProperty.call(shard, t) ? shard[t] : [];
+                        const next = new Map();
+                        let doc = 0;
+                        for (let k = 0; k < post.length; k += 2) {
+                            doc += post[k];
+                            if (scores === null) next.set(doc, post[k + 1]);
+                            else if (scores.has(doc)) next.set(doc, scores.get(doc) + post[k + 1]);
+                        }
+                        scores = next;
+                    });
+                    const hits = Array.from(scores.keys()).sort(function (a, b) {
+                        return scores.get(b) - scores.get(a) || a - b;
+                    });
+                    if (!hits.length) { show('<div class="klefki-search-note">該当なし</div>'); return; }
+                    const rows = hits.slice(0, MAX_RESULTS).map(function (d) {
+                        const p = meta.pages[d];
+                        return '<a href="' + esc(root + p[1]) + '"><span class="klefki-search-title">' + esc(p[0]) +
+                               '</span>' + (p[2] ? '<span class="klefki-search-path">' + esc(p[2]) + '</span>' : '') + '</a>';
+                    });
+                    show('<div class="klefki-search-note">' + hits.length + ' 件</div>' + rows.join(""));
+                });
+            });
+        }
+
+        input.addEventListener("input", function () {
+            clearTimeout(timer);
+            timer = setTimeout(function () { search(input.value); }, 150);
+        });
+        input.addEventListener("keydown", function (ev) {
+            if (ev.key === "Enter") {
+                const first = panel.querySelector("a");
+                if (first) window.location.href = first.getAttribute("href");
+            } else if (ev.key === "Escape") {
+                show("");
+                input.blur();
+            }
+        });
+        document.addEventListener("click", function (ev) {
+            if (!box.contains(ev.target)) show("");
+        });
+    })();
+""".replace("__CJK__", _SEARCH_CJK).replace("__WORD__", _SEARCH_WORD).replace("__MAXLEN__", str(SEARCH_MAX_TOKEN_LEN))
+
+_SEARCH_CSS = """
+        /* 全文検索（右上のバー） */
+        .klefki-search {
+        position: relative;
+        display: inline-block;
+        margin-right: 12px;
+        }
+        .klefki-search input {
+        width: 220px;
+        padding: 2px 6px;
+        font-size: 12px;
+        }
+        .klefki-search-results {
+        display: none;
+        position: absolute;
+        right: 0;
+        top: calc(100% + 6px);
+        width: 360px;
+        max-height: 60vh;
+        overflow-y: auto;
+        background: #ffffff;
+        border-radius: 6px;
+        box-shadow: 0 6px 18px rgba(0,0,0,0.22);
+        text-align: left;
+        }
+        .klefki-search-results.open {
+        display: block;
+        }
+        .klefki-search-results a {
+        display: block;
+        padding: 6px 10px;
+        color: #1f2937;
+        text-decoration: none;
+        border-top: 1px solid #f1f5f9;
+        }
+        .klefki-search-results a:hover {
+        background: #e5f0ff;
+        }
+        .klefki-search-title {
+        display: block;
+        font-weight: 600;
+        }
+        .klefki-search-path {
+        display: block;
+        color: #6b7280;
+        font-size: 11px;
+        }
+        .klefki-search-note {
+        padding: 6px 10px;
+        color: #6b7280;
+        }
+"""
+
+# ---------- ページの版履歴（最新版の全文＋旧版への差分） ----------
+_HISTORY_CDATA_RE = re.compile(r"<!\[CDATA\[(.*?)\]\]>", re.S)
+_HISTORY_BREAK_RE = re.compile(r"<\s*(?:br|/p|/h[1-6]|/li|/tr|/div|/pre|/blockquote|/ac:parameter|/ac:plain-text-body)\b[^>]*>", re.I)
+_HISTORY_CELL_RE = re.compile(r"<\s*/t[dh]\s*>", re.I)
+_HISTORY_TAG_RE = re.compile(r"<[^>]*>")
+
+def _history_lines(storage_html: str) -> list[str]:
+    # 版どうしを比べるための本文テキスト（段落・改行・リスト項目ごとに1行，表のセルは " | " 区切り，空行は除く）
+    text = _HISTORY_CDATA_RE.sub(lambda m: html.escape(m.group(1), quote=False), storage_html or "")
+    text = _HISTORY_CELL_RE.sub(" | ", _HISTORY_BREAK_RE.sub("\n", text))
+    text = html.unescape(_HISTORY_TAG_RE.sub("", text))
+    return [ln.strip() for ln in text.splitlines() if ln.strip()]
+
+def _history_delta(src: list[str], dst: list[str]) -> list:
+    # src（新しい版）の行から dst（1つ古い版）を作る差分．
+    # 正の数 = src の行をそのまま n 行，負の数 = src を n 行飛ばす，文字列のリスト = その行を挿入．
+    # 置き換えは 挿入 → 飛ばす の順に並べる（閲覧ページでは 削除行 → 追加行 の順に表示される）
+    import difflib
+    ops: list = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, src, dst, autojunk=False).get_opcodes():
+        if tag == "equal":
+            ops.append(i2 - i1)
+            continue
+        if j2 > j1:
+            ops.append(dst[j1:j2])
+        if i2 > i1:
+            ops.append(i1 - i2)
+    return ops
+
+def _history_js_assign(page_id: str, obj) -> str:
+    data = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    data = data.replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+    return f'(window.KLEFKI_HISTORY=window.KLEFKI_HISTORY||{{}})[{json.dumps(page_id)}]={data};\n'
+
+def _history_task(task: list[tuple]) -> list[tuple]:
+    # task: [(page_id, タイトル, 閲覧ページからの相対 href, [(版, 更新日時, storage_html) 新しい順], 出力パス), ...]
+    # 1ページずつ差分を作って <page_id>.js を書き出し，(page_id, 版数, 全版を全文で持った場合のバイト数, 書いたバイト数) を返す
+    results = []
+    for pid, title, page_href, versions, path in task:
+        texts = [_history_lines(body) for _ver, _modified, body in versions]
+        data = {"title": title, "page": page_href,
+                "versions": [[ver, modified] for ver, modified, _body in versions],
+                "base": texts[0]}
+        full = len(_history_js_assign(pid, {**data, "texts": texts[1:]}).encode("utf-8"))
+        data["deltas"] = [_history_delta(texts[i], texts[i + 1]) for i in range(len(texts) - 1)]
+        raw = _history_js_assign(pid, data).encode("utf-8")
+        path.write_bytes(raw)
+        results.append((pid, len(versions), full, len(raw)))
+    return results
+
+def _write_page_history(html_root: Path, entries: list[tuple], workers: int = 1) -> tuple[int, int, int, int]:
+    """
+    ページの版履歴を html_root/_history/ に書き出す（ページごとの <page_id>.js と共通の閲覧ページ index.html）．
+    entries: [(page_id, タイトル, HTML のパス, [(版, 更新日時, storage_html) 新しい順])]．
+    各版は本文テキストの行にして，最新版だけ全文・旧版は1つ新しい版からの差分で持つ（版の復元と差分表示はブラウザ側）．
+    差分の計算は workers>1 かつ PARALLEL_MIN_PAGES ページ以上ならプロセスプールで行う．
+    戻り値: (ページ数, 版数, 全版を全文で持った場合のバイト数, 書き出したバイト数)
+    """
+    hist_dir = html_root / HISTORY_DIR_NAME
+    hist_dir.mkdir(parents=True, exist_ok=True)
+    viewer = hist_dir / "index.html"
+    viewer.write_text(_HISTORY_VIEWER_HTML, encoding="utf-8")
+
+    tasks = [(pid, title, _quote_href_path(os.path.relpath(path, hist_dir).replace("\\", "/")), versions,
+              hist_dir / f"{pid}.js") for pid, title, path, versions in entries]
+    if workers > 1 and len(tasks) >= PARALLEL_MIN_PAGES:
+        chunk = max(1, min(32, len(tasks) // (workers * 8) or 1))
+        with _process_pool(workers) as ex:
+            results = [r for part in ex.map(_history_task, [tasks[i:i + chunk] for i in range(0, len(tasks), chunk)])
+                       for r in part]
+    else:
+        results = _history_task(tasks)
+
+    # 履歴の無くなったページの古いファイルを削除
+    written = {viewer.name} | {path.name for *_rest, path in tasks}
+    for old in hist_dir.glob("*.js"):
+        if old.name not in written:
+            _unlink_quiet(old)
+    return len(results), sum(r[1] for r in results), sum(r[2] for r in results), sum(r[3] for r in results)
+
+_HISTORY_VIEWER_HTML = """<!DOCTYPE html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<title>版履歴</title>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<style>
+    body {
+    margin: 0;
+    font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", system-ui, sans-serif;
+    background: #f5f5f5;
+    color: #1f2937;
+    }
+    header {
+    padding: 12px 20px;
+    background: #ffffff;
+    box-shadow: 0 2px 6px rgba(0,0,0,0.12);
+    }
+    header h1 {
+    margin: 4px 0 0;
+    font-size: 18px;
+    }
+    .wrap {
+    display: flex;
+    gap: 16px;
+    padding: 16px 20px;
+    }
+    #versions {
+    flex: 0 0 240px;
+    margin: 0;
+    padding: 0;
+    list-style: none;
+    }
+    #versions li {
+    padding: 6px 10px;
+    margin-bottom: 4px;
+    background: #ffffff;
+    border-radius: 6px;
+    cursor: pointer;
+    font-size: 13px;
+    }
+    #versions li.current {
+    background: #e5f0ff;
+    font-weight: bold;
+    }
+    #view {
+    flex: 1;
+    min-width: 0;
+    }
+    .tabs button {
+    margin-right: 6px;
+    padding: 4px 12px;
+    }
+    .tabs button.current {
+    font-weight: bold;
+    }
+    #out {
+    margin-top: 10px;
+    padding: 10px;
+    background: #ffffff;
+    border-radius: 6px;
+    font-family: Consolas, Menlo, monospace;
+    font-size: 13px;
+    white-space: pre-wrap;
+    word-break: break-word;
+    }
+    #out .add { background: #e6ffec; }
+    #out .del { background: #ffebe9; text-decoration: line-through; }
+    #out .skip { color: #6b7280; font-style: italic; }
+</style>
+</head>
+<body>
+<header>
+    <a id="back" href="#">← ページに戻る</a>
+    <h1 id="title">版履歴</h1>
+</header>
+<div class="wrap">
+    <ol id="versions"></ol>
+    <div id="view">
+        <div class="tabs"><button data-mode="diff">1つ前の版との差分</button><button data-mode="full">全文</button></div>
+        <div id="out"></div>
+    </div>
+</div>
+<script>
+    // --- 版履歴（<page_id>.js の最新版＋差分から，選んだ版だけをその場で復元して表示） ---
+    (function () {
+        const H = window.KLEFKI_HISTORY = window.KLEFKI_HISTORY || {};
+        const CONTEXT = 3;
+        const list = document.getElementById("versions");
+        const out = document.getElementById("out");
+        let data = null, texts = [], selected = 0, mode = "diff";
+
+        function load(id) {
+            if (H[id]) return Promise.resolve(H[id]);
+            return new Promise(function (resolve) {
+                const el = document.createElement("script");
+                el.src = encodeURIComponent(id) + ".js";
+                el.onload  = function () { resolve(H[id] || null); };
+                el.onerror = function () { resolve(null); };
+                document.head.appendChild(el);
+            });
+        }
+
+        // 差分 ops を新しい版の行に当てて1つ古い版の行を作る
+        function apply(src, ops) {
+            const dst = [];
+            let i = 0;
+            for (const op of ops) {
+                if (typeof op !== "number") { for (const line of op) dst.push(line); }
+                else if (op > 0) { for (let k = 0; k < op; k++) dst.push(src[i + k]); i += op; }
+                else i -= op;
+            }
+            return dst;
+        }
+
+        function text(k) {
+            for (let j = texts.length; j <= k; j++) texts.push(apply(texts[j - 1], data.deltas[j - 1]));
+            return texts[k];
+        }
+
+        function row(cls, line) {
+            const div = document.createElement("div");
+            if (cls) div.className = cls;
+            div.textContent = line === "" ? " " : line;
+            out.appendChild(div);
+        }
+
+        // 版 k と1つ古い版 k+1 の差分（ops は版 k → 版 k+1 の変換なので，挿入=削除行・飛ばす=追加行）
+        function showDiff(k) {
+            const src = text(k);
+            if (k + 1 >= data.versions.length) {
+                src.forEach(function (line) { row("add", line); });
+                return;
+            }
+            const ops = data.deltas[k];
+            let i = 0;
+            ops.forEach(function (op, idx) {
+                if (typeof op !== "number") { op.forEach(function (line) { row("del", line); }); }
+                else if (op < 0) { for (let n = 0; n < -op; n++) row("add", src[i + n]); i -= op; }
+                else {
+                    // 変更の無い行は前後 CONTEXT 行だけ残して畳む
+                    const head = i > 0 ? CONTEXT : 0, tail = idx < ops.length - 1 ? CONTEXT : 0;
+                    if (op > head + tail + 1) {
+                        for (let n = 0; n < head; n++) row("", src[i + n]);
+                        row("skip", "… " + (op - head - tail) + " 行 変更なし …");
+                        for (let n = op - tail; n < op; n++) row("", src[i + n]);
+                    } else {
+                        for (let n = 0; n < op; n++) row("", src[i + n]);
+                    }
+                    i += op;
+                }
+            });
+        }
+
+        function render() {
+            Array.prototype.forEach.call(list.children, function (li, k) {
+                li.classList.toggle("current", k === selected);
+            });
+            document.querySelectorAll(".tabs button").forEach(function (b) {
+                b.classList.toggle("current", b.getAttribute("data-mode") === mode);
+            });
+            out.textContent = "";
+            if (mode === "full") text(selected).forEach(function (line) { row("", line); });
+            else showDiff(selected);
+        }
+
+        function init() {
+            const id = decodeURIComponent(location.hash.slice(1));
+            list.textContent = "";
+            out.textContent = "";
+            load(id).then(function (d) {
+                if (!d) { out.textContent = "この版履歴は見つかりません．"; return; }
+                data = d; texts = [d.base]; selected = 0;
+                document.title = d.title + " - 版履歴";
+                document.getElementById("title").textContent = d.title + " の版履歴";
+                document.getElementById("back").setAttribute("href", d.page);
+                d.versions.forEach(function (v, k) {
+                    const li = document.createElement("li");
+                    li.textContent = "v" + (v[0] || "?") + (v[1] ? "  " + v[1].slice(0, 16) : "") + (k === 0 ? "（現行版）" : "");
+                    li.addEventListener("click", function () { selected = k; render(); });
+                    list.appendChild(li);
+                });
+                render();
+            });
+        }
+
+        document.querySelectorAll(".tabs button").forEach(function (b) {
+            b.addEventListener("click", function () { mode = b.getAttribute("data-mode"); if (data) render(); });
+        });
+        window.addEventListener("hashchange", init);
+        init();
+    })();
+</script>
+</body>
+</html>
+"""
+
+def _resolve_page_icons(page_dir: Path, out_root: Path) -> dict:
+    # このページのフォルダを基準に共通アイコンの相対パスを事前解決
+    icons = {}
+    try:
+        p = _ensure_bg_image(out_root)
+        if p:
+            icons["bg"] = _rel_href_from(page_dir, p)
+    except Exception:
+        pass
+    try:
+        p = _ensure_exe_icon(out_root)
+        if p: icons["exe_icon"] = _rel_href_from(page_dir, p)
+    except Exception:
+        pass
+    try:
+        p = _ensure_pokeball(out_root)
+        if p: icons["pokeball"] = _rel_href_from(page_dir, p)
+    except Exception:
+        pass
+    try:
+        p = _ensure_empty_icon(out_root)
+        if p: icons["empty_icon"] = _rel_href_from(page_dir, p)
+    except Exception:
+        pass
+    try:
+        p = _ensure_footer_gori(out_root)
+        if p:icons["back_top_img"] = _rel_href_from(page_dir, p)
+    except Exception:
+        pass
+    return icons
+
+def _render_page_to_file(storage_html: str, chain: list[str], page_dir: Path, page_title: str,
+                         ctx: dict, page_id: str | None = None) -> tuple[str, Path, dict | None, float, dict]:
+    # 1ページ分の HTML を生成して書き出し，(ログ行, 出力パス, 検索語, 描画秒数, ri:page リンクの解決数) を返す（直列/並列で共通）
+    # ctx: out_html_root / out_root / attach_index / sidebar_manifest / static_assets / search_index / storage_engine /
+    #      history_index / history_pages / page_index（全ページ共通の描画設定）
+    started = time.perf_counter()
+    page_path = page_dir / f"{page_title}.html"
+    history_href = None
+    if page_id is not None and page_id in ctx.get("history_pages", ()):
+        history_href = f'{_rel_href_from(page_dir, ctx["history_index"])}#{urllib.parse.quote(page_id)}'
+    link_stats: dict = {}
+    html = confluence_storage_to_html(
+        storage_html,
+        chain,
+        ctx["out_html_root"],
+        ctx["out_root"],
+        attach_index=ctx["attach_index"],
+        page_id=page_id,
+        resolved_icons=_resolve_page_icons(page_dir, ctx["out_root"]),
+        sidebar_manifest=ctx.get("sidebar_manifest"),
+        static_assets=ctx.get("static_assets"),
+        search_index=ctx.get("search_index"),
+        engine=ctx.get("storage_engine", STORAGE_ENGINE),
+        history_href=history_href,
+        page_index=ctx.get("page_index"),
+        link_stats=link_stats,
+    )
+    page_dir.mkdir(parents=True, exist_ok=True)
+    page_path.write_text(html, encoding="utf-8")
+    # 検索語はワーカー側で抽出して返す（親プロセスはインデックスにまとめるだけ）
+    terms = _search_terms(chain[-1] if chain else page_title, storage_html) if ctx.get("search_index") else None
+    return f"[HTML] {'/'.join(chain)}/{page_title}.html", page_path, terms, time.perf_counter() - started, link_stats
+
+# ---------- 並列描画（ProcessPool） ----------
+PARALLEL_MIN_PAGES = 64       # これ未満のページ数ならプロセス起動コストの方が高いので直列
+
+_RENDER_CTX: dict = {}
+
+def _process_pool(max_workers: int, **kwargs):
+    # 常に spawn で起動する．GUI ではワーカースレッドから呼ばれ，Tk を読み込んだマルチスレッドの
+    # プロセスを fork するとデッドロックしうるため（ワーカーへの状態は initializer / 引数で渡す）
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"), **kwargs)
+
+def _init_render_worker(sidebar_root, sidebar_items, sidebar_empty, ctx: dict):
+    # ワーカープロセスの初期化：サイドバー情報と描画設定（添付インデックス含む）を1回だけ受け取る
+    global SIDEBAR_HTML_ROOT, SIDEBAR_ITEMS, SIDEBAR_EMPTY_PAGES
+    SIDEBAR_HTML_ROOT = sidebar_root
+    SIDEBAR_ITEMS = sidebar_items
+    SIDEBAR_EMPTY_PAGES = sidebar_empty
+    _RENDER_CTX.update(ctx)
+
+def _render_pages_task(task: list[tuple]) -> list[tuple]:
+    # task: [(storage_html, chain, page_dir, page_title, page_id), ...] を順に描画して結果を返す
+    return [(*_render_page_to_file(storage_html, chain, page_dir, page_title, _RENDER_CTX, pid), pid)
+            for storage_html, chain, page_dir, page_title, pid in task]
+
+def _render_pages_parallel(page_entries, bodies, ctx: dict, workers: int):
+    """
+    ページ描画をプロセスプールで実行し，完了したページの (ログ行, 出力パス, 検索語, 描画秒数, リンク解決数, ページID) を順次 yield する．
+    同じ出力パスを持つページは直列時と同じ順序で1つのタスクにまとめ，
+    最後に書いたページが残るという直列モードの結果（バイト単位）を保つ．
+    """
+    from concurrent.futures import as_completed
+
+    # 共通アイコン類はワーカーが同時にコピーしないよう先に用意しておく
+    for ensure in (_ensure_bg_image, _ensure_exe_icon, _ensure_pokeball, _ensure_empty_icon,
+                   _ensure_footer_gori, _ensure_header_logo):
+        ensure(ctx["out_root"])
+
+    groups: dict[Path, list[tuple]] = {}
+    for pid, chain, page_dir, page_title in page_entries:
+        page_path = page_dir / f"{page_title}.html"
+        groups.setdefault(page_path, []).append((bodies.get(pid, ""), chain, page_dir, page_title, pid))
+
+    chunk = max(1, min(64, len(page_entries) // (workers * 8) or 1))
+    tasks, cur = [], []
+    for items in groups.values():
+        cur.extend(items)
+        if len(cur) >= chunk:
+            tasks.append(cur); cur = []
+    if cur:
+        tasks.append(cur)
+
+    # マニフェスト方式ではワーカーは全ページのサイドバー情報を必要としない
+    sidebar_items = [] if ctx.get("sidebar_manifest") else SIDEBAR_ITEMS
+    with _process_pool(workers, initializer=_init_render_worker,
+                       initargs=(SIDEBAR_HTML_ROOT, sidebar_items, SIDEBAR_EMPTY_PAGES, ctx)) as ex:
+        futures = [ex.submit(_render_pages_task, t) for t in tasks]
+        try:
+            for fut in as_completed(futures):
+                yield from fut.result()
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+
+def _pick_page_winners(page_entries: list[tuple], pages_map: dict, skipped_pages: list | None,
+                       timer: StageTimer) -> list[tuple]:
+    # 同じ出力パスに当たるページから1件だけ残す（更新日時 → 版番号 → entities.xml で後に出たもの の順に優先）．
+    # 残した順は各勝者の元の位置のまま．落としたページは skipped_pages に {page_id, title, path, winner} で追記
+    def rank(entry):
+        meta = pages_map[entry[0]]
+        return meta.get("modified") or "", meta.get("version") or 0
+
+    winners: dict[Path, tuple] = {}
+    losers: list[tuple[tuple, Path]] = []
+    for entry in page_entries:
+        page_path = entry[2] / f"{entry[3]}.html"
+        prev = winners.get(page_path)
+        if prev is not None and rank(entry) < rank(prev):
+            losers.append((entry, page_path))
+            continue
+        if prev is not None:
+            losers.append((prev, page_path))
+        winners[page_path] = entry
+    timer.count("pages_duplicate", len(losers))
+    if skipped_pages is not None:
+        for (pid, chain, _dir, _title), page_path in losers:
+            skipped_pages.append({"page_id": pid, "title": pages_map[pid].get("title", ""),
+                                  "path": page_path, "winner": winners[page_path][0]})
+    keep = {id(e) for e in winners.values()}
+    return [e for e in page_entries if id(e) in keep]
+
+def generate_html_from_xml_root(input_path: Path, out_html_root: Path, out_root: Path, log_box, progress_cb=None,
+                                model: BackupModel | None = None, render_workers: int = 1,
+                                sidebar_mode: str = SIDEBAR_MODE, asset_mode: str = ASSET_MODE,
+                                manifest: RunManifest | None = None, attach_index: AttachmentIndex | None = None,
+                                search: bool = SEARCH_INDEX, timer: StageTimer | None = None,
+                                storage_engine: str = STORAGE_ENGINE, skipped_pages: list | None = None,
+                                history: bool = PAGE_HISTORY, page_index: PageLinkIndex | None = None):
     
     # Zip/フォルダどちらでも HTML を生成
-    if input_path.is_file() and input_path.suffix.lower()==".zip":
+    # attach_index は展開時に作った添付索引（省略時はマニフェスト/添付フォルダから1回だけ作る）
+    # search=True なら描画と同時に検索語を集め，最後に _search/ へ全文検索インデックスを書き出す
+    # storage_engine は本文変換のエンジン（lxml / bs4．出力は同じ）
+    # 描画するのは現行版のページだけで，同じ出力パスに当たるページは1件に絞る（落としたページは skipped_pages へ）
+    # history=True なら旧版のあるページに「履歴」リンクを置き，版ごとの差分を _history/ へ書き出す（html.history）
+    # page_index は ri:page リンクの索引（省略時はこのバックアップの描画ページから作る．サイト変換では全スペース共通）
+    # timer には各周の所要時間を html.collect / html.sidebar / html.blank / html.assets / html.render / html.history /
+    # html.search / html.index で，
+    # ページごとの描画時間は timer.page で記録（遅いページの上位だけ残る）
+    timer = timer or StageTimer()
+    if model is not None:
+        log_append(log_box, f"=== XML→HTML 生成 ({'ZIPダイレクト読込' if model.is_zip else 'フォルダ'}) ===")
+        if not model.entities_name:
+            raise RuntimeError("entities.xml が見つかりません．")
+        pages_map, bodies = model.pages, model.bodies
+    elif input_path.is_file() and input_path.suffix.lower()==".zip":
         log_append(log_box, "=== XML→HTML 生成 (ZIPダイレクト読込) ===")
         with zipfile.ZipFile(input_path) as z:
             ent = next((n for n in z.namelist() if n.endswith("/entities.xml") or n=="entities.xml"), None)
             if not ent:
                 raise RuntimeError("Zip内に entities.xml が見つかりません．")
-            pages_map, bodies = _parse_pages_and_bodies_from_entities_bytes(z.read(ent))
+            with z.open(ent) as fp:
+                pages_map, bodies = _parse_pages_and_bodies_from_entities_bytes(fp)
     else:
         log_append(log_box, "=== XML→HTML 生成 (フォルダ) ===")
         entities_list = list(Path(input_path if input_path.is_dir() else input_path.parent).rglob("entities.xml"))
@@ -2269,7 +4415,7 @@ def generate_html_from_xml_root(input_path: Path, out_html_root: Path, out_root:
             raise RuntimeError("entities.xml が見つかりません．")
         pages_map, bodies = {}, {}
         for ent in entities_list:
-            p, b = _parse_pages_and_bodies_from_entities_bytes(Path(ent).read_bytes())
+            p, b = _parse_pages_and_bodies_from_entities_bytes(Path(ent))
             pages_map.update(p)
             bodies.update(b)
 
@@ -2278,6 +4424,15 @@ def generate_html_from_xml_root(input_path: Path, out_html_root: Path, out_root:
     SIDEBAR_ITEMS = []  # ★毎回リセットさせる
     SIDEBAR_EMPTY_PAGES = set()
 
+    # 旧版・下書きは描画しない（親子のたどりと索引も現行版だけで作る）
+    timer.mark()
+    statuses = [meta.get("status", "current") for meta in pages_map.values()]
+    n_historical, n_draft = statuses.count("historical"), statuses.count("draft")
+    timer.count("pages_historical", n_historical)
+    timer.count("pages_draft", n_draft)
+    all_pages = pages_map
+    pages_map = {pid: meta for pid, meta in pages_map.items() if meta.get("status", "current") == "current"}
+
     # 1周目：全ページのチェインとパスを収集
     page_entries: list[tuple[str, list[str], Path, str]] = []
     total_pages = len(pages_map)
@@ -2288,7 +4443,12 @@ def generate_html_from_xml_root(input_path: Path, out_html_root: Path, out_root:
         page_dir, page_title = _dir_for_chain(out_html_root, chain)
         page_entries.append((pid, chain, page_dir, page_title))
         _step_progress(40, 45, i, total_pages, progress_cb) 
+    page_entries = _pick_page_winners(page_entries, pages_map, skipped_pages, timer)
+    n_duplicate, total_pages = total_pages - len(page_entries), len(page_entries)
+    log_append(log_box, f"[INFO] 描画対象 {total_pages} ページ（旧版 {n_historical} / 下書き {n_draft} / "
+                        f"出力先の重複 {n_duplicate} 件は除外）")
     log_append(log_box, f"=== DONE === Sub process 1 complete")
+    timer.lap("html.collect")
 
     # 2周目：サイドバー用のアイテムを先に全て登録
     log_append(log_box, f"[Sub process 2] Sidebar Item Registration  total：{total_pages}")
@@ -2297,15 +4457,17 @@ def generate_html_from_xml_root(input_path: Path, out_html_root: Path, out_root:
         SIDEBAR_ITEMS.append((chain, page_path))
         _step_progress(45, 50, i, total_pages, progress_cb)
     log_append(log_box, f"=== DONE === Sub process 2 complete")
+    timer.lap("html.sidebar")
 
     # 3周目：全ページを確認して空白ページの事前判定
     log_append(log_box, f"[Sub process 3] Search for blank pages  total：{total_pages}")
     page_empty_map: dict[Path, bool] = {}
     for i, (pid, chain, page_dir, page_title) in enumerate(page_entries, start=1):
         page_path = page_dir / f"{page_title}.html"
-        storage_html = bodies.get(pid, "")
-
-        is_empty = _is_blank_storage_html(storage_html)
+        # 判定は entities.xml の解析時に済んでいる（外から渡されたモデルに無ければここで判定）
+        is_empty = pages_map[pid].get("blank")
+        if is_empty is None:
+            is_empty = _is_blank_storage_html(bodies.get(pid, ""))
 
         prev = page_empty_map.get(page_path)
         if prev is None:
@@ -2316,61 +4478,159 @@ def generate_html_from_xml_root(input_path: Path, out_html_root: Path, out_root:
     log_append(log_box, f"=== DONE === Sub process 3 complete")
 
     SIDEBAR_EMPTY_PAGES = {p for p, empty in page_empty_map.items() if empty}
+    timer.lap("html.blank")
 
-    # 4周目：各ページのHTMLを書き出し（サイドバーは全ページ分を見て生成）
-    attach_index = build_attachment_index(out_root) # 添付インデックスを1回だけ構築させる
-    made = 0
-    for i, (pid, chain, page_dir, page_title) in enumerate(page_entries, start=1):
-        page_path = page_dir / f"{page_title}.html"
-        storage_html = bodies.get(pid, "")
-        # このページのフォルダを基準に共通アイコンの相対パスを事前解決
-        icons = {}
-        try:
-            p = _ensure_bg_image(out_root)
-            if p:
-                icons["bg"] = _rel_href_from(page_dir, p)
-        except Exception:
-            pass
-        try:
-            p = _ensure_exe_icon(out_root)
-            if p: icons["exe_icon"] = _rel_href_from(page_dir, p)
-        except Exception:
-            pass
-        try:
-            p = _ensure_pokeball(out_root)
-            if p: icons["pokeball"] = _rel_href_from(page_dir, p)
-        except Exception:
-            pass
-        try:
-            p = _ensure_empty_icon(out_root)
-            if p: icons["empty_icon"] = _rel_href_from(page_dir, p)
-        except Exception:
-            pass
-        try:
-            p = _ensure_footer_gori(out_root)
-            if p:icons["back_top_img"] = _rel_href_from(page_dir, p)
-        except Exception:
-            pass
+    # サイドバー：マニフェスト方式なら全ページ分のリンクを _sidebar.js に1回だけ書き出す
+    sidebar_manifest = None
+    if sidebar_mode == "manifest":
+        sidebar_manifest = _write_sidebar_manifest(out_html_root)
+        log_append(log_box, f"[INFO] サイドバーマニフェスト: {sidebar_manifest.name}")
 
-        html = confluence_storage_to_html(
-            storage_html,
-            chain,
-            out_html_root,
-            out_root,
-            attach_index=attach_index,
-            resolved_icons=icons,
-        )
-        page_dir.mkdir(parents=True, exist_ok=True)
-        page_path.write_text(html, encoding="utf-8")
+    # 共通 CSS/JS：static 方式なら _static/ に1回だけ書き出して各ページから参照
+    static_assets = None
+    if asset_mode == "static":
+        static_assets = _write_static_assets(out_html_root)
+        log_append(log_box, "[INFO] 共通アセット: " + ", ".join(p.name for p in static_assets.values()))
 
-        log_append(log_box, f"[HTML] {'/'.join(chain)}/{page_title}.html")
-        pump_gui(log_box)
-        made += 1
+    timer.lap("html.assets")
+
+    # ページ間リンク：(スペースキー, タイトル) → 出力パス の索引を1回だけ作り，全ページの描画で共有する
+    if page_index is None:
+        page_index = build_page_link_index(page_entries, pages_map, model.spaces if model is not None else {})
+
+    # 4周目：各ページのHTMLを書き出し（サイドバーは全ページ分を見て生成）
+    if attach_index is None:
+        attach_index = build_attachment_index(out_root, model) # 展開を伴わない時だけ索引を1回構築する
+    search_index = out_html_root / SEARCH_DIR_NAME / "meta.js" if search else None
+    ctx = {"out_html_root": out_html_root, "out_root": out_root,
+           "attach_index": attach_index, "sidebar_manifest": sidebar_manifest,
+           "static_assets": static_assets, "search_index": search_index, "storage_engine": storage_engine,
+           "page_index": page_index}
+
+    # 版履歴：現行ページ → 旧版のページID（履歴リンクは旧版のあるページだけに付く）
+    history_of: dict[str, list[str]] = defaultdict(list)
+    if history:
+        for hid, meta in all_pages.items():
+            if meta.get("status") == "historical" and meta.get("originalId") in pages_map:
+                history_of[meta["originalId"]].append(hid)
+        ctx["history_index"] = out_html_root / HISTORY_DIR_NAME / "index.html"
+        ctx["history_pages"] = {pid for pid, *_rest in page_entries if pid in history_of}
+
+    # 差分変換：署名が前回と同じで出力も残っているページは描画しない
+    render_entries = page_entries
+    if manifest is not None:
+        template = _render_template_key(out_html_root, sidebar_manifest, static_assets, search_index, history)
+        prev_pages = manifest.previous.get("pages", {})
+        prev_links = manifest.previous.get("links", {})
+        same_template = manifest.previous.get("template") == template
+        path_groups: dict[Path, list[tuple]] = {}
+        for entry in page_entries:
+            path_groups.setdefault(entry[2] / f"{entry[3]}.html", []).append(entry)
+        render_entries = []
+        for page_path, entries in path_groups.items():
+            rk = page_path.relative_to(out_html_root).as_posix()
+            sig = _page_signature(entries, bodies, attach_index, out_root, ctx.get("page_index"),
+                                  ctx.get("history_pages", ()))
+            manifest.pages[rk] = sig
+            # リンク数の記録が無い（古いマニフェストの）ページは描画し直して数える
+            if not (same_template and prev_pages.get(rk) == sig and rk in prev_links and page_path.exists()):
+                render_entries.extend(entries)
+            else:
+                manifest.links[rk] = prev_links[rk]
+        removed = [rk for rk in prev_pages if rk not in manifest.pages]
+        for rk in removed:
+            _remove_output(out_html_root / rk, out_html_root)
+        manifest.template = template
+        kept = len(path_groups) - len({e[2] / f"{e[3]}.html" for e in render_entries})
+        log_append(log_box, f"[INCR] ページ: 描画 {len(render_entries)} / 維持 {kept} / 削除 {len(removed)}")
+        manifest.stats.update(pages_rendered=len(render_entries), pages_kept=kept, pages_removed=len(removed))
 
-        _step_progress(55, 99, i, total_pages, progress_cb)  
+    made = 0
+    total_render = len(render_entries)
+    workers = _resolve_workers(render_workers)
+    search_terms: dict[Path, dict] = {}   # 出力パス → 検索語（同じパスは最後に書いたページ）
+    link_totals: dict[str, int] = {}      # ri:page リンクの解決数（links_resolved / links_unresolved）
+    path_links: dict[Path, list[int]] = {}   # 出力パス → [解決数, 未解決数]（マニフェストに残し，次回維持した時に数える）
+
+    def count_links(page_path: Path, links: dict) -> None:
+        for key, n in links.items():
+            link_totals[key] = link_totals.get(key, 0) + n
+        counts = path_links.setdefault(page_path, [0, 0])
+        counts[0] += links.get("links_resolved", 0)
+        counts[1] += links.get("links_unresolved", 0)
+    if workers > 1 and total_render >= PARALLEL_MIN_PAGES:
+        log_append(log_box, f"[INFO] ページ描画を {workers} プロセスで並列実行します")
+        for line, page_path, terms, seconds, links, pid in _render_pages_parallel(render_entries, bodies, ctx, workers):
+            made += 1
+            search_terms[page_path] = terms
+            timer.page(pid, page_path, seconds)
+            count_links(page_path, links)
+            log_append(log_box, line)
+            _step_progress(55, 99, made, total_render, progress_cb)
+    else:
+        for i, (pid, chain, page_dir, page_title) in enumerate(render_entries, start=1):
+            line, page_path, terms, seconds, links = _render_page_to_file(bodies.get(pid, ""), chain, page_dir, page_title,
+                                                                          ctx, pid)
+            search_terms[page_path] = terms
+            timer.page(pid, page_path, seconds)
+            count_links(page_path, links)
+            log_append(log_box, line)
+            pump_gui(log_box)
+            made += 1
+
+            _step_progress(55, 99, i, total_render, progress_cb)  
+
+    if manifest is not None:
+        # 維持したページのリンク数は前回の記録から足す（run_report は差分変換でも出力全体の数になる）
+        for resolved, unresolved in manifest.links.values():
+            link_totals["links_resolved"] = link_totals.get("links_resolved", 0) + resolved
+            link_totals["links_unresolved"] = link_totals.get("links_unresolved", 0) + unresolved
+        for page_path, counts in path_links.items():
+            manifest.links[page_path.relative_to(out_html_root).as_posix()] = counts
+    for key, n in link_totals.items():
+        timer.count(key, n)
+    if link_totals:
+        log_append(log_box, f"[INFO] ページ間リンク: 解決 {link_totals.get('links_resolved', 0)} / "
+                            f"未解決 {link_totals.get('links_unresolved', 0)}")
+    timer.lap("html.render")
+
+    # 版履歴：版ごとの本文テキストの差分をワーカーで作る（最新版だけ全文で持ち，復元と表示はブラウザ側）
+    if history:
+        def version(hid: str) -> tuple:
+            meta = all_pages[hid]
+            return meta.get("version") or 0, meta.get("modified") or "", bodies.get(hid, "")
+        entries = [(pid, chain[-1], page_dir / f"{page_title}.html",
+                    [version(pid)] + sorted((version(h) for h in history_of[pid]), key=lambda v: v[:2], reverse=True))
+                   for pid, chain, page_dir, page_title in page_entries if pid in history_of]
+        n_pages, n_versions, full_bytes, written = _write_page_history(out_html_root, entries, workers)
+        timer.count("history_pages", n_pages)
+        timer.count("history_versions", n_versions)
+        timer.count("history_bytes", written)
+        log_append(log_box, f"[INFO] 版履歴: {n_pages} ページ / {n_versions} 版（全文 {full_bytes / 1024:.0f} KiB → "
+                            f"差分 {written / 1024:.0f} KiB，{HISTORY_DIR_NAME}/）")
+        timer.lap("html.history")
+
+    # 全文検索インデックス：描画しなかった（差分変換で維持した）ページはここで検索語を抽出する
+    if search_index is not None:
+        docs: dict[Path, tuple] = {}
+        for pid, chain, page_dir, page_title in page_entries:
+            page_path = page_dir / f"{page_title}.html"
+            docs.pop(page_path, None)   # 同じパスは最後のページを採用（並びは最後の出現位置）
+            docs[page_path] = (pid, chain)
+        doc_list = []
+        for page_path, (pid, chain) in docs.items():
+            terms = search_terms.get(page_path)
+            if terms is None:
+                terms = _search_terms(chain[-1], bodies.get(pid, ""))
+            doc_list.append((chain[-1], page_path, chain, terms))
+        _write_search_index(out_html_root, doc_list)
+        log_append(log_box, f"[INFO] 全文検索インデックス: {len(doc_list)} ページ（{SEARCH_DIR_NAME}/）")
+        timer.lap("html.search")
 
     _write_index_html(out_root, out_html_root, pages_map, link_prefix=f"{HTML_DIR_NAME}/")
+    timer.lap("html.index")
     log_append(log_box, f"=== XML→HTML 生成 完了（ページ {made} 件／index.html 生成） ===")
+    return made
 
 
 
@@ -2392,8 +4652,8 @@ def _generate_docx_from_zip(zip_path: Path, dst_root: Path, log_box: tk.Text):
                 ent_name = name; break
         if not ent_name:
             raise RuntimeError("Zip内に entities.xml が見つかりません．")
-        ent_bytes = z.read(ent_name)
-        pages_map, body_html = _parse_pages_parent_from_entities_xml_bytes(ent_bytes)
+        with z.open(ent_name) as fp:
+            pages_map, body_html = _parse_pages_parent_from_entities_xml_bytes(fp)
         made = 0
         for pid, meta in pages_map.items():
             titles = _build_dir_chain_for_page(pid, pages_map)
@@ -2414,7 +4674,7 @@ def _generate_docx_from_folder(src_root: Path, dst_root: Path, log_box: tk.Text)
     pages_map_all = {}; body_html_all = {}
     for ent in entities_list:
         with open(ent, "rb") as fp:
-            pages_map, body_html = _parse_pages_parent_from_entities_xml_bytes(fp.read())
+            pages_map, body_html = _parse_pages_parent_from_entities_xml_bytes(fp)
         pages_map_all.update(pages_map); body_html_all.update(body_html)
     for k, v in pages_from_pages.items():
         base = pages_map_all.get(k, {"title": v.get("title",""), "parentId": v.get("parentId","")})
@@ -2440,6 +4700,978 @@ def generate_docx_from_xml_root(input_path: Path, out_docx_root: Path, log_box:
         log_append(log_box, f"=== XML→Word 生成 (フォルダ) ===")
         _generate_docx_from_folder(src_root, out_docx_root, log_box)
 
+# ----------------------------------------------------------------------------------
+# 変換パイプライン（GUI / CLI 共通）
+# ----------------------------------------------------------------------------------
+class ConversionCancelled(Exception):
+    """ユーザー操作で変換が中断されたことを表す"""
+
+RUN_REPORT_NAME = "run_report.json"    # 変換ごとの性能レポート（index.html と同じ階層）
+RUN_REPORT_SLOWEST_PAGES = 20          # レポートに載せる「描画の遅いページ」の件数
+
+class StageTimer:
+    """
+    処理段階ごとの所要時間（wall / CPU 秒）を積算する．
+    with timer.stage("名前"): で囲むか，timer.mark() の後に区切りごとに timer.lap("名前") を呼ぶ．
+    段階の中の小さな周は "段階.周" の名前で lap する（stage は mark/lap の基準を動かさないので入れ子にできる）．
+    CPU 秒は本プロセス＋終了した子プロセス（os.times．Windows では子プロセス分は数えられない）．
+    count で件数/バイト数を，page でページごとの描画時間（遅い順に上位 slowest 件だけ）を記録する．
+    """
+    def __init__(self, slowest: int = RUN_REPORT_SLOWEST_PAGES):
+        self.stages: dict[str, dict[str, float]] = {}
+        self.counters: dict[str, int] = {}
+        self.slowest: list[tuple[float, int, str, str]] = []   # (秒, 登録順, ページID, 出力パス) の最小ヒープ
+        self._keep = slowest
+        self._last: tuple[float, float] | None = None
+        self._pages = 0
+
+    @staticmethod
+    def _now() -> tuple[float, float]:
+        t = os.times()
+        return time.perf_counter(), t.user + t.system + t.children_user + t.children_system
+
+    def _add(self, name: str, start: tuple[float, float], end: tuple[float, float]) -> None:
+        rec = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+        rec["wall"] += end[0] - start[0]
+        rec["cpu"] += end[1] - start[1]
+
+    @contextmanager
+    def stage(self, name: str):
+        self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0})   # 表示順は段階 → その周
+        start = self._now()
+        try:
+            yield
+        finally:
+            self._add(name, start, self._now())
+
+    def mark(self) -> None:
+        self._last = self._now()
+
+    def lap(self, name: str) -> None:
+        # 直前の mark/lap からの時間を name に積算する
+        now = self._now()
+        if self._last is not None:
+            self._add(name, self._last, now)
+        self._last = now
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def page(self, page_id: str, path, seconds: float) -> None:
+        self._pages += 1
+        item = (seconds, self._pages, str(page_id), str(path))
+        if len(self.slowest) < self._keep:
+            heapq.heappush(self.slowest, item)
+        elif self._keep and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+def _peak_rss_bytes() -> dict[str, int | None]:
+    # 最大常駐メモリ（self=本プロセス / children=終了した子プロセスのうち最大のもの）．取れない項目は None
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        scale = 1 if sys.platform == "darwin" else 1024   # macOS はバイト，Linux などは KiB
+        return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+                "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+    if sys.platform == "win32":
+        try:
+            import ctypes
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                    (n, ctypes.c_size_t) for n in ("PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage",
+                                                   "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage",
+                                                   "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            kernel32 = ctypes.WinDLL("kernel32")
+            kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+            psapi = ctypes.WinDLL("psapi")
+            psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.c_void_p, wintypes.DWORD]
+            if psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+                return {"self": int(counters.PeakWorkingSetSize), "children": None}
+        except Exception:
+            pass
+    return {"self": None, "children": None}
+
+def build_run_report(summary: dict, timer: StageTimer, *, workers: int = 1, skipped_pages: list | None = None) -> dict:
+    """
+    convert_backup の要約と StageTimer から run_report.json の内容を作る．
+    stages は記録順（段階 → その周）で wall / cpu 秒，throughput は描画ページ/秒と添付バイト/秒．
+    slowest_pages / skipped_pages の path は出力フォルダからの相対パス．
+    skipped_pages は出力パスが重なって描画しなかった現行ページ（winner が描画したページのID）．
+    """
+    def rate(amount, stage):
+        wall = timer.stages.get(stage, {}).get("wall", 0.0)
+        return round(amount / wall, 2) if wall > 0 else None
+
+    seconds = summary.get("seconds") or 0.0
+    out_root = summary.get("out_root")
+    pages, att_bytes = summary.get("pages", 0), timer.counters.get("attachment_bytes", 0)
+    return {
+        "tool": APP_TITLE,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "input": summary.get("input"),
+        "space_key": summary.get("space_key"),
+        "workers": workers,
+        "seconds": seconds,
+        "stages": {name: {"wall": round(v["wall"], 4), "cpu": round(v["cpu"], 4)} for name, v in timer.stages.items()},
+        "counts": {"pages_rendered": pages, "attachments": summary.get("attachments", 0),
+                   "attachment_bytes": att_bytes, **timer.counters},
+        "throughput": {
+            "pages_per_sec": round(pages / seconds, 2) if seconds > 0 else None,
+            "render_pages_per_sec": rate(pages, "html.render"),
+            "attachment_bytes_per_sec": rate(att_bytes, "attachments"),
+        },
+        "peak_rss_bytes": _peak_rss_bytes(),
+        "slowest_pages": [{"page_id": pid, "path": Path(os.path.relpath(path, out_root)).as_posix() if out_root else path,
+                           "seconds": round(sec, 4)}
+                          for sec, _seq, pid, path in sorted(timer.slowest, reverse=True)],
+        "skipped_pages": [{**rec, "path": Path(os.path.relpath(rec["path"], out_root)).as_posix() if out_root else str(rec["path"])}
+                          for rec in skipped_pages or ()],
+        "incremental": summary.get("incremental"),
+    }
+
+def _null_log(line: str) -> None:
+    pass
+
+def _cancellable(fn, cancel: threading.Event):
+    # ログ/進捗の出力ごとに中断要求を確認する（各ステージのループは1件ごとに必ずどちらかを呼ぶ）
+    def wrapped(value):
+        if cancel.is_set():
+            raise ConversionCancelled()
+        if fn is not None:
+            fn(value)
+    return wrapped
+
+def convert_backup(input_path: Path, out_root: Path | None = None, *, dry_run: bool = False,
+                   log=None, progress_cb=None, model: BackupModel | None = None,
+                   use_cache: bool = False, workers: int = 1,
+                   cancel: threading.Event | None = None, incremental: bool = False,
+                   dedup: bool = DEDUP_ATTACHMENTS, version_mode: str = ATTACHMENT_VERSION_MODE,
+                   timer: StageTimer | None = None, page_history: bool = PAGE_HISTORY,
+                   link_mode: str = "copy", page_index: PageLinkIndex | None = None) -> dict:
+    """
+    1つのバックアップ（Zip/フォルダ）を 添付復元 → HTML 生成 まで通しで変換し，結果の要約を返す．
+    添付は展開時にページ名フォルダへ直接置く（plan_attachments）ので，展開後の再配置は無い．
+    log はログ欄（tk.Text）または1行を受け取る callable，progress_cb は 0〜100 を受け取る callable．
+    out_root 省略時は入力の隣に「日時_スペースキー」で自動作成する．
+    cancel がセットされると次のログ/進捗出力の時点で ConversionCancelled を送出する．
+    incremental=True なら out_root（前回の出力）の klefki_manifest.json と比べて変わった添付/ページだけ作り直す．
+    dedup=True なら同じ内容の添付をハードリンクにし，節約量を dedup_report.json に書き出す．
+    version_mode は添付の版の扱い（latest / history / all，_extract_attachments 参照）．
+    link_mode はフォルダ入力の添付の置き方（copy / hardlink / reflink，Zip 入力では無視）．
+    page_index は ri:page リンクの索引（convert_site_backup が全スペース分をまとめて渡す．省略時はこの変換の分だけ）．
+    page_history=True ならページの版履歴（最新版＋差分）と閲覧ページを html_pages/_history/ に書き出す．
+    timer を渡すと段階ごとの所要時間（parse / attachments(.*) / html(.*)）を記録する．
+    書き出し時は out_root/run_report.json に段階別の時間・処理速度・最大メモリ・描画の遅いページを残す．
+    """
+    log = log if log is not None else _null_log
+    if cancel is not None:
+        sink = log
+        log = _cancellable(lambda line: log_append(sink, line), cancel)
+        progress_cb = _cancellable(progress_cb, cancel)
+    started = time.perf_counter()
+    input_path = Path(input_path)
+    timer = timer or StageTimer()
+    if model is None:
+        # entities.xml はここで1回だけ解析し，以降の全ステージで共有する
+        with timer.stage("parse"):
+            model = load_backup_model(input_path, log, use_cache=use_cache)
+    if out_root is None:
+        out_root = _build_auto_out_root(input_path, log, model=model)
+    attach_root = out_root / ATT_DIR_NAME
+    html_root = out_root / HTML_DIR_NAME
+    if not dry_run:
+        attach_root.mkdir(parents=True, exist_ok=True)
+        html_root.mkdir(parents=True, exist_ok=True)
+    # 変換結果は毎回マニフェストに記録し，次回の差分変換に使う
+    manifest = load_run_manifest(out_root, incremental) if not dry_run or incremental else None
+    if incremental:
+        if manifest.previous:
+            log_append(log, f"[INCR] 前回の出力を差分更新します: {out_root}")
+        else:
+            log_append(log, f"[WARN] {RUN_MANIFEST_NAME} が無いため全件変換します: {out_root}")
+    store = _DedupStore() if dedup and not dry_run else None
+    index = AttachmentIndex()   # 展開しながら作り，HTML 生成でそのまま使う
+
+    # 添付復元（ステップ1）0% ⇒ 40%
+    with timer.stage("attachments"):
+        if model.is_zip:
+            log_append(log, f"=== ZIP入力: {input_path.name} (dry_run={dry_run}) ===")
+            attachments = process_zip(input_path, attach_root, dry_run, log, progress_cb=progress_cb, model=model,
+                                      extract_workers=workers, manifest=manifest, dedup=store,
+                                      version_mode=version_mode, index=index, timer=timer)
+        else:
+            log_append(log, f"=== フォルダ入力: {input_path} (dry_run={dry_run}) ===")
+            attachments = process_folder(input_path, attach_root, dry_run, log, progress_cb=progress_cb, model=model,
+                                         extract_workers=workers, link_mode=link_mode, manifest=manifest,
+                                         dedup=store, version_mode=version_mode, index=index, timer=timer)
+    if progress_cb: progress_cb(40)
+
+    summary = {
+        "input": str(input_path), "out_root": str(out_root), "space_key": model.space_key,
+        "dry_run": dry_run, "attachments": attachments or 0, "pages": 0,
+    }
+    skipped: list[dict] = []   # 出力パスが重なって描画しなかったページ（run_report.json へ）
+    if store is not None:
+        report = store.report(out_root)
+        (out_root / DEDUP_REPORT_NAME).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        log_append(log, f"[DEDUP] 重複添付 {report['files_linked']} 件をハードリンク化 "
+                        f"／ 節約 {report['bytes_saved'] / (1024 * 1024):.1f} MiB（{DEDUP_REPORT_NAME}）")
+        summary["dedup"] = {"files_linked": report["files_linked"], "bytes_saved": report["bytes_saved"]}
+    if dry_run:
+        if progress_cb: progress_cb(100)
+        log_append(log, f"=== DONE (Dry-Run) === 出力予定: {out_root}")
+    else:
+        # HTML 出力（ステップ2）40% ⇒ 99%
+        with timer.stage("html"):
+            summary["pages"] = generate_html_from_xml_root(input_path, html_root, out_root, log,
+                                                           progress_cb=progress_cb, model=model,
+                                                           render_workers=workers, manifest=manifest,
+                                                           attach_index=index, timer=timer,
+                                                           skipped_pages=skipped, history=page_history,
+                                                           page_index=page_index)
+        summary["pages_skipped"] = len(skipped)
+        manifest.save()
+    if incremental:
+        summary["incremental"] = manifest.stats
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    if not dry_run:
+        report = build_run_report(summary, timer, workers=_resolve_workers(workers), skipped_pages=skipped)
+        (out_root / RUN_REPORT_NAME).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        slowest = report["slowest_pages"][:1]
+        log_append(log, f"[REPORT] {RUN_REPORT_NAME}: {report['throughput']['pages_per_sec']} ページ/秒"
+                        + (f" ／ 最も遅いページ {slowest[0]['seconds']:.2f} 秒 ({slowest[0]['path']})" if slowest else ""))
+        if progress_cb: progress_cb(100)
+        log_append(log, f"=== DONE === 出力: {out_root}")
+    return summary
+
+# ----------------------------------------------------------------------------------
+# サイト全体のバックアップ（スペースごとに分けて並列変換）
+# ----------------------------------------------------------------------------------
+SITE_REPORT_NAME = "site_report.json"
+SITE_DIR_SUFFIX = "AllSpaces"          # 自動作成する出力先の名前（日時_AllSpaces）
+UNKNOWN_SPACE_KEY = "UnknownSpace"
+
+def _attachment_entries(model: BackupModel) -> set[tuple[str | None, str | None]]:
+    # attachments/ 以下の (ページID, 添付ID) の一覧（Zip は中央ディレクトリ，フォルダは2階層目までを見るだけで中身は読まない）
+    if not model.attach_root:
+        return set()
+    if model.is_zip:
+        root = model.attach_root
+        with zipfile.ZipFile(model.source, "r") as zf:
+            return {_entry_ids(Path(n[len(root):])) for n in zf.namelist()
+                    if n.startswith(root) and not n.endswith("/")}
+    root = Path(model.attach_root)
+    entries = set()
+    for page_dir in root.iterdir():
+        if page_dir.is_file():
+            entries.add((None, None))
+            continue
+        for att_dir in page_dir.iterdir():
+            entries.add((page_dir.name, att_dir.name if att_dir.is_dir() else None))
+    return entries
+
+def split_backup_model(model: BackupModel) -> list[BackupModel]:
+    """
+    サイト全体のバックアップのモデルをスペースごとのモデルに分ける（ページ・本文・添付をページの spaceId で振り分け）．
+    spaceId の無い旧版は元ページのスペースへ．スペースの分からないページと，どのページにも属さない添付は
+    spaceId "" のモデル（UNKNOWN_SPACE_KEY）にまとめる．
+    各モデルの attach_pages は展開する attachments/<ページID> の集合で，どの添付もちょうど1つのモデルに入る．
+    戻り値はページ数の多い順（大きいスペースから並列に流すため）．
+    """
+    sid_of = {pid: meta.get("spaceId") or "" for pid, meta in model.pages.items()}
+    for pid, meta in model.pages.items():
+        if not sid_of[pid] and meta.get("originalId"):
+            sid_of[pid] = sid_of.get(meta["originalId"], "")
+
+    parts: dict[str, BackupModel] = {}
+
+    def part(sid: str) -> BackupModel:
+        m = parts.get(sid)
+        if m is None:
+            m = parts[sid] = BackupModel(source=model.source, is_zip=model.is_zip, entities_name=model.entities_name,
+                                         attach_root=model.attach_root, attach_pages=set(),
+                                         spaces={sid: model.spaces[sid]} if sid in model.spaces else {})
+        return m
+
+    for pid, meta in model.pages.items():
+        m = part(sid_of[pid])
+        m.pages[pid] = meta
+        if pid in model.bodies:
+            m.bodies[pid] = model.bodies[pid]
+
+    # 添付はファイルの置き場所（attachments/<ページID>/<添付ID>）で振り分け，添付のメタ情報も同じモデルへ
+    att_part: dict[str, BackupModel] = {}
+    for pid, aid in _attachment_entries(model):
+        m = part(sid_of.get(pid, ""))
+        m.attach_pages.add(pid)
+        if aid:
+            att_part[aid] = m
+    for aid in set(model.att_title) | set(model.att_to_page) | set(model.att_filename) | set(model.att_version):
+        m = att_part.get(aid) or parts.get(sid_of.get(model.att_to_page.get(aid), ""))
+        if m is None:
+            continue
+        for src, dst in ((model.att_title, m.att_title), (model.att_to_page, m.att_to_page),
+                         (model.att_filename, m.att_filename), (model.att_version, m.att_version)):
+            if aid in src:
+                dst[aid] = src[aid]
+    return sorted(parts.values(), key=lambda m: len(m.pages), reverse=True)
+
+def _space_dir_names(models: list[BackupModel]) -> list[str]:
+    # スペースごとの出力フォルダ名（スペースキー．大文字小文字だけ違う同名は _2, _3 …）
+    names, used = [], set()
+    for m in models:
+        base = sanitize(m.space_key) or UNKNOWN_SPACE_KEY
+        name, n = base, 1
+        while name.lower() in used:
+            n += 1
+            name = f"{base}_{n}"
+        used.add(name.lower())
+        names.append(name)
+    return names
+
+def _site_page_link_index(models: list[BackupModel], html_roots: list[Path]) -> PageLinkIndex:
+    # 全スペースの描画ページ（現行版・出力パスごとの勝者）を generate_html_from_xml_root と同じ規則で集めて1つの索引にする
+    index = PageLinkIndex()
+    for m, html_root in zip(models, html_roots):
+        pages_map = {pid: meta for pid, meta in m.pages.items() if meta.get("status", "current") == "current"}
+        entries = []
+        for pid in pages_map:
+            chain = _build_chain(pid, pages_map)
+            page_dir, page_title = _dir_for_chain(html_root, chain)
+            entries.append((pid, chain, page_dir, page_title))
+        entries = _pick_page_winners(entries, pages_map, None, StageTimer())
+        build_page_link_index(entries, pages_map, m.spaces, index=index)
+    return index
+
+_SPACE_CTX: dict = {}
+SPACE_POLL_SECONDS = 0.1   # 並列のサイト変換で，親がワーカーのログ中継と中止要求を確認する間隔
+
+def _relay_space_logs(log_queue, log) -> None:
+    # ワーカーがキューへ送ったログ行を親の log へ書き出す（キューが無ければ何もしない）
+    if log_queue is None:
+        return
+    while True:
+        try:
+            line = log_queue.get_nowait()
+        except queue.Empty:
+            return
+        log_append(log, line)
+
+def _init_space_worker(ctx: dict):
+    # スペース変換ワーカーの初期化：全スペース共通の ri:page 索引をワーカーごとに1回だけ受け取る
+    _SPACE_CTX.update(ctx)
+
+def _convert_space_task(task: tuple, log=None, ctx: dict | None = None) -> dict:
+    # 1スペース分の変換（プロセスプールのワーカーでも親でも同じ）．例外は要約に変換して返す
+    # ctx は全スペース共通の設定（page_index，並列時は中継用の log_queue と中止用の cancel）．
+    # 省略時は _init_space_worker で受け取った分
+    input_path, out_root, model, opts = task
+    ctx = ctx if ctx is not None else _SPACE_CTX
+    if log is None:
+        prefix = f"[{model.space_key}] "
+        if ctx.get("log_queue") is not None:
+            log = lambda line, q=ctx["log_queue"]: q.put(prefix + str(line))
+        else:
+            log = _stream_log_sink(prefix) if opts["log_stream"] else _null_log
+    started = time.perf_counter()
+    try:
+        summary = convert_backup(input_path, out_root, dry_run=opts["dry_run"], log=log, model=model,
+                                 workers=opts["workers"], incremental=opts["incremental"], dedup=opts["dedup"],
+                                 version_mode=opts["versions"], page_history=opts["page_history"],
+                                 link_mode=opts["link_mode"], page_index=ctx.get("page_index"),
+                                 cancel=ctx.get("cancel"))
+        summary["status"] = "ok"
+    except ConversionCancelled:
+        raise
+    except Exception as e:
+        summary = {"input": str(input_path), "out_root": str(out_root), "space_key": model.space_key,
+                   "status": "error", "error": f"{type(e).__name__}: {e}",
+                   "seconds": round(time.perf_counter() - started, 3)}
+    return summary
+
+def _write_site_index(out_root: Path, rows: list[tuple[str, dict]]) -> Path:
+    # out_root/index.html：スペースごとの index.html へのリンク一覧
+    items = []
+    for name, summary in rows:
+        key = html.escape(summary.get("space_key") or name)
+        if summary.get("status") == "ok":
+            href = _quote_href_path(f"{name}/index.html")
+            items.append(f'<li><a href="{href}">{key}</a> <span class="meta">ページ {summary.get("pages", 0)} '
+                         f'／ 添付 {summary.get("attachments", 0)}</span></li>')
+        else:
+            items.append(f'<li>{key} <span class="meta">変換に失敗: {html.escape(summary.get("error", ""))}</span></li>')
+    text = f"""<!DOCTYPE html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<title>スペース一覧</title>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<style>
+    body {{ margin: 24px; font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", system-ui, sans-serif; background: #f5f5f5; }}
+    li {{ margin: 4px 0; }}
+    .meta {{ color: #6b7280; font-size: 12px; margin-left: 8px; }}
+</style>
+</head>
+<body>
+<h1>スペース一覧（{len(rows)}）</h1>
+<ul>
+{chr(10).join(items)}
+</ul>
+</body>
+</html>
+"""
+    path = out_root / "index.html"
+    path.write_text(text, encoding="utf-8")
+    return path
+
+def convert_site_backup(input_path: Path, out_root: Path | None = None, *, dry_run: bool = False,
+                        log=None, progress_cb=None, model: BackupModel | None = None,
+                        use_cache: bool = False, jobs: int = 0, workers: int = 1,
+                        cancel: threading.Event | None = None, incremental: bool = False,
+                        dedup: bool = DEDUP_ATTACHMENTS, version_mode: str = ATTACHMENT_VERSION_MODE,
+                        page_history: bool = PAGE_HISTORY, log_stream: bool = False,
+                        link_mode: str = "copy") -> dict:
+    """
+    サイト全体のバックアップ（複数スペース入りの Zip/フォルダ）をスペースごとに分けて変換し，結果の要約を返す．
+    entities.xml はここで1回だけ解析し，split_backup_model でスペース別のモデルに分ける．
+    各スペースは out_root/<スペースキー>/ に convert_backup と同じ構成で出力する（添付は自分のページの分だけ読む）．
+    ri:page リンクの索引は全スペース共通なので，他のスペースのページへのリンクも <スペースキー>/html_pages をまたいで解決する．
+    jobs 個のワーカープロセスでスペースを並行して変換する（1スペース内の並列数は workers，0=CPU数）．
+    log_stream=True ならワーカーのログを stderr へ「[スペースキー] 」付きで流す．
+    False なら（log を渡した時）ワーカーのログを Manager のキュー経由で親の log へ「[スペースキー] 」付きで中継する．
+    cancel はワーカープロセスにも Manager のイベントで伝わり，変換中のスペースも次のログ/進捗出力の時点で止まる．
+    out_root 直下にはスペース一覧の index.html と，スペースごとの要約をまとめた site_report.json を書き出す．
+    """
+    log = log if log is not None else _null_log
+    relay_logs = not log_stream and log is not _null_log   # ワーカーのログを親の log へ中継する
+    if cancel is not None:
+        sink = log
+        log = _cancellable(lambda line: log_append(sink, line), cancel)
+        progress_cb = _cancellable(progress_cb, cancel)
+    started = time.perf_counter()
+    input_path = Path(input_path)
+    if model is None:
+        model = load_backup_model(input_path, log, use_cache=use_cache)
+    spaces = split_backup_model(model)
+    if out_root is None:
+        out_root = input_path.parent / f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{SITE_DIR_SUFFIX}"
+        log_append(log, f"[OUT] 出力先（自動）: {out_root}")
+    names = _space_dir_names(spaces)
+    # ri:page リンクはスペースをまたぐので，索引は全スペースの出力先から1つだけ作って各スペースへ渡す
+    page_index = _site_page_link_index(spaces, [out_root / name / HTML_DIR_NAME for name in names])
+    jobs = max(1, min(_resolve_workers(jobs), len(spaces)))
+    log_append(log, f"=== サイト変換: {len(spaces)} スペース（{jobs} プロセス） ===")
+
+    opts = {"dry_run": dry_run, "workers": workers, "incremental": incremental, "dedup": dedup,
+            "versions": version_mode, "page_history": page_history, "log_stream": log_stream,
+            "link_mode": link_mode}
+    ctx = {"page_index": page_index}   # タスクごとではなくワーカーごとに1回だけ送る
+    tasks = [(input_path, out_root / name, m, opts) for name, m in zip(names, spaces)]
+    results: dict[str, dict] = {}
+
+    def finished(name: str, summary: dict) -> None:
+        results[name] = summary
+        if summary.get("status") == "ok":
+            log_append(log, f"[SPACE] {summary.get('space_key')}: ページ {summary.get('pages', 0)} ／ "
+                            f"添付 {summary.get('attachments', 0)} ／ {summary.get('seconds', 0):.1f} 秒 → {name}/")
+        else:
+            log_append(log, f"[ERROR] {name}: {summary.get('error')}")
+        if progress_cb:
+            progress_cb(len(results) * 100 / len(tasks))
+
+    if jobs <= 1:
+        for name, task in zip(names, tasks):
+            key = task[2].space_key
+            finished(name, _convert_space_task(task, log=lambda line, key=key: log_append(log, f"[{key}] {line}"),
+                                               ctx=ctx))
+    else:
+        from concurrent.futures import wait, FIRST_COMPLETED
+        # ログの中継と中止の伝達は Manager のキュー/イベントで（ワーカーは別プロセスなので threading.Event は見えない）
+        manager = multiprocessing.get_context("spawn").Manager() if relay_logs or cancel is not None else None
+        try:
+            if manager is not None:
+                ctx["log_queue"] = manager.Queue() if relay_logs else None
+                ctx["cancel"] = manager.Event()
+            with _process_pool(jobs, initializer=_init_space_worker, initargs=(ctx,)) as ex:
+                futures = {ex.submit(_convert_space_task, task): name for name, task in zip(names, tasks)}
+                pending = set(futures)
+                try:
+                    while pending:
+                        done, pending = wait(pending, timeout=SPACE_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                        _relay_space_logs(ctx.get("log_queue"), log)
+                        if cancel is not None and cancel.is_set():
+                            raise ConversionCancelled()
+                        for fut in done:
+                            finished(futures[fut], fut.result())
+                except BaseException:
+                    if ctx.get("cancel") is not None:
+                        ctx["cancel"].set()
+                    for f in futures:
+                        f.cancel()
+                    raise
+        finally:
+            if manager is not None:
+                manager.shutdown()
+
+    rows = [(name, results[name]) for name in names]
+    failed = sum(1 for _name, r in rows if r.get("status") != "ok")
+    summary = {
+        "input": str(input_path), "out_root": str(out_root), "dry_run": dry_run, "jobs": jobs,
+        "spaces": [{"space_key": r.get("space_key"), "dir": name, "status": r.get("status"),
+                    "pages": r.get("pages", 0), "attachments": r.get("attachments", 0),
+                    "seconds": r.get("seconds"), **({"error": r["error"]} if "error" in r else {})}
+                   for name, r in rows],
+        "pages": sum(r.get("pages", 0) for _name, r in rows),
+        "attachments": sum(r.get("attachments", 0) for _name, r in rows),
+        "failed": failed,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    if not dry_run:
+        out_root.mkdir(parents=True, exist_ok=True)
+        _write_site_index(out_root, rows)
+        report = {"tool": APP_TITLE, "created": datetime.now().isoformat(timespec="seconds"), **summary}
+        (out_root / SITE_REPORT_NAME).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    if progress_cb: progress_cb(100)
+    log_append(log, f"=== DONE === {len(rows) - failed}/{len(rows)} スペース（{summary['seconds']:.1f} 秒） 出力: {out_root}")
+    return summary
+
+# ----------------------------------------------------------------------------------
+# CLI（ヘッドレス一括変換）
+# ----------------------------------------------------------------------------------
+def _stream_log_sink(prefix: str, stream=None):
+    # 1行ずつ stderr へ（並列時に混ざっても読めるよう入力名を前置）
+    stream = stream or sys.stderr
+    def sink(line: str) -> None:
+        for ln in str(line).splitlines() or [""]:
+            stream.write(f"{prefix}{ln}\n")
+        stream.flush()
+    return sink
+
+def _stream_progress_sink(prefix: str, stream=None, step: int = 10):
+    # 進捗は step% 刻みでだけ出力する
+    stream = stream or sys.stderr
+    last = [-step]
+    def sink(value: float) -> None:
+        v = int(value)
+        if v >= last[0] + step or (v >= 100 > last[0]):
+            last[0] = v
+            stream.write(f"{prefix}[PROGRESS] {v}%\n")
+            stream.flush()
+    return sink
+
+def _cli_out_roots(inputs: list[Path], out_dir: Path | None) -> list[Path | None]:
+    # --out 指定時は <out>/<入力名>（同名は _2, _3 …）．未指定なら GUI と同じ自動命名
+    if out_dir is None:
+        return [None] * len(inputs)
+    roots, used = [], set()
+    for p in inputs:
+        base = sanitize(p.stem if p.is_file() else p.name) or "backup"
+        name, n = base, 1
+        while name.lower() in used:
+            n += 1
+            name = f"{base}_{n}"
+        used.add(name.lower())
+        roots.append(out_dir / name)
+    return roots
+
+def _cli_convert_one(task: tuple) -> dict:
+    # プロセスプールで実行される1件分の変換（例外は要約に変換して返す）
+    input_path, out_root, opts = task
+    prefix = f"[{input_path.name}] " if opts["prefix_log"] else ""
+    log = _null_log if opts["quiet"] else _stream_log_sink(prefix)
+    progress = None if opts["quiet"] else _stream_progress_sink(prefix)
+    started = time.perf_counter()
+    if out_root is not None:
+        log_append(log, f"[OUT] 出力先: {out_root}")
+    try:
+        if opts["per_space"]:
+            # スペースごとに分けて変換（--workers はスペースを並行させるプロセス数）
+            summary = convert_site_backup(input_path, out_root, dry_run=opts["dry_run"], log=log, progress_cb=progress,
+                                          use_cache=opts["cache"], jobs=opts["workers"], workers=1,
+                                          incremental=opts["incremental"], dedup=opts["dedup"],
+                                          version_mode=opts["versions"], page_history=opts["page_history"],
+                                          log_stream=not opts["quiet"], link_mode=opts["link_mode"])
+            summary["status"] = "error" if summary["failed"] else "ok"
+            if summary["failed"]:
+                summary["error"] = f"{summary['failed']} スペースの変換に失敗"
+        else:
+            summary = convert_backup(input_path, out_root, dry_run=opts["dry_run"], log=log, progress_cb=progress,
+                                     use_cache=opts["cache"], workers=opts["workers"],
+                                     incremental=opts["incremental"], dedup=opts["dedup"],
+                                     version_mode=opts["versions"], page_history=opts["page_history"],
+                                     link_mode=opts["link_mode"])
+            summary["status"] = "ok"
+    except Exception as e:
+        summary = {"input": str(input_path), "out_root": str(out_root) if out_root else None,
+                   "status": "error", "error": f"{type(e).__name__}: {e}",
+                   "seconds": round(time.perf_counter() - started, 3)}
+        log_append(log, f"[ERROR] {summary['error']}")
+    return summary
+
+def _build_cli_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(prog="klefki-conflu", description=f"{APP_TITLE}: Confluence バックアップを HTML に変換")
+    sub = ap.add_subparsers(dest="command", required=True)
+    cv = sub.add_parser("convert", help="Zip/フォルダを一括変換（結果の要約を JSON で標準出力へ）")
+    cv.add_argument("inputs", nargs="+", type=Path, help="Confluence バックアップの .zip またはフォルダ")
+    cv.add_argument("--out", type=Path, default=None, help="出力先の親フォルダ（入力ごとに <out>/<入力名> を作成）")
+    cv.add_argument("--jobs", "-j", type=int, default=1, help="同時に変換するバックアップ数（プロセス並列，0=CPU数）")
+    cv.add_argument("--workers", type=int, default=0,
+                    help="1件あたりの並列数（添付展開スレッド/描画プロセス，0=CPU数÷jobs）")
+    cv.add_argument("--dry-run", action="store_true", help="書き込みせず計画だけ表示")
+    cv.add_argument("--cache", action="store_true", help="entities.xml の解析結果をキャッシュ")
+    cv.add_argument("--incremental", action="store_true",
+                    help="--out 配下の前回出力を差分更新（変わったページ/添付だけ作り直す）")
+    cv.add_argument("--versions", choices=ATTACHMENT_VERSION_MODES, default=ATTACHMENT_VERSION_MODE,
+                    help=f"添付の版: latest=現行版のみ / history=旧版を {ATT_HISTORY_DIR_NAME} へ / all=全版")
+    cv.add_argument("--page-history", action="store_true",
+                    help=f"ページの版履歴（最新版＋差分）と閲覧ページを {HTML_DIR_NAME}/{HISTORY_DIR_NAME} に出力")
+    cv.add_argument("--per-space", action="store_true",
+                    help="スペースごとに <out>/<入力名>/<スペースキー>/ へ分けて出力（--workers 個のプロセスでスペースを並行変換）")
+    cv.add_argument("--no-dedup", dest="dedup", action="store_false",
+                    help="同じ内容の添付をハードリンクにまとめない（すべて個別に書き出す）")
+    cv.add_argument("--link-mode", choices=LINK_MODES, default="copy",
+                    help="フォルダ入力の添付の置き方: copy=コピー / hardlink=ハードリンク / reflink=reflink（不可ならコピー）")
+    cv.add_argument("--quiet", "-q", action="store_true", help="ログ/進捗を出力しない（要約のみ）")
+
+    # 合成バックアップの条件（synth / bench 共通）
+    synth = argparse.ArgumentParser(add_help=False)
+    synth.add_argument("--depth", type=int, default=4, help="ページツリーの最大の深さ")
+    synth.add_argument("--attachments", type=int, default=3, help="1ページあたりの平均添付数")
+    synth.add_argument("--attachment-kb", type=int, default=64, help="添付の平均サイズ（KiB）")
+    synth.add_argument("--versions", type=int, default=2, help="ページ・添付の版数")
+    synth.add_argument("--macros", default=None,
+                       help=f"マクロの比率 例: image=3,code=1（種類: {', '.join(SYNTH_MACROS)}）")
+    synth.add_argument("--macros-per-page", type=int, default=8, help="1ページの本文に入れるマクロ数")
+    synth.add_argument("--spaces", type=int, default=1, help="スペース数")
+    synth.add_argument("--seed", type=int, default=0)
+
+    sy = sub.add_parser("synth", parents=[synth], help="計測用の合成バックアップ（Zip）を作る")
+    sy.add_argument("output", type=Path, help="出力する .zip")
+    sy.add_argument("--pages", type=int, nargs=1, default=[200], help="ページ数")
+
+    bn = sub.add_parser("bench", parents=[synth], help="合成バックアップを変換して段階別の処理時間を計測")
+    bn.add_argument("--pages", type=int, nargs="+", default=[200, 800], help="ページ数（複数指定でスケーリングを計測）")
+    bn.add_argument("--workers", type=int, nargs="+", default=[1], help="並列数（複数指定で並列の効き方を計測）")
+    bn.add_argument("--repeat", type=int, default=1, help="各条件の試行回数（最速の回を採用）")
+    bn.add_argument("--work", type=Path, default=None, help="作業フォルダ（省略時は一時フォルダ．合成バックアップを再利用）")
+    bn.add_argument("--keep", action="store_true", help="変換結果を削除せずに残す（--work 指定時）")
+    bn.add_argument("--json", type=Path, default=None, help="計測結果を JSON で保存")
+    bn.add_argument("--quiet", "-q", action="store_true", help="変換ログを出力しない")
+    return ap
+
+def main(argv: list[str] | None = None) -> int:
+    """CLI エントリポイント．終了コード: 0=全件成功 / 1=失敗あり / 2=引数エラー"""
+    args = _build_cli_parser().parse_args(argv)
+    if args.command in ("synth", "bench"):
+        return _bench_main(args)
+    inputs = [p.expanduser() for p in args.inputs]
+    missing = [str(p) for p in inputs if not p.exists()]
+    if missing:
+        print(f"入力が見つかりません: {', '.join(missing)}", file=sys.stderr)
+        return 2
+
+    if args.incremental and args.out is None:
+        print("--incremental には --out（前回の出力先）が必要です", file=sys.stderr)
+        return 2
+
+    jobs = min(_resolve_workers(args.jobs), len(inputs))
+    workers = args.workers if args.workers > 0 else max(1, DEFAULT_WORKERS // jobs)
+    opts = {"dry_run": args.dry_run, "cache": args.cache, "quiet": args.quiet,
+            "workers": workers, "prefix_log": len(inputs) > 1, "incremental": args.incremental,
+            "dedup": args.dedup, "versions": args.versions, "page_history": args.page_history,
+            "per_space": args.per_space, "link_mode": args.link_mode}
+    tasks = [(p, out, opts) for p, out in zip(inputs, _cli_out_roots(inputs, args.out))]
+
+    started = time.perf_counter()
+    if jobs <= 1:
+        results = [_cli_convert_one(t) for t in tasks]
+    else:
+        with _process_pool(jobs) as ex:
+            results = list(ex.map(_cli_convert_one, tasks))
+
+    failed = sum(1 for r in results if r.get("status") != "ok")
+    report = {"ok": len(results) - failed, "failed": failed,
+              "seconds": round(time.perf_counter() - started, 3), "results": results}
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+    return 1 if failed else 0
+
+# ----------------------------------------------------------------------------------
+# ベンチマーク（合成バックアップの生成＋段階別の計測）
+# ----------------------------------------------------------------------------------
+SYNTH_MACROS = ("image", "view-file", "attachment-link", "multimedia", "page-link", "code", "info", "task-list", "table")
+BENCH_STAGES = ("parse", "attachments", "html.collect", "html.sidebar", "html.blank", "html.assets",
+                "html.render", "html.search", "html.index")
+
+_SYNTH_WORDS = ("設計", "仕様", "会議録", "議事録", "手順書", "運用", "Design", "Notes", "Spec", "Release",
+                "FAQ", "Runbook", "API", "テスト計画", "障害報告")
+_SYNTH_TEXT = ("本ページは合成データです。", "Confluence から変換した HTML の速度を測るための文章です。",
+               "The quick brown fox jumps over the lazy dog.", "日本語と English が混在した段落。",
+               "Lorem ipsum dolor sit amet, consectetur adipiscing elit.", "検索インデックスの対象になる本文。")
+_SYNTH_EXTS = (".png", ".jpg", ".pdf", ".txt", ".docx", ".mp4", ".xlsx")
+
+def _parse_macro_mix(text: str | None) -> dict[str, int]:
+    # "image=3,code=1" → {"image": 3, "code": 1}（省略時は全種類を同じ重みで）
+    if not text:
+        return {m: 1 for m in SYNTH_MACROS}
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in SYNTH_MACROS:
+            raise ValueError(f"未知のマクロ: {name}（{', '.join(SYNTH_MACROS)}）")
+        mix[name] = int(weight or 1)
+    return mix
+
+def make_synthetic_backup(path: Path, *, pages: int = 200, depth: int = 4, attachments: int = 3,
+                          attachment_kb: int = 64, versions: int = 2, macros: dict | None = None,
+                          macros_per_page: int = 8, spaces: int = 1, seed: int = 0) -> dict:
+    """
+    Confluence のスペースエクスポートに似た合成バックアップ（entities.xml ＋ attachments/）を Zip で作る．
+    pages: ページ数 / depth: ページツリーの最大の深さ / attachments: 1ページあたりの平均添付数
+    attachment_kb: 添付の平均サイズ / versions: ページ・添付の版数（旧版は originalVersion 付きで出力）
+    macros: マクロ種別（SYNTH_MACROS）→ 重み / macros_per_page: 1ページの本文に入れるマクロ数
+    戻り値は生成した件数とバイト数．同じ引数と seed なら同じ内容になる．
+    """
+    import random
+    from xml.sax.saxutils import escape
+    rnd = random.Random(seed)
+    mix = macros or {m: 1 for m in SYNTH_MACROS}
+    kinds, weights = list(mix), list(mix.values())
+    versions = max(1, versions)
+    stats = {"pages": pages, "page_objects": 0, "attachments": 0, "attachment_files": 0,
+             "attachment_bytes": 0, "current_attachment_bytes": 0, "entities_bytes": 0}
+
+    def cdata(text: str) -> str:
+        return "<![CDATA[" + text.replace("]]>", "]]]]><![CDATA[>") + "]]>"
+
+    def ref(name: str, cls: str, oid) -> str:
+        return f'<property name="{name}" class="{cls}" package="x"><id name="id">{oid}</id></property>'
+
+    next_id = [100000]
+    def new_id() -> int:
+        next_id[0] += 1
+        return next_id[0]
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    logo = rnd.randbytes(2048)
+    # 添付を Zip へ書きながら entities.xml は一時ファイルへ流し，最後に Zip へ移す
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf, tempfile.TemporaryFile() as ent:
+        def emit(xml: str) -> None:
+            data = xml.encode("utf-8")
+            stats["entities_bytes"] += len(data)
+            ent.write(data)
+
+        emit('<?xml version="1.0" encoding="UTF-8"?>\n<hibernate-generic datetime="2024-01-01 00:00:00">\n')
+        space_ids = []
+        for s in range(max(1, spaces)):
+            sid = new_id()
+            space_ids.append(sid)
+            emit(f'<object class="Space" package="x"><id name="id">{sid}</id>'
+                 f'<property name="name">{cdata(f"Synthetic {s}")}</property>'
+                 f'<property name="key">{cdata(f"SYN{s}")}</property></object>\n')
+
+        tree: list[tuple[int, int, int, str]] = []   # (ページID, スペースID, 深さ, タイトル)
+        for i in range(pages):
+            pid, sid = new_id(), space_ids[i % len(space_ids)]
+            parents = [t for t in tree[-200:] if t[1] == sid and t[2] < depth]
+            parent = rnd.choice(parents) if parents and rnd.random() < 0.85 else None
+            title = f"{rnd.choice(_SYNTH_WORDS)} {i}"
+            tree.append((pid, sid, parent[2] + 1 if parent else 1, title))
+
+            # 添付（版ごとに attachments/<pageId>/<attId>/<版>）
+            names = []
+            for k in range(rnd.randint(0, 2 * attachments)):
+                aid = new_id()
+                ext = rnd.choice(_SYNTH_EXTS)
+                name = f"{rnd.choice(('image', '資料', 'diagram', 'report'))}_{k}{ext}"
+                names.append(name)
+                stats["attachments"] += 1
+                emit(f'<object class="Attachment" package="x"><id name="id">{aid}</id>'
+                     f'<property name="title">{cdata(name)}</property><property name="version">{versions}</property>'
+                     f'<property name="contentStatus">{cdata("current")}</property>'
+                     f'{ref("containerContent", "Page", pid)}</object>\n')
+                for v in range(1, versions + 1):
+                    if v < versions:
+                        emit(f'<object class="Attachment" package="x"><id name="id">{new_id()}</id>'
+                             f'<property name="title">{cdata(name)}</property><property name="version">{v}</property>'
+                             f'{ref("originalVersion", "Attachment", aid)}{ref("containerContent", "Page", pid)}</object>\n')
+                    size = max(1, int(attachment_kb * 1024 * rnd.uniform(0.5, 1.5)))
+                    data = logo if rnd.random() < 0.2 else rnd.randbytes(size)
+                    zf.writestr(f"attachments/{pid}/{aid}/{v}", data)
+                    stats["attachment_files"] += 1
+                    stats["attachment_bytes"] += len(data)
+                    if v == versions:
+                        stats["current_attachment_bytes"] += len(data)
+
+            # 本文（段落＋マクロの混在）
+            parts = [f"<h2>{escape(title)}</h2>"]
+            for kind in rnd.choices(kinds, weights, k=macros_per_page):
+                parts.append(f"<p>{escape(rnd.choice(_SYNTH_TEXT))} {escape(rnd.choice(_SYNTH_TEXT))}</p>")
+                att = escape(rnd.choice(names)) if names else None
+                if kind == "image" and att:
+                    parts.append(f'<p><ac:image ac:height="150"><ri:attachment ri:filename="{att}" /></ac:image></p>')
+                elif kind == "view-file" and att:
+                    parts.append(f'<ac:structured-macro ac:name="view-file"><ac:parameter ac:name="name">'
+                                 f'<ri:attachment ri:filename="{att}" /></ac:parameter></ac:structured-macro>')
+                elif kind == "attachment-link" and att:
+                    parts.append(f'<p><ac:link><ri:attachment ri:filename="{att}" />'
+                                 f'<ac:plain-text-link-body>{cdata(att)}</ac:plain-text-link-body></ac:link></p>')
+                elif kind == "multimedia" and att:
+                    parts.append(f'<ac:structured-macro ac:name="multimedia"><ac:parameter ac:name="name">'
+                                 f'<ri:attachment ri:filename="{att}" /></ac:parameter></ac:structured-macro>')
+                elif kind == "page-link" and tree:
+                    other = escape(rnd.choice(tree)[3])
+                    parts.append(f'<p><ac:link><ri:page ri:content-title="{other}" />'
+                                 f'<ac:link-body>{other}</ac:link-body></ac:link></p>')
+                elif kind == "code":
+                    parts.append('<ac:structured-macro ac:name="code"><ac:parameter ac:name="language">python'
+                                 '</ac:parameter><ac:plain-text-body>' + cdata("for i in range(10):\n    print(i < 5)")
+                                 + '</ac:plain-text-body></ac:structured-macro>')
+                elif kind == "info":
+                    parts.append('<ac:structured-macro ac:name="info"><ac:rich-text-body><p>'
+                                 f'{escape(rnd.choice(_SYNTH_TEXT))}</p></ac:rich-text-body></ac:structured-macro>')
+                elif kind == "task-list":
+                    parts.append('<ac:task-list><ac:task><ac:task-status>complete</ac:task-status>'
+                                 '<ac:task-body>done</ac:task-body></ac:task><ac:task><ac:task-status>incomplete'
+                                 '</ac:task-status><ac:task-body>todo</ac:task-body></ac:task></ac:task-list>')
+                elif kind == "table":
+                    rows = "".join(f"<tr><td>{r}</td><td>{escape(rnd.choice(_SYNTH_WORDS))}</td></tr>" for r in range(5))
+                    parts.append(f"<table><tbody><tr><th>No</th><th>Item</th></tr>{rows}</tbody></table>")
+
+            parent_xml = ref("parent", "Page", parent[0]) if parent else ""
+            emit(f'<object class="Page" package="x"><id name="id">{pid}</id>'
+                 f'<property name="title">{cdata(title)}</property>{ref("space", "Space", sid)}{parent_xml}'
+                 f'<property name="version">{versions}</property><property name="contentStatus">{cdata("current")}</property>'
+                 f'<property name="lastModificationDate">2024-01-01 10:00:00.000</property></object>\n')
+            emit(f'<object class="BodyContent" package="x"><id name="id">{new_id()}</id>'
+                 f'<property name="body">{cdata("".join(parts))}</property>{ref("content", "Page", pid)}'
+                 f'<property name="bodyType">2</property></object>\n')
+            stats["page_objects"] += 1
+            for v in range(1, versions):
+                hid = new_id()
+                emit(f'<object class="Page" package="x"><id name="id">{hid}</id>'
+                     f'<property name="title">{cdata(title)}</property>{ref("space", "Space", sid)}'
+                     f'<property name="version">{v}</property><property name="contentStatus">{cdata("current")}</property>'
+                     f'{ref("originalVersion", "Page", pid)}'
+                     f'<property name="lastModificationDate">2023-12-01 10:00:00.000</property></object>\n')
+                emit(f'<object class="BodyContent" package="x"><id name="id">{new_id()}</id>'
+                     f'<property name="body">{cdata(f"<p>{escape(title)} v{v}</p>")}</property>'
+                     f'{ref("content", "Page", hid)}<property name="bodyType">2</property></object>\n')
+                stats["page_objects"] += 1
+        emit("</hibernate-generic>\n")
+        ent.seek(0)
+        with zf.open("entities.xml", "w", force_zip64=True) as dst:
+            shutil.copyfileobj(ent, dst, 1 << 20)
+        zf.writestr("exportDescriptor.properties", "exportType=space\nspaceKey=SYN0\ncreatedByBenchmark=1\n")
+    stats["zip_bytes"] = path.stat().st_size
+    return stats
+
+def _bench_synth_kwargs(args) -> dict:
+    return {"depth": args.depth, "attachments": args.attachments, "attachment_kb": args.attachment_kb,
+            "versions": args.versions, "macros": _parse_macro_mix(args.macros),
+            "macros_per_page": args.macros_per_page, "spaces": args.spaces, "seed": args.seed}
+
+def run_benchmark(page_counts: list[int], workers_list: list[int], work_dir: Path, *, repeat: int = 1,
+                  keep: bool = False, log=None, **synth) -> dict:
+    """
+    ページ数 × 並列数 の組み合わせごとに合成バックアップを convert_backup で変換し，段階別の時間と処理速度を返す．
+    合成バックアップは work_dir に置き，同じ条件なら再利用する．repeat 回のうち最速の回を採用する．
+    """
+    work_dir.mkdir(parents=True, exist_ok=True)
+    tag = hashlib.sha1(repr(sorted(synth.items())).encode("utf-8")).hexdigest()[:8]
+    rows = []
+    for pages in page_counts:
+        src = work_dir / f"synthetic_{pages}p_{tag}.zip"
+        stats_path = src.with_suffix(".json")
+        if src.exists() and stats_path.exists():
+            stats = json.loads(stats_path.read_text(encoding="utf-8"))
+        else:
+            stats = make_synthetic_backup(src, pages=pages, **synth)
+            stats_path.write_text(json.dumps(stats, indent=2), encoding="utf-8")
+        for workers in workers_list:
+            best = None
+            for _ in range(max(1, repeat)):
+                out = work_dir / f"out_{pages}p_w{workers}"
+                shutil.rmtree(out, ignore_errors=True)
+                timer = StageTimer()
+                started = time.perf_counter()
+                summary = convert_backup(src, out, log=log, workers=workers, timer=timer)
+                total = time.perf_counter() - started
+                if best is None or total < best[0]:
+                    best = (total, timer.stages, summary)
+                if not keep:
+                    shutil.rmtree(out, ignore_errors=True)
+            total, stages, summary = best
+
+            def rate(amount, stage):
+                wall = stages.get(stage, {}).get("wall", 0.0)
+                return round(amount / wall, 2) if wall > 0 else None
+            rows.append({
+                "pages": pages, "workers": workers, "seconds": round(total, 3),
+                "stages": {k: {"wall": round(v["wall"], 4), "cpu": round(v["cpu"], 4)} for k, v in stages.items()},
+                "throughput": {
+                    "pages_per_s": round(pages / total, 2) if total > 0 else None,
+                    "parse_mb_per_s": rate(stats["entities_bytes"] / 1e6, "parse"),
+                    "attachments_per_s": rate(summary["attachments"], "attachments"),
+                    "attachment_mb_per_s": rate(stats["current_attachment_bytes"] / 1e6, "attachments"),
+                    "render_pages_per_s": rate(summary["pages"], "html.render"),
+                },
+                "synthetic": stats,
+            })
+
+    # スケーリング：ページ数に対する 1000ページあたりの秒数 と 並列数に対する速度比
+    base = {}
+    for row in rows:
+        row["seconds_per_1k_pages"] = round(row["seconds"] / row["pages"] * 1000, 3) if row["pages"] else None
+        first = base.setdefault(row["pages"], row["seconds"])
+        row["speedup"] = round(first / row["seconds"], 2) if row["seconds"] > 0 else None
+    return {"params": {k: v for k, v in synth.items()}, "repeat": repeat, "cpu_count": os.cpu_count(), "runs": rows}
+
+def _format_benchmark(result: dict) -> str:
+    short = {"parse": "parse", "attachments": "attach", "html.collect": "collect", "html.sidebar": "sidebar",
+             "html.blank": "blank", "html.assets": "assets", "html.render": "render", "html.search": "search",
+             "html.index": "index"}
+    head = ["pages", "workers", "total[s]"] + [short[s] for s in BENCH_STAGES] + ["pages/s", "att MB/s", "s/1k", "speedup"]
+    lines = ["  ".join(f"{h:>8}" for h in head)]
+    for row in result["runs"]:
+        tp = row["throughput"]
+        cells = [row["pages"], row["workers"], f"{row['seconds']:.2f}"]
+        cells += [f"{row['stages'].get(s, {}).get('wall', 0.0):.2f}" for s in BENCH_STAGES]
+        cells += [tp["pages_per_s"], tp["attachment_mb_per_s"], row["seconds_per_1k_pages"], row["speedup"]]
+        lines.append("  ".join(f"{'-' if c is None else c:>8}" for c in cells))
+    return "\n".join(lines)
+
+def _bench_main(args) -> int:
+    try:
+        synth = _bench_synth_kwargs(args)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if args.command == "synth":
+        stats = make_synthetic_backup(args.output, pages=args.pages[0], **synth)
+        json.dump(stats, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return 0
+
+    log = None if args.quiet else _stream_log_sink("", sys.stderr)
+    if args.work is not None:
+        result = run_benchmark(args.pages, args.workers, args.work, repeat=args.repeat, keep=args.keep, log=log, **synth)
+    else:
+        with tempfile.TemporaryDirectory(prefix="klefki_bench_") as tmp:
+            result = run_benchmark(args.pages, args.workers, Path(tmp), repeat=args.repeat, log=log, **synth)
+    result["params"]["macros"] = synth["macros"]
+    print(_format_benchmark(result))
+    if args.json is not None:
+        args.json.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    return 0
+
 # ----------------------------------------------------------------------------------
 # ロゴ表示
 # ----------------------------------------------------------------------------------
@@ -2496,9 +5728,21 @@ def _split_dropped_files(data: str) -> list[str]:
 # ----------------------------------------------------------------------------------
 # GUI
 # ----------------------------------------------------------------------------------
-BaseTk = TkinterDnD.Tk if HAS_DND else tk.Tk
+def _gui_app() -> type:
+    # tkinter / tkinterdnd2 をここで初めて import し，Tk（DnD が使えれば TkinterDnD.Tk）を基底にした App を返す
+    global tk, ttk, filedialog, messagebox, tkfont, HAS_DND, DND_FILES, TkinterDnD
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox
+    import tkinter.font as tkfont
+    try:
+        from tkinterdnd2 import DND_FILES, TkinterDnD  # pip install tkinterdnd2
+        HAS_DND = True
+    except Exception:
+        HAS_DND = False
+    return type("App", (_AppWindow, TkinterDnD.Tk if HAS_DND else tk.Tk), {})
 
-class App(BaseTk):    
+class _AppWindow:
+    # GUI 本体（基底の Tk クラスは _gui_app() が import 後に決める）
     def __init__(self):
         super().__init__()
         self.title(APP_TITLE); self.minsize(740, 440)
@@ -2532,8 +5776,21 @@ class App(BaseTk):
         info.grid(row=1, column=0, columnspan=3, sticky="w", pady=(6,0))
 
         opt = ttk.Frame(frm); opt.grid(row=2, column=0, columnspan=3, sticky="w", pady=(4,0))
-        self.rehome_var = tk.BooleanVar(value=True)
-        ttk.Checkbutton(opt, text="復元後，ページタイトルで再配置（添付ファイル配下）", variable=self.rehome_var).pack(side="left")
+        self.cache_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(opt, text="解析結果をキャッシュ（同じZipの再変換を高速化）", variable=self.cache_var).pack(side="left")
+        self.dedup_var = tk.BooleanVar(value=DEDUP_ATTACHMENTS)
+        ttk.Checkbutton(opt, text="重複添付をハードリンク化", variable=self.dedup_var).pack(side="left", padx=(12,0))
+        self.history_var = tk.BooleanVar(value=ATTACHMENT_VERSION_MODE == "history")
+        ttk.Checkbutton(opt, text=f"添付の旧版も出力（{ATT_HISTORY_DIR_NAME}）", variable=self.history_var).pack(side="left", padx=(12,0))
+        self.page_history_var = tk.BooleanVar(value=PAGE_HISTORY)
+        ttk.Checkbutton(opt, text="ページの版履歴も出力", variable=self.page_history_var).pack(side="left", padx=(12,0))
+        self.per_space_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(opt, text="スペースごとに分けて出力", variable=self.per_space_var).pack(side="left", padx=(12,0))
+        self.incr_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(opt, text="前回の出力を差分更新", variable=self.incr_var).pack(side="left", padx=(12,0))
+        ttk.Label(opt, text="並列数").pack(side="left", padx=(12,0))
+        self.workers_var = tk.IntVar(value=DEFAULT_WORKERS)
+        ttk.Spinbox(opt, from_=1, to=64, width=4, textvariable=self.workers_var).pack(side="left", padx=(4,0))
 
         # 出力形式トグル（排他）
         self.md_var = tk.BooleanVar(value=True)
@@ -2553,7 +5810,15 @@ class App(BaseTk):
         btns = ttk.Frame(frm); btns.grid(row=3, column=0, columnspan=3, sticky="w", pady=(8,0))
         self.btn_dry = ttk.Button(btns, text="①ドライラン（計画表示）", command=lambda: self.run(True))
         self.btn_run = ttk.Button(btns, text="②実行（変更を反映）", command=lambda: self.run(False))
+        self.btn_cancel = ttk.Button(btns, text="中止", command=self.cancel_run, state="disabled")
         self.btn_dry.pack(side="left"); self.btn_run.pack(side="left", padx=(8,0))
+        self.btn_cancel.pack(side="left", padx=(8,0))
+
+        # 変換はワーカースレッドで実行し，ログ/進捗はキュー経由で after() タイマーからまとめて反映する
+        self._queue: queue.Queue = queue.Queue()
+        self._cancel = threading.Event()
+        self._worker: threading.Thread | None = None
+        self._events: list[tuple] = []
 
         # ログ（黒地・等幅）＋ 縦スクロールバー
         self.log = tk.Text(frm, height=28, wrap="none")
@@ -2643,7 +5908,8 @@ class App(BaseTk):
                 ok = True
             elif self.allow_dir_var.get() and p.is_dir():
                 ok = True
-        state = "normal" if ok else "disabled"
+        running = getattr(self, "_worker", None) is not None
+        state = "normal" if ok and not running else "disabled"
         self.btn_dry.config(state=state); self.btn_run.config(state=state)
         return ok
 
@@ -2663,74 +5929,137 @@ class App(BaseTk):
         except Exception:
             pass
 
+    def _workers(self) -> int:
+        try:
+            return max(1, int(self.workers_var.get()))
+        except Exception:
+            return 1
+
     def run(self, dry_run: bool):
+        if self._worker is not None:
+            return
         if not self.validate_input():
             messagebox.showwarning("注意", "入力が未指定です．")
             return
 
+        in_p = Path(self.in_var.get().strip())
+        # 差分更新では前回の出力フォルダ（klefki_manifest.json のある場所）を選ばせる
+        prev_out = None
+        if self.incr_var.get():
+            d = filedialog.askdirectory(title="前回の出力フォルダを選択")
+            if not d:
+                return
+            prev_out = Path(d)
+
         # 実行中はボタンを無効化し，進捗リセット
         self.btn_dry.config(state="disabled")
         self.btn_run.config(state="disabled")
+        self.btn_cancel.config(state="normal")
         self._set_progress(0)
 
-        in_p = Path(self.in_var.get().strip())
-        out_root = _build_auto_out_root(in_p, self.log)
-        attach_root = out_root / ATT_DIR_NAME
-        html_root = out_root / HTML_DIR_NAME
-
-        if not dry_run:
+        opts = {"use_cache": self.cache_var.get(), "workers": self._workers(),
+                "out_root": prev_out, "dedup": self.dedup_var.get(),
+                "versions": "history" if self.history_var.get() else "latest",
+                "page_history": self.page_history_var.get(), "per_space": self.per_space_var.get()}
+        self._cancel.clear()
+        self._worker = threading.Thread(target=self._run_worker, args=(in_p, dry_run, opts), daemon=True)
+        self._worker.start()
+        self.after(LOG_DRAIN_INTERVAL_MS, self._drain_queue)
+
+    def cancel_run(self):
+        if self._worker is not None and not self._cancel.is_set():
+            self._cancel.set()
+            self.btn_cancel.config(state="disabled")
+            log_append(self.log, "[WARN] 中止を要求しました．処理中のファイルが終わり次第停止します．")
+
+    def _run_worker(self, in_p: Path, dry_run: bool, opts: dict):
+        # ワーカースレッド：Tk には一切触れず，結果はすべてキューへ送る
+        q = self._queue
+        log = lambda line: q.put(("log", line))
+        progress = lambda value: q.put(("progress", value))
+        try:
             try:
-                attach_root.mkdir(parents=True, exist_ok=True)
-                html_root.mkdir(parents=True, exist_ok=True)
+                # entities.xml はここで1回だけ解析し，以降の全ステージで共有する
+                model = load_backup_model(in_p, log, use_cache=opts["use_cache"])
             except Exception as e:
-                messagebox.showerror("エラー", f"出力先作成に失敗: {e}")
-                # ボタン状態を元に戻して終了
-                ok = self.validate_input()
-                self.btn_dry.config(state="normal" if ok else "disabled")
-                self.btn_run.config(state="normal" if ok else "disabled")
+                q.put(("error", ("エラー", f"entities.xml の解析に失敗: {e}")))
                 return
-
-        try:
-            # 添付復元（ステップ1）0% ⇒ 20%
-            if in_p.is_file() and in_p.suffix.lower() == ".zip":
-                log_append(self.log, f"=== ZIP入力: {in_p.name} (dry_run={dry_run}) ===")
-                process_zip(in_p, attach_root, dry_run, self.log, progress_cb=self._set_progress)
-            else:
-                log_append(self.log, f"=== フォルダ入力: {in_p} (dry_run={dry_run}) ===")
-                process_folder(in_p, attach_root, dry_run, self.log, progress_cb=self._set_progress)
-            self._set_progress(20)
-
-            # ドライラン
-            if dry_run:
-                self._set_progress(100)
-                log_append(self.log, f"=== DONE (Dry-Run) === 出力予定: {out_root}")
+            if opts["per_space"]:
+                # サイト全体のバックアップ：スペースごとのフォルダに分け，並列数ぶんのプロセスで並行変換
+                summary = convert_site_backup(in_p, opts["out_root"], dry_run=dry_run, log=log, progress_cb=progress,
+                                              model=model, jobs=opts["workers"], workers=1, cancel=self._cancel,
+                                              incremental=opts["out_root"] is not None, dedup=opts["dedup"],
+                                              version_mode=opts["versions"], page_history=opts["page_history"])
+                q.put(("done", summary))
                 return
-
-            # 再配置（ステップ2）20% ⇒ 40%
-            if self.rehome_var.get():
-                log_append(self.log, f"=== Re-home by PageTitle 開始（{ATT_DIR_NAME} 配下） ===")
-                rehome_by_page_title(attach_root, self.log, progress_cb=self._set_progress)
-            self._set_progress(40)
-
-            # HTML 出力（ステップ3）40% ⇒ 99%
-            generate_html_from_xml_root(in_p, html_root, out_root, self.log, progress_cb=self._set_progress)
-
-            # HTML完了0% ⇒ 100%
-            self._set_progress(100)
-
-            log_append(self.log, f"=== DONE === 出力: {out_root}")
-            messagebox.showinfo("Process successful","出力が完了しました")
-
+            out_root = opts["out_root"] or _build_auto_out_root(in_p, log, model=model)
+
+            if not dry_run:
+                try:
+                    (out_root / ATT_DIR_NAME).mkdir(parents=True, exist_ok=True)
+                    (out_root / HTML_DIR_NAME).mkdir(parents=True, exist_ok=True)
+                except Exception as e:
+                    q.put(("error", ("エラー", f"出力先作成に失敗: {e}")))
+                    return
+
+            summary = convert_backup(in_p, out_root, dry_run=dry_run, log=log, progress_cb=progress,
+                                     model=model, workers=opts["workers"],
+                                     cancel=self._cancel, incremental=opts["out_root"] is not None,
+                                     dedup=opts["dedup"], version_mode=opts["versions"],
+                                     page_history=opts["page_history"])
+            q.put(("done", summary))
+        except ConversionCancelled:
+            q.put(("cancelled", None))
         except Exception as e:
             exc_type, exc_value, exc_tb = e.__traceback__.tb_frame, e, e.__traceback__
             line_number = exc_tb.tb_lineno
-            messagebox.showerror("エラった", f"エラーが発生した行番号: {line_number}\n" + str(e))
-
+            q.put(("error", ("エラった", f"エラーが発生した行番号: {line_number}\n" + str(e))))
         finally:
-            # 実行完了後にボタン状態を戻す
-            ok = self.validate_input()
-            self.btn_dry.config(state="normal" if ok else "disabled")
-            self.btn_run.config(state="normal" if ok else "disabled")
+            q.put(("finished", None))
+
+    def _drain_queue(self):
+        # キューに溜まったログをまとめて書き込み，進捗は最新値だけ反映する
+        lines: list[str] = []
+        progress = None
+        finished = False
+        try:
+            while len(lines) < LOG_DRAIN_MAX_LINES:
+                kind, payload = self._queue.get_nowait()
+                if kind == "log":
+                    lines.append(payload)
+                elif kind == "progress":
+                    progress = payload
+                elif kind == "finished":
+                    finished = True
+                    break
+                else:
+                    self._events.append((kind, payload))
+        except queue.Empty:
+            pass
+
+        log_append_many(self.log, lines)
+        if progress is not None:
+            self._set_progress(progress)
+        if not finished:
+            self.after(LOG_DRAIN_INTERVAL_MS, self._drain_queue)
+            return
+
+        # 実行完了後にボタン状態を戻す
+        self._worker = None
+        self.btn_cancel.config(state="disabled")
+        self.validate_input()
+        events, self._events = self._events, []
+        for kind, payload in events:
+            if kind == "done" and not payload.get("dry_run"):
+                messagebox.showinfo("Process successful","出力が完了しました")
+            elif kind == "cancelled":
+                log_append(self.log, "[WARN] 変換を中止しました（出力は途中までです）")
+            elif kind == "error":
+                messagebox.showerror(*payload)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # PyInstaller でのプロセスプール用
+    if sys.argv[1:2] in (["convert"], ["synth"], ["bench"]):
+        sys.exit(main())
+    App = _gui_app()
     App().mainloop()
\ No newline at end of file